@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Benchmarks of the client and the server. Most subcommands compare two
+# ways of doing something in a single run. suite runs the regression
+# scenarios in SCENARIOS and stores their timings as JSON, and compare
+# tells whether one such run is significantly slower than another:
+#
+#   ./benchmarks.py --server local suite --output baseline.json
+#   ./benchmarks.py --server local suite --output current.json --baseline baseline.json
+#   ./benchmarks.py compare baseline1.json baseline2.json current.json
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import localserver
+import syncclient
+from syncclient import (DEFAULT_BATCH_BYTES, DEFAULT_COMPRESS_MIN_SIZE, DEFAULT_MAX_IN_FLIGHT, DEFAULT_PAGE_SIZE,
+                        SERVER, CollectionCache, SyncStorageClient)
+import workload
+
+SUITE_FORMAT = "syncserver-benchmarks"
+SUITE_VERSION = 1
+DEFAULT_ROUNDS = 10
+DEFAULT_SUITE_SCALE = 0.2
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_BOOTSTRAP = 2000
+# Changes smaller than this are not reported even when they are significant
+DEFAULT_THRESHOLD = 0.1
+
+def new_token(client, server):
+    return client.mint_token(server, "%s@mockmyid.com" % uuid.uuid4().hex)
+
+def bench_upload_batch_sizes(server, batch_sizes=(10, 25, 50, 100, 250, 500, 1000), max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                             batch_bytes=DEFAULT_BATCH_BYTES, scale=0.2, seed=0):
+    """Upload the same history collection with each batch size and report
+    records/sec, so the best batch size for the server can be picked."""
+    client = SyncStorageClient(pool_size=max_in_flight)
+    records = workload.ProfileModel(seed, scale).records("history")
+    results = []
+    for batch_size in batch_sizes:
+        token = new_token(client, server)
+        started = time.time()
+        result = client.upload_objects(token, "history", records, batch_size=batch_size,
+                                       batch_bytes=batch_bytes, max_in_flight=max_in_flight)
+        elapsed = time.time() - started
+        results.append({"batch_size": batch_size, "records": len(result["success"]), "failed": len(result["failed"]),
+                        "batches": result["batches"], "seconds": elapsed, "records_per_second": len(records) / elapsed})
+        client.delete_storage(token)
+    return results
+
+def measure_syncs(client, sync, syncs):
+    client.timings.clear()
+    started = time.time()
+    for i in range(syncs):
+        sync()
+    elapsed = time.time() - started
+    timings = list(client.timings)
+    return {"requests": len(timings) / float(syncs), "bytes_sent": sum(t.sent for t in timings) / float(syncs),
+            "bytes_received": sum(t.received for t in timings) / float(syncs), "seconds": elapsed / syncs}
+
+def bench_conditional_sync(server, scale=0.2, seed=0, syncs=20):
+    """Compare a sync without remote changes done by re-fetching every
+    collection with one done by a CollectionCache, which gets 304s."""
+    client = SyncStorageClient()
+    token = new_token(client, server)
+    workload.upload_profile(client, token, workload.ProfileModel(seed, scale))
+    def refetch():
+        info,r = client.get_info_collections(token)
+        for name in sorted(info.keys()):
+            client.get_objects(token, name, full=True)
+    cache = CollectionCache(client, token)
+    cache.sync()
+    results = [dict(measure_syncs(client, refetch, syncs), mode="full re-fetch"),
+               dict(measure_syncs(client, cache.sync, syncs), mode="conditional")]
+    client.delete_storage(token)
+    return results
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+def bench_compression(server, scale=0.2, seed=0, page_size=1000):
+    """Upload a profile and download it again, once with gzip bodies and
+    once without. Payloads are independently random like real ciphertext.
+    Reports bytes on the wire, wall time and the CPU time of this process,
+    which includes the server's when it is local."""
+    profile = workload.ProfileModel(seed, scale, shared_noise=False)
+    results = []
+    for mode, compress_min_size in (("identity", None), ("gzip", DEFAULT_COMPRESS_MIN_SIZE)):
+        client = SyncStorageClient(compress_min_size=compress_min_size)
+        token = new_token(client, server)
+        def upload():
+            workload.upload_profile(client, token, profile)
+        def download():
+            for name in sorted(profile.collections.keys()):
+                for record in client.iter_objects(token, name, full=True, page_size=page_size):
+                    pass
+        for phase, run in (("upload", upload), ("download", download)):
+            client.timings.clear()
+            cpu, started = _cpu_seconds(), time.time()
+            run()
+            elapsed, cpu = time.time() - started, _cpu_seconds() - cpu
+            timings = list(client.timings)
+            results.append({"mode": mode, "phase": phase, "requests": len(timings),
+                            "bytes_sent": sum(t.sent for t in timings),
+                            "bytes_received": sum(t.received for t in timings),
+                            "seconds": elapsed, "cpu_seconds": cpu})
+        client.delete_storage(token)
+    return results
+
+def hot_reads(client, token):
+    # What a desktop client reads on every sync besides /info/collections
+    client.get_object(token, "meta", "global")
+    client.get_object(token, "crypto", "keys")
+    client.get_objects(token, "clients", full=True)
+
+def bench_cache(store="sqlite", scale=0.05, seed=0, devices=3, syncs=20):
+    """Count the queries that reach the store per sync cycle, on a local
+    server with and without its cache. In a cycle every device of one
+    account reads /info/collections and the hot collections and downloads
+    what changed, after the first device uploaded a round of changes."""
+    results = []
+    mockmyid_server = syncclient.MOCKMYID_SERVER
+    for cache_bytes in (0, localserver.DEFAULT_CACHE_BYTES):
+        server = localserver.LocalSyncServer(store=localserver.STORES[store](), cache_bytes=cache_bytes).start()
+        syncclient.MOCKMYID_SERVER = server.url
+        try:
+            client = SyncStorageClient()
+            token = new_token(client, server.url)
+            profile = workload.ProfileModel(seed, scale)
+            sessions = [workload.SyncSession(client, token, profile) for i in range(devices)]
+            sessions[0].first_sync()
+            for session in sessions[1:]:
+                session.last_modified = dict(sessions[0].last_modified)
+            client.timings.clear()
+            queries, started = server.timed_store.queries, time.time()
+            for i in range(syncs):
+                changes = profile.mutate()
+                for n, session in enumerate(sessions):
+                    session.sync(changes if n == 0 else None)
+                    hot_reads(client, token)
+            elapsed = time.time() - started
+            cache = server.cache
+            results.append({"cache_bytes": cache_bytes, "queries": (server.timed_store.queries - queries) / float(syncs),
+                            "requests": len(client.timings) / float(syncs), "seconds": elapsed / syncs,
+                            "hit_ratio": cache.hits / float(max(cache.hits + cache.misses, 1)) if cache else None})
+        finally:
+            syncclient.MOCKMYID_SERVER = mockmyid_server
+            server.stop()
+    return results
+
+# Regression scenarios. Each one sets up an account and then times rounds
+# of one kind of operation, returning the seconds that every operation in
+# the round took. The operation is the unit that the medians are about.
+# The suite runs a round of every scenario in turn, so that a slowdown of
+# the machine while it runs hits all of them instead of a few rounds of one.
+
+def _timed(call, *args, **kwargs):
+    started = time.time()
+    call(*args, **kwargs)
+    return time.time() - started
+
+def _history(seed, count):
+    history = [m for m in workload.COLLECTION_MODELS if m.name == "history"][0]
+    return workload.ProfileModel(seed, models=[history._replace(count=count)]).records("history")
+
+def put_object_setup(client, token, rounds, scale, seed):
+    bookmarks = [m for m in workload.COLLECTION_MODELS if m.name == "bookmarks"][0]
+    profile = workload.ProfileModel(seed, models=[bookmarks._replace(count=rounds * 20)])
+    return profile.records("bookmarks")
+
+def put_object_round(client, token, records, r):
+    return [_timed(client.put_object, token, "bookmarks", record["id"], record) for record in records[r*20:r*20+20]]
+
+def post_batch_setup(client, token, rounds, scale, seed):
+    # New records, like a first sync uploads them
+    return list(workload.batches(_history(seed, rounds * 10 * syncclient.DEFAULT_BATCH_SIZE),
+                                 syncclient.DEFAULT_BATCH_SIZE))
+
+def post_batch_round(client, token, batches, r):
+    return [_timed(client.post_objects, token, "history", batch) for batch in batches[r*10:r*10+10]]
+
+def collection_walk_setup(client, token, rounds, scale, seed):
+    client.upload_objects(token, "history", _history(seed, int(15000 * scale)))
+
+def collection_walk_round(client, token, state, r):
+    walk = lambda: sum(1 for o in client.iter_objects(token, "history", full=True, page_size=DEFAULT_PAGE_SIZE // 2))
+    return [_timed(walk)]
+
+def info_collections_setup(client, token, rounds, scale, seed):
+    workload.upload_profile(client, token, workload.ProfileModel(seed, scale))
+
+def info_collections_round(client, token, state, r):
+    return [_timed(client.get_info_collections, token) for i in range(10)]
+
+def delete_storage_setup(client, token, rounds, scale, seed):
+    return (seed, scale)
+
+def delete_storage_round(client, token, state, r):
+    seed, scale = state
+    workload.upload_profile(client, token, workload.ProfileModel(seed + r, scale))
+    return [_timed(client.delete_storage, token)]
+
+def sync_cycle_setup(client, token, rounds, scale, seed):
+    profile = workload.ProfileModel(seed, scale)
+    session = workload.SyncSession(client, token, profile)
+    session.first_sync()
+    return session
+
+def sync_cycle_round(client, token, session, r):
+    return [session.sync(session.profile.mutate())["duration"] for i in range(2)]
+
+Scenario = collections.namedtuple("Scenario", ["setup", "round", "operation"])
+
+SCENARIOS = collections.OrderedDict([
+    ("put_object", Scenario(put_object_setup, put_object_round, "PUT of one bookmark")),
+    ("post_batch", Scenario(post_batch_setup, post_batch_round,
+                            "POST of %d new records" % syncclient.DEFAULT_BATCH_SIZE)),
+    ("collection_walk", Scenario(collection_walk_setup, collection_walk_round, "paged walk of the history collection")),
+    ("info_collections", Scenario(info_collections_setup, info_collections_round,
+                                  "GET /info/collections of a full profile")),
+    ("delete_storage", Scenario(delete_storage_setup, delete_storage_round, "DELETE /storage of a full profile")),
+    ("sync_cycle", Scenario(sync_cycle_setup, sync_cycle_round, "incremental sync replayed by SyncSession")),
+])
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment(server, rounds, scale, seed):
+    """What a run depends on besides the code, so that comparisons of runs
+    made in different places can be told apart."""
+    local = localserver._local_server is not None and server == localserver._local_server.url
+    env = {"server": "local" if local else server, "python": platform.python_version(), "implementation": platform.python_implementation(),
+           "platform": platform.platform(), "machine": platform.machine(), "cpus": _cpu_count(),
+           "hostname": socket.gethostname(), "commit": _git_commit(), "rounds": rounds, "scale": scale, "seed": seed,
+           "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    if local:
+        env["local_store"] = os.environ.get("LOCAL_STORE", "memory")
+    return env
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[n // 2] + values[(n - 1) // 2]) / 2.0
+
+def _flatten(rounds):
+    return [seconds for samples in rounds for seconds in samples]
+
+def summarize(rounds):
+    samples = _flatten(rounds)
+    ordered = sorted(samples)
+    return {"n": len(samples), "median": median(samples), "mean": sum(samples) / len(samples),
+            "p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], "min": ordered[0]}
+
+def run_suite(server, names=None, rounds=DEFAULT_ROUNDS, scale=DEFAULT_SUITE_SCALE, seed=0, log=None):
+    """Run the scenarios, every one on its own account, and return the run
+    as it is stored in the JSON files."""
+    names = list(names or SCENARIOS.keys())
+    client = SyncStorageClient()
+    tokens, states = {}, {}
+    results = {"format": SUITE_FORMAT, "version": SUITE_VERSION,
+               "environment": environment(server, rounds, scale, seed), "scenarios": collections.OrderedDict()}
+    try:
+        for name in names:
+            tokens[name] = new_token(client, server)
+            states[name] = SCENARIOS[name].setup(client, tokens[name], rounds, scale, seed)
+            results["scenarios"][name] = {"operation": SCENARIOS[name].operation, "rounds": []}
+        for r in range(rounds):
+            for name in names:
+                results["scenarios"][name]["rounds"].append(SCENARIOS[name].round(client, tokens[name], states[name], r))
+    finally:
+        for token in tokens.values():
+            client.delete_storage(token)
+        client.close()
+    for name in names:
+        results["scenarios"][name]["summary"] = summarize(results["scenarios"][name]["rounds"])
+        if log is not None:
+            log(name, results["scenarios"][name])
+    return results
+
+def load_run(path):
+    with open(path) as f:
+        run = json.load(f)
+    if run.get("format") != SUITE_FORMAT or run.get("version") != SUITE_VERSION:
+        raise ValueError("%s is not a benchmark suite run" % path)
+    return run
+
+def bootstrap_ratio(baseline, current, confidence=DEFAULT_CONFIDENCE, resamples=DEFAULT_BOOTSTRAP, seed=0):
+    """The ratio of the current median to the baseline median and its
+    confidence interval. Whole rounds are resampled, not operations, as
+    the operations of a round share whatever slowed the machine down at
+    the time. The timings are skewed and rarely normal, which the
+    bootstrap does not mind."""
+    rnd = random.Random(seed)
+    def resample(rounds):
+        n = len(rounds)
+        return median(_flatten([rounds[int(rnd.random() * n)] for i in range(n)]))
+    ratios = sorted(resample(current) / max(resample(baseline), 1e-12) for i in range(resamples))
+    tail = (1 - confidence) / 2
+    low, high = ratios[int(tail * (resamples - 1))], ratios[int(round((1 - tail) * (resamples - 1)))]
+    return median(_flatten(current)) / max(median(_flatten(baseline)), 1e-12), low, high
+
+def merge_runs(runs):
+    """One baseline of several runs, with the rounds of all of them. The
+    differences between the runs then count towards the intervals too."""
+    merged = {"format": SUITE_FORMAT, "version": SUITE_VERSION, "environment": dict(runs[0]["environment"]),
+              "scenarios": collections.OrderedDict()}
+    for run in runs:
+        for name, result in run["scenarios"].items():
+            merged["scenarios"].setdefault(name, {"operation": result["operation"], "rounds": []})
+            merged["scenarios"][name]["rounds"].extend(result["rounds"])
+    commits = sorted(set((run["environment"].get("commit") or "?")[:12] for run in runs))
+    merged["environment"]["commit"] = ",".join(commits)
+    return merged
+
+def compare_runs(baseline, current, confidence=DEFAULT_CONFIDENCE, threshold=DEFAULT_THRESHOLD):
+    """Compare the scenarios two runs have in common. A scenario is a
+    regression, or an improvement, when the whole confidence interval of
+    its median ratio lies beyond 1 and the ratio beyond 1 +/- threshold."""
+    rows = []
+    for name, result in current["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        ratio, low, high = bootstrap_ratio(baseline["scenarios"][name]["rounds"], result["rounds"], confidence)
+        verdict = "same"
+        if low > 1 and ratio > 1 + threshold:
+            verdict = "REGRESSION"
+        elif high < 1 and ratio < 1 - threshold:
+            verdict = "improvement"
+        rows.append({"scenario": name, "baseline": median(_flatten(baseline["scenarios"][name]["rounds"])),
+                     "current": median(_flatten(result["rounds"])), "ratio": ratio, "low": low, "high": high,
+                     "verdict": verdict})
+    return rows
+
+ENVIRONMENT_KEYS = ("server", "local_store", "python", "implementation", "machine", "cpus", "hostname", "rounds", "scale",
+                    "seed")
+
+def print_comparison(baseline, current, rows, confidence):
+    for key in ENVIRONMENT_KEYS:
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print("warning: %s differs, %s in the baseline and %s now" % (
+                key, baseline["environment"].get(key), current["environment"].get(key)))
+    print("baseline %s, current %s" % ((baseline["environment"].get("commit") or "?")[:12],
+                                       (current["environment"].get("commit") or "?")[:12]))
+    print("%-18s %12s %12s %8s %19s  %s" % ("scenario", "baseline ms", "current ms", "change",
+                                           "%d%% interval" % round(confidence * 100), "verdict"))
+    for r in rows:
+        print("%-18s %12.2f %12.2f %+7.1f%% %+8.1f%% .. %+6.1f%%  %s" % (
+            r["scenario"], r["baseline"] * 1000, r["current"] * 1000, (r["ratio"] - 1) * 100,
+            (r["low"] - 1) * 100, (r["high"] - 1) * 100, r["verdict"]))
+
+def print_scenario(name, result):
+    summary = result["summary"]
+    print("%-18s %6d %11.2f %11.2f %11.2f  %s" % (name, summary["n"], summary["median"] * 1000, summary["p95"] * 1000,
+                                                 summary["mean"] * 1000, result["operation"]), file=sys.stderr)
+
+def run_suite_command(args):
+    names = args.scenarios.split(",") if args.scenarios else None
+    for name in names or ():
+        if name not in SCENARIOS:
+            sys.exit("unknown scenario %s, pick from %s" % (name, ", ".join(SCENARIOS.keys())))
+    print("%-18s %6s %11s %11s %11s  %s" % ("scenario", "n", "median ms", "p95 ms", "mean ms", "operation"),
+          file=sys.stderr)
+    current = run_suite(args.server, names, args.rounds, args.scale, args.seed, log=print_scenario)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=1)
+    if args.baseline:
+        compare_command(args, merge_runs([load_run(path) for path in args.baseline]), current)
+
+def compare_command(args, baseline=None, current=None):
+    if baseline is None:
+        if len(args.runs) < 2:
+            sys.exit("compare needs a baseline and a current run")
+        baseline, current = merge_runs([load_run(path) for path in args.runs[:-1]]), load_run(args.runs[-1])
+    rows = compare_runs(baseline, current, args.confidence, args.threshold)
+    print_comparison(baseline, current, rows, args.confidence)
+    if any(r["verdict"] == "REGRESSION" for r in rows):
+        sys.exit(1)
+
+def print_upload_batch_sizes(args):
+    batch_sizes = [int(n) for n in args.batch_sizes.split(",")]
+    print("%10s %8s %8s %8s %9s %12s" % ("batch_size", "records", "failed", "batches", "seconds", "records/sec"))
+    for r in bench_upload_batch_sizes(args.server, batch_sizes, args.max_in_flight):
+        print("%10d %8d %8d %8d %9.2f %12.1f" % (r["batch_size"], r["records"], r["failed"], r["batches"],
+                                                 r["seconds"], r["records_per_second"]))
+
+def print_conditional_sync(args):
+    print("%-14s %9s %11s %15s %11s" % ("mode", "requests", "bytes sent", "bytes received", "latency ms"))
+    for r in bench_conditional_sync(args.server, args.scale, args.seed, args.syncs):
+        print("%-14s %9.1f %11d %15d %11.2f" % (r["mode"], r["requests"], r["bytes_sent"], r["bytes_received"],
+                                               r["seconds"] * 1000))
+
+def print_compression(args):
+    # Loopback hides transfer time, so also estimate the time on slower
+    # links by adding the bytes on the wire at each link's bandwidth
+    links = [float(mbps) for mbps in args.link_mbps.split(",")]
+    print("%-9s %-9s %9s %12s %15s %9s %9s" % ("mode", "phase", "requests", "bytes sent", "bytes received",
+                                              "seconds", "cpu sec") +
+          "".join(" %12s" % ("@%g Mbit/s" % mbps) for mbps in links))
+    for r in bench_compression(args.server, args.scale, args.seed):
+        wire = r["bytes_sent"] + r["bytes_received"]
+        print("%-9s %-9s %9d %12d %15d %9.2f %9.2f" % (r["mode"], r["phase"], r["requests"], r["bytes_sent"],
+                                                      r["bytes_received"], r["seconds"], r["cpu_seconds"]) +
+              "".join(" %12.2f" % (r["seconds"] + wire * 8 / (mbps * 1000000)) for mbps in links))
+
+def print_cache(args):
+    print("%12s %9s %13s %10s %11s" % ("cache bytes", "requests", "queries/sync", "hit ratio", "latency ms"))
+    for r in bench_cache(args.store, args.scale, args.seed, args.devices, args.syncs):
+        hit_ratio = "%9.1f%%" % (r["hit_ratio"] * 100) if r["hit_ratio"] is not None else "%10s" % "-"
+        print("%12d %9.1f %13.1f %s %11.2f" % (r["cache_bytes"], r["requests"], r["queries"], hit_ratio,
+                                              r["seconds"] * 1000))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync server benchmarks")
+    parser.add_argument("--server", default=SERVER, type=localserver.resolve_server)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    upload = subparsers.add_parser("upload", help="records/sec of upload_objects per batch size")
+    upload.add_argument("--batch-sizes", default="10,25,50,100,250,500,1000")
+    upload.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    upload.set_defaults(bench=print_upload_batch_sizes)
+
+    conditional = subparsers.add_parser("conditional", help="a sync without changes, re-fetched and conditional")
+    conditional.add_argument("--scale", type=float, default=0.2, help="multiplier for the per-profile record counts")
+    conditional.add_argument("--seed", type=int, default=0)
+    conditional.add_argument("--syncs", type=int, default=20)
+    conditional.set_defaults(bench=print_conditional_sync)
+
+    compression = subparsers.add_parser("compression", help="bytes, CPU and latency with and without gzip")
+    compression.add_argument("--scale", type=float, default=0.2, help="multiplier for the per-profile record counts")
+    compression.add_argument("--seed", type=int, default=0)
+    compression.add_argument("--link-mbps", default="2,10,100", help="link speeds to estimate end-to-end time for")
+    compression.set_defaults(bench=print_compression)
+
+    cache = subparsers.add_parser("cache", help="store queries per sync cycle with and without the local server's cache")
+    cache.add_argument("--store", choices=sorted(localserver.STORES.keys()), default="sqlite")
+    cache.add_argument("--scale", type=float, default=0.05, help="multiplier for the per-profile record counts")
+    cache.add_argument("--seed", type=int, default=0)
+    cache.add_argument("--devices", type=int, default=3, help="devices syncing the account")
+    cache.add_argument("--syncs", type=int, default=20)
+    cache.set_defaults(bench=print_cache)
+
+    def add_comparison_arguments(subparser):
+        subparser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE)
+        subparser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                               help="smallest relative change of a median to report")
+
+    suite = subparsers.add_parser("suite", help="run the regression scenarios and store their timings")
+    suite.add_argument("--scenarios", help="comma separated, of %s" % ", ".join(SCENARIOS.keys()))
+    suite.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS)
+    suite.add_argument("--scale", type=float, default=DEFAULT_SUITE_SCALE, help="multiplier for the per-profile record counts")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--output", help="JSON file to store the run in")
+    suite.add_argument("--baseline", nargs="+", help="JSON files of earlier runs to compare with")
+    add_comparison_arguments(suite)
+    suite.set_defaults(bench=run_suite_command)
+
+    compare = subparsers.add_parser("compare", help="compare stored runs, exits with 1 on a regression")
+    compare.add_argument("runs", nargs="+", metavar="run", help="baseline runs, then the current run")
+    add_comparison_arguments(compare)
+    compare.set_defaults(bench=compare_command)
+
+    args = parser.parse_args()
+    args.bench(args)
@@ -0,0 +1,158 @@
+// This Source Code Form is subject to the terms of the Mozilla Public
+// License, v. 2.0. If a copy of the MPL was not distributed with this
+// file, You can obtain one at http://mozilla.org/MPL/2.0/
+
+package main
+
+// gzip for the storage API. Request bodies sent with Content-Encoding: gzip
+// are inflated before they reach the storage server, and responses of at
+// least minSize bytes are compressed for clients that accept gzip. It wraps
+// Instrument, so the metrics see the decoded sizes and can count records.
+
+import (
+	"bytes"
+	"compress/gzip"
+	"io"
+	"io/ioutil"
+	"net/http"
+	"strconv"
+	"strings"
+)
+
+const (
+	DEFAULT_COMPRESSION_MIN_SIZE = 1024
+
+	// A few KB of gzip can inflate to gigabytes, so request bodies that
+	// inflate to more than this are refused
+	MAX_DECODED_BODY_SIZE = 16 * 1024 * 1024
+)
+
+// inflateRequestBody replaces a gzipped request body with the inflated one.
+// It returns the status to answer with when that fails.
+func inflateRequestBody(r *http.Request) int {
+	reader, err := gzip.NewReader(r.Body)
+	if err != nil {
+		return http.StatusBadRequest
+	}
+	body, err := ioutil.ReadAll(io.LimitReader(reader, MAX_DECODED_BODY_SIZE+1))
+	if err != nil {
+		return http.StatusBadRequest
+	}
+	if len(body) > MAX_DECODED_BODY_SIZE {
+		return http.StatusRequestEntityTooLarge
+	}
+	r.Body.Close()
+	r.Body = ioutil.NopCloser(bytes.NewReader(body))
+	r.Header.Del("Content-Encoding")
+	r.Header.Set("Content-Length", strconv.Itoa(len(body)))
+	r.ContentLength = int64(len(body))
+	return http.StatusOK
+}
+
+// gzipResponseWriter holds back the first minSize bytes of the response to
+// decide whether it is worth compressing
+type gzipResponseWriter struct {
+	http.ResponseWriter
+	minSize int
+	status  int
+	buffer  []byte
+	gzip    *gzip.Writer
+	decided bool
+}
+
+func (w *gzipResponseWriter) WriteHeader(status int) {
+	w.status = status
+}
+
+func (w *gzipResponseWriter) Write(p []byte) (int, error) {
+	if w.status == 0 {
+		w.status = http.StatusOK
+	}
+	if w.decided {
+		if w.gzip != nil {
+			return w.gzip.Write(p)
+		}
+		return w.ResponseWriter.Write(p)
+	}
+	w.buffer = append(w.buffer, p...)
+	if len(w.buffer) >= w.minSize {
+		if err := w.decide(true); err != nil {
+			return 0, err
+		}
+	}
+	return len(p), nil
+}
+
+func (w *gzipResponseWriter) decide(compress bool) error {
+	w.decided = true
+	header := w.Header()
+	header.Add("Vary", "Accept-Encoding")
+	if compress && header.Get("Content-Encoding") == "" {
+		header.Set("Content-Encoding", "gzip")
+		header.Del("Content-Length")
+		w.gzip = gzip.NewWriter(w.ResponseWriter)
+	}
+	w.ResponseWriter.WriteHeader(w.status)
+	buffer := w.buffer
+	w.buffer = nil
+	if w.gzip != nil {
+		_, err := w.gzip.Write(buffer)
+		return err
+	}
+	_, err := w.ResponseWriter.Write(buffer)
+	return err
+}
+
+func (w *gzipResponseWriter) Close() error {
+	if !w.decided {
+		if w.status == 0 {
+			w.status = http.StatusOK
+		}
+		if err := w.decide(false); err != nil {
+			return err
+		}
+	}
+	if w.gzip != nil {
+		return w.gzip.Close()
+	}
+	return nil
+}
+
+func acceptsGzip(r *http.Request) bool {
+	for _, encoding := range strings.Split(r.Header.Get("Accept-Encoding"), ",") {
+		if strings.TrimSpace(strings.SplitN(encoding, ";", 2)[0]) == "gzip" {
+			return true
+		}
+	}
+	return false
+}
+
+// Compress wraps the handler for the storage API. A negative minSize
+// turns off response compression; gzipped request bodies are still read.
+func Compress(next http.Handler, minSize int) http.Handler {
+	return http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		switch r.Header.Get("Content-Encoding") {
+		case "", "identity":
+		case "gzip":
+			switch inflateRequestBody(r) {
+			case http.StatusBadRequest:
+				http.Error(w, "Invalid gzip request body", http.StatusBadRequest)
+				return
+			case http.StatusRequestEntityTooLarge:
+				http.Error(w, "Request body too large", http.StatusRequestEntityTooLarge)
+				return
+			}
+		default:
+			http.Error(w, "Unsupported Content-Encoding", http.StatusUnsupportedMediaType)
+			return
+		}
+
+		if minSize < 0 || !acceptsGzip(r) {
+			next.ServeHTTP(w, r)
+			return
+		}
+		gw := &gzipResponseWriter{ResponseWriter: w, minSize: minSize}
+		defer gw.Close()
+		next.ServeHTTP(gw, r)
+	})
+}
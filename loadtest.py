@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function
+
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import requests.exceptions
+
+import localserver
+import metrics
+from syncclient import SERVER, SyncStorageClient
+from workload import random_id, random_object, random_objects
+
+DEFAULT_MIX = {
+    "put_object": 30,
+    "post_objects": 10,
+    "get_objects": 40,
+    "get_info_collections": 15,
+    "delete_collection": 5,
+}
+
+COLLECTIONS = ["bookmarks", "history", "forms", "tabs"]
+
+POST_BATCH_SIZE = 10
+
+class LoadTestUser(object):
+
+    def __init__(self, client, server):
+        self.email = "%s@mockmyid.com" % uuid.uuid4().hex
+        self.token = client.mint_token(server, self.email)
+        self.last_modified = {}
+
+def op_put_object(client, user, rnd):
+    collection = rnd.choice(COLLECTIONS)
+    modified,r = client.put_object(user.token, collection, random_id(), random_object())
+    user.last_modified.setdefault(collection, modified)
+
+def op_post_objects(client, user, rnd):
+    collection = rnd.choice(COLLECTIONS)
+    j,r = client.post_objects(user.token, collection, random_objects(POST_BATCH_SIZE))
+    user.last_modified.setdefault(collection, j["modified"])
+
+def op_get_objects(client, user, rnd):
+    collection = rnd.choice(COLLECTIONS)
+    newer = user.last_modified.get(collection)
+    ids,r = client.get_objects(user.token, collection, newer=newer)
+    # A collection that does not exist comes back empty with a zero
+    # X-Last-Modified, only remember the ones that do
+    modified = float(r.headers.get("X-Last-Modified", 0))
+    if modified > 0:
+        user.last_modified[collection] = modified
+
+def op_get_info_collections(client, user, rnd):
+    client.get_info_collections(user.token)
+
+def op_delete_collection(client, user, rnd):
+    if not user.last_modified:
+        return op_put_object(client, user, rnd)
+    collection = rnd.choice(sorted(user.last_modified.keys()))
+    try:
+        client.delete_collection(user.token, collection)
+    except requests.exceptions.HTTPError as e:
+        # Someone else removed it, it is gone either way
+        if e.response.status_code == 404:
+            del user.last_modified[collection]
+        raise
+    del user.last_modified[collection]
+
+OPERATIONS = {
+    "put_object": op_put_object,
+    "post_objects": op_post_objects,
+    "get_objects": op_get_objects,
+    "get_info_collections": op_get_info_collections,
+    "delete_collection": op_delete_collection,
+}
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[k]
+
+class RateLimiter(object):
+
+    """Spaces out operations across all workers so that the total rate
+    approaches ops_per_second. The rate grows linearly during ramp_up."""
+
+    def __init__(self, ops_per_second, ramp_up=0.0):
+        self.ops_per_second = ops_per_second
+        self.ramp_up = ramp_up
+        self.started = time.time()
+        self.next_slot = self.started
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.ops_per_second:
+            return
+        with self.lock:
+            now = time.time()
+            rate = self.ops_per_second
+            if self.ramp_up and now - self.started < self.ramp_up:
+                rate = max(rate * (now - self.started) / self.ramp_up, 1.0)
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1.0 / rate
+        delay = slot - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+class LoadTestStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.started = None
+        self.finished = None
+
+    def record(self, endpoint, latency, status):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def report(self):
+        duration = (self.finished or time.time()) - self.started
+        results = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            statuses = self.statuses[endpoint]
+            errors = dict((s, n) for s, n in statuses.items() if s != "200")
+            results[endpoint] = {
+                "count": len(latencies),
+                "throughput": len(latencies) / duration,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "error_rate": sum(errors.values()) / float(len(latencies)),
+                "errors": errors,
+            }
+        return results
+
+def run_worker(client, user, mix, limiter, stats, deadline, seed):
+    rnd = random.Random(seed)
+    names = sorted(mix.keys())
+    weights = [mix[name] for name in names]
+    while time.time() < deadline:
+        limiter.wait()
+        endpoint = names[weighted_choice(rnd, weights)]
+        started = time.time()
+        try:
+            OPERATIONS[endpoint](client, user, rnd)
+            status = 200
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code
+        except Exception as e:
+            # Count anything else too, a worker that died would silently
+            # drop its share of the operations from the report
+            status = e.__class__.__name__
+        # HTTP statuses and exception names are both keyed as strings so
+        # that the report can sort them
+        stats.record(endpoint, time.time() - started, str(status))
+
+def weighted_choice(rnd, weights):
+    n = rnd.uniform(0, sum(weights))
+    for i, weight in enumerate(weights):
+        n -= weight
+        if n <= 0:
+            return i
+    return len(weights) - 1
+
+def run_load_test(server=SERVER, users=10, duration=60.0, ramp_up=0.0, rate=None, mix=None, seed=None):
+    mix = mix or DEFAULT_MIX
+    client = SyncStorageClient(pool_size=users)
+    load_test_users = [LoadTestUser(client, server) for i in range(users)]
+    stats = LoadTestStats()
+    stats.started = time.time()
+    limiter = RateLimiter(rate, ramp_up)
+    deadline = stats.started + ramp_up + duration
+    rnd = random.Random(seed)
+    threads = []
+    for i, user in enumerate(load_test_users):
+        # Spread worker start times over the ramp up period
+        delay = stats.started + ramp_up * i / users - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        t = threading.Thread(target=run_worker, args=(client, user, mix, limiter, stats, deadline, rnd.random()))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    stats.finished = time.time()
+    client.close()
+    return stats
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, weight = part.split("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation %s" % name)
+        mix[name] = float(weight)
+    return mix
+
+def print_report(results):
+    print("%-22s %8s %10s %9s %9s %9s %8s  %s" % ("endpoint", "count", "ops/sec", "p50 ms", "p95 ms", "p99 ms", "errors", "by status"))
+    for endpoint, r in sorted(results.items()):
+        print("%-22s %8d %10.1f %9.1f %9.1f %9.1f %7.2f%%  %s" % (endpoint, r["count"], r["throughput"],
+              r["p50"] * 1000, r["p95"] * 1000, r["p99"] * 1000, r["error_rate"] * 100,
+              " ".join("%s:%d" % (s, n) for s, n in sorted(r["errors"].items()))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a sync server")
+    parser.add_argument("--server", default=SERVER, type=localserver.resolve_server)
+    parser.add_argument("--users", type=int, default=10, help="number of concurrent users")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to run after ramp up")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="seconds to ramp up users and rate")
+    parser.add_argument("--rate", type=float, default=None, help="target operations per second")
+    parser.add_argument("--mix", type=parse_mix, default=None, help="for example put_object=30,get_objects=70")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--metrics", action="store_true", help="scrape the server's /metrics and attribute its time")
+    args = parser.parse_args()
+    if args.metrics:
+        before = metrics.scrape(args.server)
+    stats = run_load_test(args.server, args.users, args.duration, args.ramp_up, args.rate, args.mix, args.seed)
+    print_report(stats.report())
+    if args.metrics:
+        print()
+        samples = metrics.delta(before, metrics.scrape(args.server))
+        metrics.print_attribution(metrics.attribute(samples))
+        metrics.print_store(samples)
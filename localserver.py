@@ -0,0 +1,1291 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# A pure Python stand-in for the sync server and mockmyid. It implements
+# the token server (/token/1.0/sync/1.5), the mockmyid /assertion mock and
+# the parts of the storage API that tests.py exercises, backed by an
+# in-memory, a SQLite or a PostgreSQL store. It is meant for running the
+# tests and benchmarking client code without the real stack.
+#
+#   ./localserver.py --port 5000 --store sqlite --database /tmp/sync.db
+#   SYNC_SERVER=http://127.0.0.1:5000 MOCKMYID_SERVER=http://127.0.0.1:5000 ./tests.py
+#
+# Or let the tests start one in-process:
+#
+#   SYNC_SERVER=local ./tests.py
+
+from __future__ import print_function
+
+import argparse
+import atexit
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlsplit
+
+import dump
+import metrics
+import nodes
+import schema
+
+DEFAULT_SORTINDEX = 0
+DEFAULT_TTL = 2100000000
+DEFAULT_TOKEN_DURATION = 300
+DEFAULT_SHARED_SECRET = "ThisIsTheLocalServerSecret"
+
+# Responses of at least this many bytes are gzipped for clients that
+# accept it, like DEFAULT_COMPRESSION_MIN_SIZE in compression.go
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+# Gzipped request bodies that inflate to more than this are refused, like
+# MAX_DECODED_BODY_SIZE in compression.go
+MAX_DECODED_BODY_SIZE = 16 * 1024 * 1024
+
+# Every sync reads /info/collections and these small, rarely changing
+# collections, so CachedStore keeps them in memory
+HOT_COLLECTIONS = ("meta", "crypto", "clients")
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+# Bounds how long a change made behind the server's back, like purge.py
+# deleting expired clients records, can go unnoticed
+DEFAULT_CACHE_SECONDS = 60
+
+# The scratch schema of the postgres store, dropped when it starts
+DEFAULT_POSTGRES_SCHEMA = "localserver"
+
+# Hawk requests with a timestamp further off than this are rejected
+MAX_CLOCK_SKEW = 60
+
+MAX_COLLECTION_NAME = 32
+MAX_ID = 64
+
+_COLLECTION_NAME = re.compile(r"^[a-zA-Z0-9._-]{1,%d}$" % MAX_COLLECTION_NAME)
+_HAWK_ATTRIBUTE = re.compile(r'(\w+)="([^"\\]*)"')
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None, headers=None):
+        Exception.__init__(self, message or str(status))
+        self.status = status
+        self.headers = headers
+
+def _bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def _b64decode(s):
+    s = str(s)
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+def _now():
+    # Timestamps are kept in milliseconds, rounded to the 10ms that the
+    # API exposes as seconds with two decimals
+    return int(time.time() * 100) * 10
+
+def _seconds(modified):
+    return round(modified / 1000.0, 2)
+
+def _milliseconds(seconds):
+    return int(round(float(seconds) * 1000))
+
+# Stores
+
+class MemoryStore(object):
+
+    """Keeps everything in dicts. All calls are made with the server's
+    lock held."""
+
+    def __init__(self):
+        self.users = {}
+        self.nodes = {}
+        self.objects = {}
+
+    def get_user(self, email):
+        if email not in self.users:
+            self.users[email] = len(self.users) + 1
+        return self.users[email]
+
+    def get_node(self, uid):
+        return self.nodes.get(uid, (None, False))
+
+    def set_node(self, uid, node, migrating=False):
+        self.nodes[uid] = (node, migrating)
+
+    def node_users(self, node):
+        return sorted((uid, email) for email, uid in self.users.items() if self.nodes.get(uid, (None,))[0] == node)
+
+    def info_collections(self, uid):
+        return dict((name, max(o["modified"] for o in objects.values()))
+                    for name, objects in self.objects.get(uid, {}).items() if objects)
+
+    def info_collection_counts(self, uid):
+        return dict((name, len(objects)) for name, objects in self.objects.get(uid, {}).items() if objects)
+
+    def get_object(self, uid, collection_name, object_id):
+        o = self.objects.get(uid, {}).get(collection_name, {}).get(object_id)
+        return dict(o) if o is not None else None
+
+    def get_objects(self, uid, collection_name, newer=None, ids=None, sort=None, limit=None, offset=0, after=None):
+        objects = self.objects.get(uid, {}).get(collection_name, {})
+        if ids is not None:
+            objects = [objects[i] for i in ids if i in objects]
+        else:
+            objects = list(objects.values())
+        if newer is not None:
+            objects = [o for o in objects if o["modified"] > newer]
+        if after is not None:
+            objects = [o for o in objects if _sorts_after(o, sort, after)]
+        objects.sort(key=lambda o: o["id"])
+        if sort == "oldest":
+            objects.sort(key=lambda o: o["modified"])
+        elif sort == "newest":
+            objects.sort(key=lambda o: o["modified"], reverse=True)
+        elif sort == "index":
+            objects.sort(key=lambda o: o["sortindex"], reverse=True)
+        end = offset + limit if limit else None
+        return [dict(o) for o in objects[offset:end]], end is not None and end < len(objects)
+
+    def put_objects(self, uid, collection_name, objects, modified):
+        collection = self.objects.setdefault(uid, {}).setdefault(collection_name, {})
+        for o in objects:
+            stored = collection.setdefault(o["id"], {"id": o["id"], "payload": "", "sortindex": DEFAULT_SORTINDEX,
+                                                     "ttl": DEFAULT_TTL})
+            for field in ("payload", "sortindex", "ttl"):
+                if o.get(field) is not None:
+                    stored[field] = o[field]
+            stored["modified"] = modified
+
+    def delete_objects(self, uid, collection_name, ids=None):
+        collection = self.objects.get(uid, {}).get(collection_name)
+        if not collection:
+            return 0
+        if ids is None:
+            del self.objects[uid][collection_name]
+            return len(collection)
+        deleted = [collection.pop(i) for i in ids if i in collection]
+        return len(deleted)
+
+    def delete_storage(self, uid):
+        self.objects.pop(uid, None)
+
+# SQLite does not have plpgsql, so the triggers that maintain Collections
+# in setup.sql are restated here in SQLite's dialect.
+SQLITE_TRIGGERS = [
+    """create trigger if not exists ObjectsInsertTrigger after insert on Objects begin
+         insert or ignore into Collections (UserId, CollectionName, Modified, Count, TotalPayloadSize)
+           values (new.UserId, new.CollectionName, new.Modified, 0, 0);
+         update Collections set Modified = max(Modified, new.Modified), Count = Count + 1,
+           TotalPayloadSize = TotalPayloadSize + new.PayloadSize
+           where UserId = new.UserId and CollectionName = new.CollectionName;
+       end""",
+    """create trigger if not exists ObjectsUpdateTrigger after update on Objects begin
+         update Collections set Modified = max(Modified, new.Modified),
+           TotalPayloadSize = TotalPayloadSize + new.PayloadSize - old.PayloadSize
+           where UserId = new.UserId and CollectionName = new.CollectionName;
+       end""",
+    """create trigger if not exists ObjectsDeleteTrigger after delete on Objects begin
+         update Collections set Count = Count - 1, TotalPayloadSize = TotalPayloadSize - old.PayloadSize,
+           Modified = coalesce((select max(Modified) from Objects
+             where UserId = old.UserId and CollectionName = old.CollectionName), Modified)
+           where UserId = old.UserId and CollectionName = old.CollectionName;
+         delete from Collections where UserId = old.UserId and CollectionName = old.CollectionName and Count <= 0;
+       end""",
+]
+
+# The field each sort order sorts on and whether it sorts descending. Ties
+# are always broken by ascending Id, which makes (field, Id) a unique key
+# that a page can be continued from.
+SORT_KEYS = {
+    None: (None, False),
+    "oldest": ("modified", False),
+    "newest": ("modified", True),
+    "index": ("sortindex", True),
+}
+
+def _sorts_after(o, sort, after):
+    field, descending = SORT_KEYS[sort]
+    value, object_id = after
+    if field is None or o[field] == value:
+        return o["id"] > object_id
+    return o[field] < value if descending else o[field] > value
+
+SQLITE_SORT_ORDERS = {
+    None: "Id",
+    "oldest": "Modified, Id",
+    "newest": "Modified desc, Id",
+    "index": "SortIndex desc, Id",
+}
+
+class SQLiteStore(object):
+
+    """Stores objects in SQLite using the Objects and Collections tables
+    from setup.sql. All calls are made with the server's lock held."""
+
+    def __init__(self, path=":memory:"):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""create table if not exists Users (
+                             Uid integer primary key autoincrement,
+                             Email varchar unique not null,
+                             Node varchar(64),
+                             Migrating boolean not null default 0)""")
+        for table in ("Objects", "Collections"):
+            self.db.execute(schema.sqlite_create_table_statement(table).replace("create table", "create table if not exists", 1))
+        for statement in schema.sql_statements(schema.SETUP_SQL):
+            # SQLite integers are 64 bits already, the expiry index does
+            # not need the Postgres cast
+            if statement.startswith("create index"):
+                statement = statement.replace("::bigint", "")
+                self.db.execute(statement.replace("create index", "create index if not exists", 1))
+        for statement in SQLITE_TRIGGERS:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def get_user(self, email):
+        row = self.db.execute("select Uid from Users where Email = ?", (email,)).fetchone()
+        if row is None:
+            with self.db:
+                return self.db.execute("insert into Users (Email) values (?)", (email,)).lastrowid
+        return row[0]
+
+    def get_node(self, uid):
+        row = self.db.execute("select Node, Migrating from Users where Uid = ?", (uid,)).fetchone()
+        return (row[0], bool(row[1])) if row is not None else (None, False)
+
+    def set_node(self, uid, node, migrating=False):
+        with self.db:
+            self.db.execute("update Users set Node = ?, Migrating = ? where Uid = ?", (node, migrating, uid))
+
+    def node_users(self, node):
+        return self.db.execute("select Uid, Email from Users where Node = ? order by Uid", (node,)).fetchall()
+
+    def info_collections(self, uid):
+        return dict(self.db.execute("select CollectionName, Modified from Collections where UserId = ?", (uid,)))
+
+    def info_collection_counts(self, uid):
+        return dict(self.db.execute("select CollectionName, Count from Collections where UserId = ?", (uid,)))
+
+    def _object(self, row):
+        return {"id": row[0], "sortindex": row[1], "modified": row[2], "payload": row[3], "ttl": row[4]}
+
+    def get_object(self, uid, collection_name, object_id):
+        row = self.db.execute("select Id, SortIndex, Modified, Payload, TTL from Objects"
+                              " where UserId = ? and CollectionName = ? and Id = ?",
+                              (uid, collection_name, object_id)).fetchone()
+        return self._object(row) if row is not None else None
+
+    def get_objects(self, uid, collection_name, newer=None, ids=None, sort=None, limit=None, offset=0, after=None):
+        sql = "select Id, SortIndex, Modified, Payload, TTL from Objects where UserId = ? and CollectionName = ?"
+        params = [uid, collection_name]
+        if newer is not None:
+            sql += " and Modified > ?"
+            params.append(newer)
+        if ids is not None:
+            sql += " and Id in (%s)" % ",".join("?" * len(ids))
+            params.extend(ids)
+        if after is not None:
+            # Written so that the index on the sort field can seek to the
+            # start of the page, instead of skipping over earlier rows
+            field, descending = SORT_KEYS[sort]
+            if field is None:
+                sql += " and Id > ?"
+                params.append(after[1])
+            else:
+                sql += " and %s %s ? and (%s %s ? or Id > ?)" % (field, "<=" if descending else ">=",
+                                                                 field, "<" if descending else ">")
+                params.extend([after[0], after[0], after[1]])
+        sql += " order by " + SQLITE_SORT_ORDERS[sort]
+        # Fetch one extra row to find out if there is a next page
+        sql += " limit ? offset ?"
+        params.extend([limit + 1 if limit else -1, offset])
+        rows = self.db.execute(sql, params).fetchall()
+        more = bool(limit) and len(rows) > limit
+        return [self._object(row) for row in rows[:limit]], more
+
+    def put_objects(self, uid, collection_name, objects, modified):
+        rows = [{"uid": uid, "collection": collection_name, "id": o["id"], "sortindex": o.get("sortindex"),
+                 "modified": modified, "payload": o.get("payload"),
+                 "payloadsize": len(o["payload"]) if o.get("payload") is not None else None, "ttl": o.get("ttl")}
+                for o in objects]
+        with self.db:
+            self.db.executemany("""insert into Objects (UserId, CollectionName, Id, SortIndex, Modified, Payload, PayloadSize, TTL)
+                                   values (:uid, :collection, :id, coalesce(:sortindex, %d), :modified,
+                                           coalesce(:payload, ''), coalesce(:payloadsize, 0), coalesce(:ttl, %d))
+                                   on conflict (UserId, CollectionName, Id) do update set
+                                     SortIndex = coalesce(:sortindex, SortIndex), Modified = :modified,
+                                     Payload = coalesce(:payload, Payload), PayloadSize = coalesce(:payloadsize, PayloadSize),
+                                     TTL = coalesce(:ttl, TTL)""" % (DEFAULT_SORTINDEX, DEFAULT_TTL), rows)
+
+    def delete_objects(self, uid, collection_name, ids=None):
+        sql = "delete from Objects where UserId = ? and CollectionName = ?"
+        params = [uid, collection_name]
+        if ids is not None:
+            sql += " and Id in (%s)" % ",".join("?" * len(ids))
+            params.extend(ids)
+        with self.db:
+            return self.db.execute(sql, params).rowcount
+
+    def delete_storage(self, uid):
+        with self.db:
+            self.db.execute("delete from Objects where UserId = ?", (uid,))
+
+# Ids are compared bytewise, like Python compares the cursors
+POSTGRES_SORT_ORDERS = {
+    None: 'Id collate "C"',
+    "oldest": 'Modified, Id collate "C"',
+    "newest": 'Modified desc, Id collate "C"',
+    "index": 'SortIndex desc, Id collate "C"',
+}
+
+# A whole POST batch in one statement, so one round trip and one
+# transaction. The conflict check looks every id up in the primary key,
+# whatever the statistics say about the collection, which is usually still
+# filling up during a first sync. excluded holds the defaults for the
+# fields a record leaves out, so omitted maps the ids of such records to
+# those fields, and the stored values are kept for them.
+POSTGRES_UPSERT = """
+  insert into Objects (UserId, CollectionName, Id, SortIndex, Modified, Payload, PayloadSize, TTL)
+    select %%(uid)s, %%(collection)s, b.Id, coalesce(b.SortIndex, %d), %%(modified)s, coalesce(b.Payload, ''),
+           coalesce(b.PayloadSize, 0), coalesce(b.TTL, %d)
+      from unnest(%%(ids)s::varchar[], %%(sortindexes)s::integer[], %%(payloads)s::text[],
+                  %%(payloadsizes)s::integer[], %%(ttls)s::integer[]) as b(Id, SortIndex, Payload, PayloadSize, TTL)
+    on conflict (UserId, CollectionName, Id) do update set
+      SortIndex = case when (%%(omitted)s::jsonb -> excluded.Id) ? 'sortindex'
+                    then Objects.SortIndex else excluded.SortIndex end,
+      Modified = excluded.Modified,
+      Payload = case when (%%(omitted)s::jsonb -> excluded.Id) ? 'payload'
+                  then Objects.Payload else excluded.Payload end,
+      PayloadSize = case when (%%(omitted)s::jsonb -> excluded.Id) ? 'payload'
+                      then Objects.PayloadSize else excluded.PayloadSize end,
+      TTL = case when (%%(omitted)s::jsonb -> excluded.Id) ? 'ttl'
+              then Objects.TTL else excluded.TTL end""" % (DEFAULT_SORTINDEX, DEFAULT_TTL)
+
+def _merge_batch(objects):
+    # An upsert can only touch a row once, so the records for an id that
+    # is repeated in a batch are merged like they would have been applied
+    merged = collections.OrderedDict()
+    for o in objects:
+        if o["id"] in merged:
+            merged[o["id"]].update((k, v) for k, v in o.items() if v is not None)
+        else:
+            merged[o["id"]] = dict(o)
+    return list(merged.values())
+
+class PostgresStore(object):
+
+    """Stores objects in PostgreSQL with the tables, indexes and triggers of
+    setup.sql. All calls are made with the server's lock held, and each is
+    a single statement in autocommit."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.autocommit = True
+
+    @classmethod
+    def create(cls, dsn=dump.DEFAULT_DSN, schema_name=DEFAULT_POSTGRES_SCHEMA):
+        """A store in a scratch schema, dropped and set up again from
+        setup.sql."""
+        import psycopg2
+        conn = psycopg2.connect(dsn)
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("drop schema if exists %s cascade" % schema_name)
+        cur.execute("create schema %s" % schema_name)
+        cur.execute("set search_path to %s" % schema_name)
+        for statement in schema.sql_statements(schema.SETUP_SQL):
+            cur.execute(statement)
+        return cls(conn)
+
+    def execute(self, sql, params=()):
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        return cur
+
+    def get_user(self, email):
+        row = self.execute("select Uid from Users where Email = %s", (email,)).fetchone()
+        if row is None:
+            row = self.execute("insert into Users (Email, Generation, ClientState) values (%s, 0, '') returning Uid",
+                               (email,)).fetchone()
+        return row[0]
+
+    def get_node(self, uid):
+        row = self.execute("select Node, Migrating from Users where Uid = %s", (uid,)).fetchone()
+        return tuple(row) if row is not None else (None, False)
+
+    def set_node(self, uid, node, migrating=False):
+        self.execute("update Users set Node = %s, Migrating = %s where Uid = %s", (node, migrating, uid))
+
+    def node_users(self, node):
+        return self.execute("select Uid, Email from Users where Node = %s order by Uid", (node,)).fetchall()
+
+    def info_collections(self, uid):
+        return dict(self.execute("select CollectionName, Modified from Collections where UserId = %s", (uid,)))
+
+    def info_collection_counts(self, uid):
+        return dict(self.execute("select CollectionName, Count from Collections where UserId = %s", (uid,)))
+
+    def _object(self, row):
+        return {"id": row[0], "sortindex": row[1], "modified": row[2], "payload": row[3], "ttl": row[4]}
+
+    def get_object(self, uid, collection_name, object_id):
+        row = self.execute("select Id, SortIndex, Modified, Payload, TTL from Objects"
+                           " where UserId = %s and CollectionName = %s and Id = %s",
+                           (uid, collection_name, object_id)).fetchone()
+        return self._object(row) if row is not None else None
+
+    def get_objects(self, uid, collection_name, newer=None, ids=None, sort=None, limit=None, offset=0, after=None):
+        sql = "select Id, SortIndex, Modified, Payload, TTL from Objects where UserId = %s and CollectionName = %s"
+        params = [uid, collection_name]
+        if newer is not None:
+            sql += " and Modified > %s"
+            params.append(newer)
+        if ids is not None:
+            sql += " and Id = any(%s)"
+            params.append(list(ids))
+        if after is not None:
+            field, descending = SORT_KEYS[sort]
+            if field is None:
+                sql += ' and Id > %s collate "C"'
+                params.append(after[1])
+            else:
+                sql += ' and %s %s %%s and (%s %s %%s or Id > %%s collate "C")' % (
+                    field, "<=" if descending else ">=", field, "<" if descending else ">")
+                params.extend([after[0], after[0], after[1]])
+        sql += " order by " + POSTGRES_SORT_ORDERS[sort]
+        sql += " limit %s offset %s"
+        params.extend([limit + 1 if limit else None, offset])
+        rows = self.execute(sql, params).fetchall()
+        more = bool(limit) and len(rows) > limit
+        return [self._object(row) for row in rows[:limit]], more
+
+    def put_objects(self, uid, collection_name, objects, modified):
+        objects = _merge_batch(objects)
+        omitted = {}
+        for o in objects:
+            fields = [field for field in ("sortindex", "payload", "ttl") if o.get(field) is None]
+            if fields:
+                omitted[o["id"]] = fields
+        self.execute(POSTGRES_UPSERT, {
+            "uid": uid, "collection": collection_name, "modified": modified,
+            "ids": [o["id"] for o in objects],
+            "sortindexes": [o.get("sortindex") for o in objects],
+            "payloads": [o.get("payload") for o in objects],
+            "payloadsizes": [len(o["payload"]) if o.get("payload") is not None else None for o in objects],
+            "ttls": [o.get("ttl") for o in objects],
+            "omitted": json.dumps(omitted),
+        })
+
+    def delete_objects(self, uid, collection_name, ids=None):
+        sql = "delete from Objects where UserId = %s and CollectionName = %s"
+        params = [uid, collection_name]
+        if ids is not None:
+            sql += " and Id = any(%s)"
+            params.append(list(ids))
+        return self.execute(sql, params).rowcount
+
+    def delete_storage(self, uid):
+        self.execute("delete from Objects where UserId = %s", (uid,))
+
+STORES = {
+    "memory": MemoryStore,
+    "sqlite": SQLiteStore,
+    "postgres": PostgresStore.create,
+}
+
+class TimedStore(object):
+
+    """Wraps a store and adds up, per thread, the time spent in it so that
+    the time a request spent in the database can be reported."""
+
+    def __init__(self, store):
+        self.store = store
+        self.local = threading.local()
+        self.queries = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+        if not callable(method):
+            return method
+        def timed(*args, **kwargs):
+            started = time.time()
+            self.queries += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.local.seconds = getattr(self.local, "seconds", 0.0) + time.time() - started
+        return timed
+
+    def take_seconds(self):
+        seconds = getattr(self.local, "seconds", 0.0)
+        self.local.seconds = 0.0
+        return seconds
+
+def _cache_size(value):
+    # A rough estimate of the memory an entry takes, dominated by payloads
+    if isinstance(value, tuple):
+        value = value[0]
+    if isinstance(value, list):
+        return 128 + sum(_cache_size(o) for o in value)
+    if isinstance(value, dict):
+        return 128 + len(value.get("payload", "")) + 64 * len(value)
+    return 64
+
+def _cache_copy(value):
+    # Callers get their own copies so that nothing they do changes the cache
+    if isinstance(value, tuple):
+        return [dict(o) for o in value[0]], value[1]
+    return dict(value) if value is not None else None
+
+class CachedStore(object):
+
+    """Wraps a store with an LRU cache of info_collections per user and of
+    the reads of HOT_COLLECTIONS. Entries are keyed by (uid,), (uid,
+    collection, query) and (uid, collection, id), hold at most max_bytes
+    together and are dropped by every write to the user or collection."""
+
+    def __init__(self, store, max_bytes=DEFAULT_CACHE_BYTES, max_age=DEFAULT_CACHE_SECONDS,
+                 hot_collections=HOT_COLLECTIONS):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hot_collections = hot_collections
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.keys = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def lookup(self, key, load):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+                return _cache_copy(entry[0])
+            self.misses += 1
+        value = load()
+        size = _cache_size(value)
+        with self.lock:
+            self.remove(key)
+            if size <= self.max_bytes:
+                self.entries[key] = (value, now + self.max_age, size)
+                self.keys.setdefault(key[0], set()).add(key)
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+        return _cache_copy(value)
+
+    def remove(self, key):
+        # Must be called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+            self.keys[key[0]].discard(key)
+            if not self.keys[key[0]]:
+                del self.keys[key[0]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+            self.bytes = 0
+
+    def invalidate(self, uid, collection_name=None):
+        with self.lock:
+            for key in list(self.keys.get(uid, ())):
+                if collection_name is None or len(key) == 1 or key[1] == collection_name:
+                    self.remove(key)
+
+    def info_collections(self, uid):
+        return self.lookup((uid,), lambda: self.store.info_collections(uid))
+
+    def get_object(self, uid, collection_name, object_id):
+        if collection_name not in self.hot_collections:
+            return self.store.get_object(uid, collection_name, object_id)
+        return self.lookup((uid, collection_name, object_id),
+                           lambda: self.store.get_object(uid, collection_name, object_id))
+
+    def get_objects(self, uid, collection_name, newer=None, ids=None, sort=None, limit=None, offset=0, after=None):
+        load = lambda: self.store.get_objects(uid, collection_name, newer=newer, ids=ids, sort=sort, limit=limit,
+                                              offset=offset, after=after)
+        if collection_name not in self.hot_collections:
+            return load()
+        query = (newer, tuple(ids) if ids is not None else None, sort, limit, offset, after)
+        return self.lookup((uid, collection_name, query), load)
+
+    def put_objects(self, uid, collection_name, objects, modified):
+        try:
+            return self.store.put_objects(uid, collection_name, objects, modified)
+        finally:
+            self.invalidate(uid, collection_name)
+
+    def delete_objects(self, uid, collection_name, ids=None):
+        try:
+            return self.store.delete_objects(uid, collection_name, ids)
+        finally:
+            self.invalidate(uid, collection_name)
+
+    def delete_storage(self, uid):
+        try:
+            return self.store.delete_storage(uid)
+        finally:
+            self.invalidate(uid)
+
+# Tokens and assertions
+
+class TokenSigner(object):
+
+    """Makes and checks the Hawk token ids and keys handed out by the token
+    server, and the assertions handed out by the mockmyid mock."""
+
+    def __init__(self, secret):
+        self.secret = _bytes(secret)
+
+    def sign(self, data):
+        return hmac.new(self.secret, _bytes(data), hashlib.sha256).digest()
+
+    def make_token(self, uid, node, duration):
+        payload = _bytes(json.dumps({"uid": uid, "node": node, "expires": time.time() + duration}))
+        token_id = _b64encode(payload + self.sign(payload))
+        return token_id, _b64encode(self.sign("key:" + token_id))
+
+    def parse_token(self, token_id):
+        try:
+            data = _b64decode(token_id)
+        except Exception:
+            raise HTTPError(401, "Invalid token")
+        payload, signature = data[:-32], data[-32:]
+        if not hmac.compare_digest(signature, self.sign(payload)):
+            raise HTTPError(401, "Invalid token")
+        token = json.loads(payload.decode("utf-8"))
+        if token["expires"] < time.time():
+            raise HTTPError(401, "Expired token")
+        return token, _b64encode(self.sign("key:" + token_id))
+
+    def make_assertion(self, email, audience):
+        payload = _b64encode(_bytes(json.dumps({"email": email, "audience": audience})))
+        return payload + "." + _b64encode(self.sign("assertion:" + payload))
+
+    def parse_assertion(self, assertion):
+        try:
+            payload, signature = assertion.split(".")
+            valid = hmac.compare_digest(_bytes(signature), _bytes(_b64encode(self.sign("assertion:" + payload))))
+        except ValueError:
+            valid = False
+        if not valid:
+            raise HTTPError(401, "Invalid assertion")
+        return json.loads(_b64decode(payload).decode("utf-8"))
+
+def hawk_mac(key, method, resource, host, port, attributes):
+    normalized = "hawk.1.header\n%s\n%s\n%s\n%s\n%s\n%s\n%s\n%s\n" % (
+        attributes.get("ts", ""), attributes.get("nonce", ""), method.upper(), resource, host.lower(), port,
+        attributes.get("hash", ""), attributes.get("ext", ""))
+    mac = hmac.new(_bytes(key), _bytes(normalized), hashlib.sha256).digest()
+    return base64.b64encode(mac).decode("ascii")
+
+# The application
+
+class Request(object):
+
+    def __init__(self, method, path, headers, body=b""):
+        self.method = method
+        self.resource = path
+        parts = urlsplit(path)
+        self.path = parts.path
+        self.query = dict(parse_qsl(parts.query))
+        self.headers = headers
+        self.body = body
+
+    def header(self, name, default=None):
+        return self.headers.get(name, default)
+
+class Response(object):
+
+    def __init__(self, status=200, body=None, content_type="application/json", headers=None):
+        self.status = status
+        self.headers = dict(headers or {})
+        if body is None:
+            body = ""
+        if not isinstance(body, (bytes, type(u""))):
+            body = json.dumps(body)
+        self.body = _bytes(body)
+        self.headers["Content-Type"] = content_type
+        # Records sent or received, for the metrics
+        self.records = None
+
+class SyncApp(object):
+
+    """Routes requests to the token server, the mockmyid mock and the
+    storage API. Storage writes are serialized through a lock so that
+    every write gets a unique, increasing timestamp."""
+
+    def __init__(self, store, public_url, secret=DEFAULT_SHARED_SECRET, token_duration=DEFAULT_TOKEN_DURATION,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, nodes=None):
+        self.store = store
+        self.public_url = public_url
+        # The storage nodes users are assigned to, by default just this server
+        self.nodes = nodes
+        self.compress_min_size = compress_min_size
+        self.signer = TokenSigner(secret)
+        self.token_duration = token_duration
+        self.lock = threading.Lock()
+        self.last_modified = 0
+
+    def __call__(self, request):
+        try:
+            request.body = self.decode_body(request)
+            if request.path == "/version":
+                return Response(200, {"version": "0.1"})
+            if request.path == "/assertion":
+                return self.assertion(request)
+            if request.path == "/token/1.0/sync/1.5":
+                return self.token(request)
+            if request.path.startswith("/storage/1.5/"):
+                return self.storage(request)
+            raise HTTPError(404)
+        except HTTPError as e:
+            if e.status == 304:
+                return Response(304, headers=e.headers)
+            return Response(e.status, {"status": e.status, "error": str(e)}, headers=e.headers)
+
+    def decode_body(self, request):
+        encoding = request.header("Content-Encoding", "identity")
+        if encoding == "identity":
+            return request.body
+        if encoding != "gzip":
+            raise HTTPError(415, "Unsupported Content-Encoding")
+        try:
+            inflated = zlib.decompressobj(31).decompress(request.body, MAX_DECODED_BODY_SIZE + 1)
+            if len(inflated) > MAX_DECODED_BODY_SIZE:
+                raise HTTPError(413, "Request body too large")
+            # Once more in one go, which also fails on a truncated body
+            return zlib.decompress(request.body, 31)
+        except zlib.error:
+            raise HTTPError(400, "Invalid gzip request body")
+
+    def encode_body(self, request, response):
+        """The response body as it goes over the wire. Like Compress in
+        compression.go, big enough bodies are gzipped when the client
+        accepts it."""
+        accepted = [e.split(";")[0].strip() for e in request.header("Accept-Encoding", "").split(",")]
+        if self.compress_min_size is None or "Content-Encoding" in response.headers:
+            return response.body
+        response.headers["Vary"] = "Accept-Encoding"
+        if "gzip" not in accepted or len(response.body) < self.compress_min_size:
+            return response.body
+        response.headers["Content-Encoding"] = "gzip"
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(response.body) + compressor.flush()
+
+    def timestamp(self):
+        # Must be called with the lock held
+        self.last_modified = max(_now(), self.last_modified + 10)
+        return self.last_modified
+
+    def assertion(self, request):
+        return Response(200, {"assertion": self.signer.make_assertion(request.query["email"], request.query.get("audience"))})
+
+    def token(self, request):
+        authorization = request.header("Authorization", "")
+        if not authorization.startswith("BrowserID "):
+            raise HTTPError(401, "Missing BrowserID assertion")
+        email = self.signer.parse_assertion(authorization[len("BrowserID "):])["email"]
+        with self.lock:
+            uid = self.store.get_user(email)
+            node = self.user_node(uid, email)
+        token_id, key = self.signer.make_token(uid, node, self.token_duration)
+        return Response(200, {"id": token_id, "key": key, "uid": uid, "api_endpoint": "%s/1.5/%d" % (node, uid),
+                              "duration": self.token_duration})
+
+    def user_node(self, uid, email):
+        # Must be called with the lock held
+        if self.nodes is None:
+            return self.public_url + "/storage"
+        name, migrating = self.store.get_node(uid)
+        if migrating:
+            raise HTTPError(503, "The user is being moved to another node", headers={"Retry-After": "60"})
+        urls = dict((node.name, node.url) for node in self.nodes)
+        if name is None:
+            name = nodes.assign_node(email, self.nodes).name
+            self.store.set_node(uid, name)
+        elif name not in urls:
+            # The user's data is on that node, see nodes.py rename
+            raise HTTPError(503, "The user is on unknown storage node %s" % name)
+        return urls[name]
+
+    def authenticate(self, request, uid):
+        attributes = dict(_HAWK_ATTRIBUTE.findall(request.header("Authorization", "")))
+        if not request.header("Authorization", "").startswith("Hawk ") or "id" not in attributes:
+            raise HTTPError(401, "Missing Hawk authorization")
+        token, key = self.signer.parse_token(attributes["id"])
+        if token["uid"] != uid:
+            raise HTTPError(401, "Token is for another user")
+        if token["node"] != self.public_url + "/storage":
+            raise HTTPError(401, "Token is for another node")
+        host = request.header("Host", "")
+        if ":" in host:
+            host, port = host.rsplit(":", 1)
+        else:
+            port = "443" if self.public_url.startswith("https:") else "80"
+        expected = hawk_mac(key, request.method, request.resource, host, port, attributes)
+        if not hmac.compare_digest(_bytes(expected), _bytes(attributes.get("mac", ""))):
+            raise HTTPError(401, "Invalid Hawk signature")
+        if abs(int(attributes.get("ts", 0)) - time.time()) > MAX_CLOCK_SKEW:
+            raise HTTPError(401, "Hawk timestamp out of range")
+
+    def storage(self, request):
+        parts = request.path[len("/storage/1.5/"):].split("/")
+        try:
+            uid = int(parts[0])
+        except ValueError:
+            raise HTTPError(404)
+        self.authenticate(request, uid)
+        route = parts[1:]
+        if route == ["info", "collections"] and request.method == "GET":
+            return self.info_collections(request, uid)
+        if route == ["info", "collection_counts"] and request.method == "GET":
+            return self.info_collection_counts(request, uid)
+        if route == ["storage"] and request.method == "DELETE":
+            return self.delete_storage(request, uid)
+        if len(route) == 2 and route[0] == "storage":
+            self.check_collection_name(route[1])
+            handler = {"GET": self.get_collection, "POST": self.post_collection,
+                       "DELETE": self.delete_collection}.get(request.method)
+        elif len(route) == 3 and route[0] == "storage":
+            self.check_collection_name(route[1])
+            handler = {"GET": self.get_object, "PUT": self.put_object,
+                       "DELETE": self.delete_object}.get(request.method)
+        else:
+            raise HTTPError(404)
+        if handler is None:
+            raise HTTPError(405)
+        return handler(request, uid, *route[1:])
+
+    def check_collection_name(self, collection_name):
+        if not _COLLECTION_NAME.match(collection_name):
+            raise HTTPError(400, "Invalid collection name")
+
+    def check_preconditions(self, request, modified):
+        # Call with the lock held, so that nothing can be written between
+        # the check and the write it guards
+        since = request.header("X-If-Modified-Since")
+        unmodified = request.header("X-If-Unmodified-Since")
+        if since is not None and unmodified is not None:
+            raise HTTPError(400, "X-If-Modified-Since and X-If-Unmodified-Since are mutually exclusive")
+        try:
+            since = _milliseconds(since) if since is not None else None
+            unmodified = _milliseconds(unmodified) if unmodified is not None else None
+        except ValueError:
+            raise HTTPError(400, "Invalid precondition timestamp")
+        headers = {"X-Last-Modified": "%.2f" % _seconds(modified)}
+        if since is not None and request.method == "GET" and modified <= since:
+            raise HTTPError(304, headers=headers)
+        if unmodified is not None and modified > unmodified:
+            raise HTTPError(412, "Modified since %.2f" % _seconds(unmodified), headers=headers)
+
+    def modified_response(self, modified, body=None):
+        if body is None:
+            body = {"modified": _seconds(modified)}
+        return Response(200, body, headers={"X-Last-Modified": "%.2f" % _seconds(modified)})
+
+    def info_collections(self, request, uid):
+        with self.lock:
+            collections = self.store.info_collections(uid)
+            self.check_preconditions(request, max(collections.values() or [0]))
+        response = Response(200, dict((name, _seconds(modified)) for name, modified in collections.items()))
+        response.headers["X-Last-Modified"] = "%.2f" % _seconds(max(collections.values() or [0]))
+        return response
+
+    def info_collection_counts(self, request, uid):
+        with self.lock:
+            self.check_preconditions(request, max(self.store.info_collections(uid).values() or [0]))
+            counts = self.store.info_collection_counts(uid)
+        return Response(200, counts)
+
+    def get_collection(self, request, uid, collection_name):
+        accepts = request.header("Accepts") or request.header("Accept") or "application/json"
+        if accepts not in ("application/json", "application/newlines", "*/*"):
+            raise HTTPError(406)
+        sort = request.query.get("sort")
+        if sort not in SORT_KEYS:
+            raise HTTPError(400, "Invalid sort")
+        try:
+            newer = _milliseconds(request.query["newer"]) if "newer" in request.query else None
+            limit = int(request.query.get("limit", 0)) or None
+            offset, after = self.parse_offset(request.query.get("offset"), sort)
+        except ValueError:
+            raise HTTPError(400, "Invalid query parameter")
+        ids = request.query["ids"].split(",") if "ids" in request.query else None
+        with self.lock:
+            modified = self.store.info_collections(uid).get(collection_name, 0)
+            self.check_preconditions(request, modified)
+            objects, more = self.store.get_objects(uid, collection_name, newer=newer, ids=ids, sort=sort,
+                                                   limit=limit, offset=offset, after=after)
+        if request.query.get("full"):
+            records = [{"id": o["id"], "modified": _seconds(o["modified"]), "payload": o["payload"],
+                        "sortindex": o["sortindex"], "ttl": o["ttl"]} for o in objects]
+        else:
+            records = [o["id"] for o in objects]
+        headers = {"X-Weave-Records": str(len(records)), "X-Last-Modified": "%.2f" % _seconds(modified)}
+        if more:
+            headers["X-Weave-Next-Offset"] = self.next_offset(objects, sort, offset, after)
+        if accepts == "application/newlines":
+            response = Response(200, "".join(json.dumps(r) + "\n" for r in records), "application/newlines", headers)
+        else:
+            response = Response(200, records, headers=headers)
+        response.records = len(records)
+        return response
+
+    def parse_offset(self, value, sort):
+        # Old clients send integer offsets. Anything else is a cursor from
+        # X-Weave-Next-Offset, the sort key and id of the last record seen.
+        if not value:
+            return 0, None
+        if value.isdigit():
+            return int(value), None
+        try:
+            cursor_sort, sort_value, object_id = json.loads(_b64decode(value).decode("utf-8"))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid offset")
+        if cursor_sort != sort:
+            raise ValueError("Offset is for another sort order")
+        return 0, (sort_value, object_id)
+
+    def next_offset(self, objects, sort, offset, after):
+        # Explicit sort orders page with cursors, so that every page is an
+        # index seek. The default order keeps integer offsets unless the
+        # client already sent a cursor.
+        if sort is None and after is None:
+            return str(offset + len(objects))
+        last = objects[-1]
+        field, descending = SORT_KEYS[sort]
+        return _b64encode(_bytes(json.dumps([sort, last[field] if field else None, last["id"]])))
+
+    def parse_objects(self, request):
+        content_type = request.header("Content-Type", "application/json").split(";")[0].strip()
+        try:
+            if content_type in ("application/json", "text/plain"):
+                objects = json.loads(request.body.decode("utf-8"))
+            elif content_type == "application/newlines":
+                objects = [json.loads(line) for line in request.body.decode("utf-8").split("\n") if line.strip()]
+            else:
+                raise HTTPError(415)
+        except ValueError:
+            raise HTTPError(400, "Invalid JSON")
+        if not isinstance(objects, list):
+            raise HTTPError(400, "Expected a list of objects")
+        return objects
+
+    def validate_object(self, o):
+        if not isinstance(o, dict):
+            return "not an object"
+        if not isinstance(o.get("id"), (str, type(u""))) or not 0 < len(o["id"]) <= MAX_ID:
+            return "invalid id"
+        if "payload" in o and not isinstance(o["payload"], (str, type(u""))):
+            return "invalid payload"
+        for field in ("sortindex", "ttl"):
+            if field in o and o[field] is not None and (not isinstance(o[field], int) or isinstance(o[field], bool)):
+                return "invalid %s" % field
+        return None
+
+    def post_collection(self, request, uid, collection_name):
+        success, failed, valid = [], {}, []
+        objects = self.parse_objects(request)
+        for o in objects:
+            error = self.validate_object(o)
+            if error is not None:
+                failed[o.get("id") if isinstance(o, dict) else None] = [error]
+            else:
+                valid.append(o)
+                success.append(o["id"])
+        with self.lock:
+            self.check_preconditions(request, self.store.info_collections(uid).get(collection_name, 0))
+            modified = self.timestamp()
+            if valid:
+                self.store.put_objects(uid, collection_name, valid, modified)
+        response = self.modified_response(modified, {"modified": _seconds(modified), "success": success, "failed": failed})
+        response.records = len(objects)
+        return response
+
+    def delete_collection(self, request, uid, collection_name):
+        ids = request.query["ids"].split(",") if "ids" in request.query else None
+        with self.lock:
+            collections = self.store.info_collections(uid)
+            if collection_name not in collections:
+                raise HTTPError(404)
+            self.check_preconditions(request, collections[collection_name])
+            modified = self.timestamp()
+            self.store.delete_objects(uid, collection_name, ids)
+        return self.modified_response(modified)
+
+    def get_object(self, request, uid, collection_name, object_id):
+        with self.lock:
+            o = self.store.get_object(uid, collection_name, object_id)
+            if o is None:
+                raise HTTPError(404)
+            self.check_preconditions(request, o["modified"])
+        o["modified"] = _seconds(o["modified"])
+        return Response(200, o, headers={"X-Last-Modified": "%.2f" % o["modified"]})
+
+    def put_object(self, request, uid, collection_name, object_id):
+        try:
+            o = json.loads(request.body.decode("utf-8"))
+        except ValueError:
+            raise HTTPError(400, "Invalid JSON")
+        if not isinstance(o, dict):
+            raise HTTPError(400, "Expected an object")
+        o["id"] = object_id
+        if self.validate_object(o) is not None:
+            raise HTTPError(400, self.validate_object(o))
+        with self.lock:
+            existing = self.store.get_object(uid, collection_name, object_id)
+            self.check_preconditions(request, existing["modified"] if existing is not None else 0)
+            modified = self.timestamp()
+            self.store.put_objects(uid, collection_name, [o], modified)
+        return Response(200, "%.2f" % _seconds(modified), "text/plain", {"X-Last-Modified": "%.2f" % _seconds(modified)})
+
+    def delete_object(self, request, uid, collection_name, object_id):
+        with self.lock:
+            existing = self.store.get_object(uid, collection_name, object_id)
+            if existing is None:
+                raise HTTPError(404)
+            self.check_preconditions(request, existing["modified"])
+            modified = self.timestamp()
+            self.store.delete_objects(uid, collection_name, [object_id])
+        return self.modified_response(modified)
+
+    def delete_storage(self, request, uid):
+        with self.lock:
+            self.check_preconditions(request, max(self.store.info_collections(uid).values() or [0]))
+            modified = self.timestamp()
+            self.store.delete_storage(uid)
+        return self.modified_response(modified)
+
+# HTTP server
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # Buffer the response and send it in one go once it is complete
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle_request(self):
+        started = time.time()
+        self.server.metrics.request_started()
+        self.server.timed_store.take_seconds()
+        request, response = None, None
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = Request(self.command, self.path, self.headers, self.rfile.read(length) if length else b"")
+            if request.path == "/metrics":
+                response = Response(200, self.server.metrics.render(), "text/plain; version=0.0.4")
+            else:
+                response = self.server.app(request)
+            body = self.server.app.encode_body(request, response)
+            self.send_response(response.status)
+            response.headers["Content-Length"] = str(len(body))
+            response.headers["X-Weave-Timestamp"] = "%.2f" % _seconds(_now())
+            for name, value in sorted(response.headers.items()):
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+            self.wfile.flush()
+        finally:
+            # Sizes are of the decoded bodies, as with Compress wrapping
+            # Instrument in main.go
+            self.server.metrics.request_finished(
+                metrics.route_name(urlsplit(self.path).path), self.command, response.status if response else 500,
+                time.time() - started, len(request.body) if request else 0, len(response.body) if response else 0,
+                response.records if response else None, self.server.timed_store.take_seconds())
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class LocalSyncServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, store=None, verbose=False, cache_bytes=DEFAULT_CACHE_BYTES, **kwargs):
+        HTTPServer.__init__(self, (host, port), SyncRequestHandler)
+        self.url = "http://%s:%d" % (host, self.server_port)
+        self.timed_store = TimedStore(store if store is not None else MemoryStore())
+        self.metrics = metrics.Metrics()
+        self.metrics.add("syncserver_db_queries_total", "counter", lambda: self.timed_store.queries)
+        self.cache = None
+        if cache_bytes:
+            self.cache = CachedStore(self.timed_store, cache_bytes)
+            self.metrics.add("syncserver_cache_hits_total", "counter", lambda: self.cache.hits)
+            self.metrics.add("syncserver_cache_misses_total", "counter", lambda: self.cache.misses)
+            self.metrics.add("syncserver_cache_evictions_total", "counter", lambda: self.cache.evictions)
+            self.metrics.add("syncserver_cache_bytes", "gauge", lambda: self.cache.bytes)
+        self.app = SyncApp(self.cache or self.timed_store, self.url, **kwargs)
+        self.verbose = verbose
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections are not worth a traceback
+        if self.verbose:
+            HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _LockedDirectory(object):
+
+    # The user to node assignments of a running token server, for drain
+    def __init__(self, app):
+        self.app = app
+
+    def node_users(self, node):
+        with self.app.lock:
+            return self.app.store.node_users(node)
+
+    def set_node(self, uid, node, migrating=False):
+        with self.app.lock:
+            self.app.store.set_node(uid, node, migrating)
+
+class LocalCluster(object):
+
+    """A token server and a storage node per weight, each its own
+    LocalSyncServer with a SQLite store. It stands in for a deployment
+    with StorageNode sections in syncserver.ini."""
+
+    def __init__(self, weights=(100, 100, 100), host="127.0.0.1", port=0, **kwargs):
+        self.servers = collections.OrderedDict()
+        node_list = []
+        for i, weight in enumerate(weights):
+            name = "node%d" % (i + 1)
+            server = LocalSyncServer(host, port + i + 1 if port else 0, SQLiteStore(), **kwargs)
+            self.servers[name] = server
+            node_list.append(nodes.Node(name, server.url + "/storage", None, weight))
+        self.token_server = LocalSyncServer(host, port, SQLiteStore(), nodes=node_list, **kwargs)
+        self.url = self.token_server.url
+
+    @property
+    def nodes(self):
+        return self.token_server.app.nodes
+
+    def set_weight(self, name, weight):
+        with self.token_server.app.lock:
+            self.token_server.app.nodes = [node._replace(weight=weight) if node.name == name else node
+                                           for node in self.nodes]
+
+    def databases(self):
+        return dict((name, dump.SQLiteDatabase(server.timed_store.store.db)) for name, server in self.servers.items())
+
+    def drain(self, name, grace=0):
+        """Stop assigning users to a node and move its users to the others."""
+        self.set_weight(name, 0)
+        report = nodes.drain(_LockedDirectory(self.token_server.app), self.databases(), name, self.nodes, grace)
+        # The moves bypassed the nodes' caches
+        for server in self.servers.values():
+            if server.cache is not None:
+                server.cache.clear()
+        return report
+
+    def start(self):
+        for server in list(self.servers.values()) + [self.token_server]:
+            server.start()
+        return self
+
+    def stop(self):
+        for server in list(self.servers.values()) + [self.token_server]:
+            server.stop()
+
+_local_server = None
+
+def local_server():
+    """Start, once per process, a server in a background thread and point
+    the syncclient mockmyid endpoint at it. LOCAL_STORE picks the store."""
+    global _local_server
+    if _local_server is None:
+        import syncclient
+        _local_server = LocalSyncServer(store=STORES[os.environ.get("LOCAL_STORE", "memory")]()).start()
+        syncclient.MOCKMYID_SERVER = _local_server.url
+        atexit.register(_local_server.stop)
+    return _local_server
+
+def resolve_server(server):
+    # "local" stands for an in-process server
+    if server == "local":
+        return local_server().url
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in sync server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--store", choices=sorted(STORES.keys()), default="memory")
+    parser.add_argument("--database", default=":memory:", help="SQLite database path")
+    parser.add_argument("--dsn", default=dump.DEFAULT_DSN, help="PostgreSQL database, set up in a scratch schema")
+    parser.add_argument("--secret", default=DEFAULT_SHARED_SECRET)
+    parser.add_argument("--token-duration", type=int, default=DEFAULT_TOKEN_DURATION)
+    parser.add_argument("--compress-min-size", type=int, default=DEFAULT_COMPRESS_MIN_SIZE,
+                        help="Smallest response to gzip, 0 for all and -1 for none")
+    parser.add_argument("--cache-bytes", type=int, default=DEFAULT_CACHE_BYTES,
+                        help="memory for the info and hot collection cache, 0 to turn it off")
+    parser.add_argument("--nodes", type=int, default=0,
+                        help="run a token server on --port and this many storage nodes with SQLite stores after it")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    options = dict(verbose=args.verbose, cache_bytes=args.cache_bytes, secret=args.secret,
+                   token_duration=args.token_duration,
+                   compress_min_size=args.compress_min_size if args.compress_min_size >= 0 else None)
+    if args.nodes:
+        cluster = LocalCluster([nodes.DEFAULT_WEIGHT] * args.nodes, args.host, args.port, **options)
+        for node in cluster.nodes:
+            cluster.servers[node.name].start()
+            print("Storage node %s on %s" % (node.name, node.url))
+        server = cluster.token_server
+    else:
+        if args.store == "postgres":
+            store = PostgresStore.create(args.dsn)
+        else:
+            store = SQLiteStore(args.database) if args.store == "sqlite" else MemoryStore()
+        server = LocalSyncServer(args.host, args.port, store, **options)
+    print("Starting local sync server on %s" % server.url)
+    print("export SYNC_SERVER=%s MOCKMYID_SERVER=%s" % (server.url, server.url))
+    server.serve_forever()
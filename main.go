@@ -6,9 +6,11 @@ package main
 
 import (
 	"code.google.com/p/gcfg"
+	"database/sql"
 	"flag"
 	"fmt"
 	"github.com/gorilla/mux"
+	_ "github.com/lib/pq"
 	"github.com/st3fan/moz-storageserver/storageserver"
 	"github.com/st3fan/moz-tokenserver/tokenserver"
 	"log"
@@ -32,7 +34,14 @@ type Config struct {
 		PublicHostname string
 		SharedSecret   string
 		DataSource     string
+
+		// Smallest response body to gzip. 0 picks the default and a
+		// negative value turns response compression off.
+		CompressionMinSize int
 	}
+
+	// Optional, see nodes.go
+	StorageNode map[string]*StorageNodeConfig
 }
 
 func main() {
@@ -52,39 +61,75 @@ func main() {
 
 	// Setup the http mux and mount the token server and storage server on it
 
+	metrics := NewMetrics()
+
 	router := mux.NewRouter()
 	router.HandleFunc("/version", VersionHandler)
+	router.Handle("/metrics", metrics)
 
-	tokenServerConfig := tokenserver.Config{
-		PersonaVerifier:   "https://verifier.accounts.firefox.com/v2",
-		PersonaAudience:   config.SyncServer.PublicHostname,
-		AllowNewUsers:     true,
-		TokenDuration:     300,
-		SharedSecret:      config.SyncServer.SharedSecret,
-		StorageServerNode: config.SyncServer.PublicHostname + "/storage",
-		DatabaseUrl:       config.SyncServer.DataSource,
-	}
+	// One token server per storage node, NodeDispatcher picks the user's.
+	// All of them share the Users table in DataSource.
+
+	nodes := readNodes(config)
 
-	_, err := tokenserver.SetupRouter(router.PathPrefix("/token").Subrouter(), tokenServerConfig)
+	db, err := sql.Open("postgres", config.SyncServer.DataSource)
 	if err != nil {
 		log.Fatal(err)
 	}
-
-	storageServerConfig := storageserver.Config{
-		DatabaseUrl:  config.SyncServer.DataSource,
-		SharedSecret: config.SyncServer.SharedSecret,
+	unknown, err := unknownNodes(db, nodes)
+	if err != nil {
+		log.Print("Could not check the nodes of the users: ", err)
+	}
+	for name, count := range unknown {
+		log.Printf("%d users are on storage node %q, which is not configured. They get a 503 until "+
+			"./nodes.py rename %s <node> assigns them to a node that has their data.", count, name, name)
 	}
 
-	_, err = storageserver.SetupRouter(router.PathPrefix("/storage").Subrouter(), storageServerConfig)
-	if err != nil {
-		log.Fatal(err)
+	tokenServers := make(map[string]http.Handler)
+	for _, node := range nodes {
+		tokenServerConfig := tokenserver.Config{
+			PersonaVerifier:   "https://verifier.accounts.firefox.com/v2",
+			PersonaAudience:   config.SyncServer.PublicHostname,
+			AllowNewUsers:     true,
+			TokenDuration:     300,
+			SharedSecret:      config.SyncServer.SharedSecret,
+			StorageServerNode: node.Url,
+			DatabaseUrl:       config.SyncServer.DataSource,
+		}
+		tokenRouter := mux.NewRouter()
+		if _, err := tokenserver.SetupRouter(tokenRouter.PathPrefix("/token").Subrouter(), tokenServerConfig); err != nil {
+			log.Fatal(err)
+		}
+		tokenServers[node.Name] = tokenRouter
+	}
+	router.PathPrefix("/token").Handler(NewNodeDispatcher(db, nodes, tokenServers))
+
+	// Mount the storage server of every node that this server hosts, the
+	// others run their own syncserver
+
+	for _, node := range nodes {
+		path := mountPath(node, config.SyncServer.PublicHostname)
+		if path == "" {
+			continue
+		}
+		storageServerConfig := storageserver.Config{
+			DatabaseUrl:  node.DataSource,
+			SharedSecret: config.SyncServer.SharedSecret,
+		}
+		if _, err := storageserver.SetupRouter(router.PathPrefix(path).Subrouter(), storageServerConfig); err != nil {
+			log.Fatal(err)
+		}
 	}
 
 	// Start listening to http requests
 
 	addr := fmt.Sprintf("%s:%d", config.SyncServer.ListenAddress, config.SyncServer.ListenPort)
 	log.Printf("Starting sync server on http://%s", addr)
-	http.Handle("/", router)
+	compressionMinSize := config.SyncServer.CompressionMinSize
+	if compressionMinSize == 0 {
+		compressionMinSize = DEFAULT_COMPRESSION_MIN_SIZE
+	}
+	http.Handle("/", Compress(metrics.Instrument(router), compressionMinSize))
 	err = http.ListenAndServe(addr, nil)
 	if err != nil {
 		log.Fatal(err)
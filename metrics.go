@@ -0,0 +1,334 @@
+// This Source Code Form is subject to the terms of the Mozilla Public
+// License, v. 2.0. If a copy of the MPL was not distributed with this
+// file, You can obtain one at http://mozilla.org/MPL/2.0/
+
+package main
+
+// Request instrumentation. Every request is timed and measured per route
+// and method, and the results are served in the Prometheus text format
+// on /metrics. metrics.py scrapes and analyzes them.
+
+import (
+	"fmt"
+	"io"
+	"net/http"
+	"sort"
+	"strings"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+var (
+	LATENCY_BUCKETS = []float64{0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10}
+	SIZE_BUCKETS    = []float64{64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304}
+	RECORD_BUCKETS  = []float64{0, 1, 10, 100, 1000, 10000}
+)
+
+type histogram struct {
+	buckets []float64
+	counts  []uint64
+	sum     float64
+	count   uint64
+}
+
+func newHistogram(buckets []float64) *histogram {
+	return &histogram{buckets: buckets, counts: make([]uint64, len(buckets))}
+}
+
+func (h *histogram) observe(value float64) {
+	for i, bound := range h.buckets {
+		if value <= bound {
+			h.counts[i]++
+		}
+	}
+	h.sum += value
+	h.count++
+}
+
+func (h *histogram) write(w io.Writer, name string, labels string) {
+	for i, bound := range h.buckets {
+		fmt.Fprintf(w, "%s_bucket{%s,le=\"%g\"} %d\n", name, labels, bound, h.counts[i])
+	}
+	fmt.Fprintf(w, "%s_bucket{%s,le=\"+Inf\"} %d\n", name, labels, h.count)
+	fmt.Fprintf(w, "%s_sum{%s} %g\n", name, labels, h.sum)
+	fmt.Fprintf(w, "%s_count{%s} %d\n", name, labels, h.count)
+}
+
+type routeKey struct {
+	route  string
+	method string
+}
+
+type byRoute []routeKey
+
+func (k byRoute) Len() int      { return len(k) }
+func (k byRoute) Swap(i, j int) { k[i], k[j] = k[j], k[i] }
+func (k byRoute) Less(i, j int) bool {
+	if k[i].route != k[j].route {
+		return k[i].route < k[j].route
+	}
+	return k[i].method < k[j].method
+}
+
+type routeMetrics struct {
+	latency      *histogram
+	requestSize  *histogram
+	responseSize *histogram
+	records      *histogram
+	statuses     map[int]uint64
+}
+
+type Metrics struct {
+	sync.Mutex
+	inFlight int64
+	routes   map[routeKey]*routeMetrics
+}
+
+func NewMetrics() *Metrics {
+	return &Metrics{routes: make(map[routeKey]*routeMetrics)}
+}
+
+// RouteName maps a request path to its route, with the user id, collection
+// and object id replaced by placeholders so that the number of label values
+// stays bounded.
+func RouteName(path string) string {
+	if path == "/version" || path == "/metrics" || path == "/token/1.0/sync/1.5" {
+		return path
+	}
+	// Storage nodes are mounted on their own path, like /storage/node1,
+	// which is left out of the route
+	parts := strings.Split(strings.Trim(path, "/"), "/")
+	version := -1
+	for i, part := range parts {
+		if part == "1.5" {
+			version = i
+			break
+		}
+	}
+	if version < 0 || len(parts) < version+2 {
+		return "other"
+	}
+	route := "/storage/1.5/{uid}"
+	switch rest := parts[version+2:]; {
+	case len(rest) == 2 && rest[0] == "info":
+		return route + "/info/" + rest[1]
+	case len(rest) == 1 && rest[0] == "storage":
+		return route + "/storage"
+	case len(rest) == 2 && rest[0] == "storage":
+		return route + "/storage/{collection}"
+	case len(rest) == 3 && rest[0] == "storage":
+		return route + "/storage/{collection}/{id}"
+	}
+	return "other"
+}
+
+// recordCounter counts the top level elements of a JSON array, or the
+// lines of an application/newlines body, as the bytes stream through.
+type recordCounter struct {
+	newlines bool
+	depth    int
+	inString bool
+	escaped  bool
+	empty    bool
+	records  int
+}
+
+func (c *recordCounter) Write(p []byte) (int, error) {
+	for _, b := range p {
+		if c.newlines {
+			if b == '\n' {
+				c.records++
+			}
+			continue
+		}
+		if c.inString {
+			switch {
+			case c.escaped:
+				c.escaped = false
+			case b == '\\':
+				c.escaped = true
+			case b == '"':
+				c.inString = false
+			}
+			continue
+		}
+		switch b {
+		case '"':
+			c.inString = true
+		case '[', '{':
+			c.depth++
+			if c.depth == 1 {
+				c.empty = true
+			} else if c.depth == 2 {
+				c.empty = false
+			}
+			continue
+		case ']', '}':
+			c.depth--
+			if c.depth == 0 && !c.empty {
+				c.records++
+			}
+			continue
+		case ',':
+			if c.depth == 1 {
+				c.records++
+			}
+			continue
+		case ' ', '\t', '\r', '\n':
+			continue
+		}
+		if c.depth == 1 {
+			c.empty = false
+		}
+	}
+	return len(p), nil
+}
+
+type countingReader struct {
+	io.ReadCloser
+	bytes   int
+	counter *recordCounter
+}
+
+func (r *countingReader) Read(p []byte) (int, error) {
+	n, err := r.ReadCloser.Read(p)
+	r.bytes += n
+	if r.counter != nil {
+		r.counter.Write(p[:n])
+	}
+	return n, err
+}
+
+type instrumentedResponseWriter struct {
+	http.ResponseWriter
+	status  int
+	bytes   int
+	counter *recordCounter
+}
+
+func (w *instrumentedResponseWriter) WriteHeader(status int) {
+	w.status = status
+	if w.counter != nil {
+		w.counter.newlines = strings.HasPrefix(w.Header().Get("Content-Type"), "application/newlines")
+	}
+	w.ResponseWriter.WriteHeader(status)
+}
+
+func (w *instrumentedResponseWriter) Write(p []byte) (int, error) {
+	if w.status == 0 {
+		w.WriteHeader(http.StatusOK)
+	}
+	n, err := w.ResponseWriter.Write(p)
+	w.bytes += n
+	if w.counter != nil {
+		w.counter.Write(p[:n])
+	}
+	return n, err
+}
+
+// Instrument wraps a handler. Records are counted in the request body of
+// collection POSTs and in the response body of collection GETs.
+func (m *Metrics) Instrument(next http.Handler) http.Handler {
+	return http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		started := time.Now()
+		atomic.AddInt64(&m.inFlight, 1)
+		defer atomic.AddInt64(&m.inFlight, -1)
+
+		route := RouteName(r.URL.Path)
+		collection := route == "/storage/1.5/{uid}/storage/{collection}"
+		body := &countingReader{ReadCloser: r.Body}
+		if collection && r.Method == "POST" {
+			body.counter = &recordCounter{newlines: strings.HasPrefix(r.Header.Get("Content-Type"), "application/newlines")}
+		}
+		r.Body = body
+		iw := &instrumentedResponseWriter{ResponseWriter: w}
+		if collection && r.Method == "GET" {
+			iw.counter = &recordCounter{}
+		}
+
+		next.ServeHTTP(iw, r)
+
+		if iw.status == 0 {
+			iw.status = http.StatusOK
+		}
+		records := -1
+		if body.counter != nil {
+			records = body.counter.records
+		} else if iw.counter != nil && iw.status == http.StatusOK {
+			records = iw.counter.records
+		}
+		m.observe(routeKey{route, r.Method}, iw.status, time.Since(started), body.bytes, iw.bytes, records)
+	})
+}
+
+func (m *Metrics) observe(key routeKey, status int, elapsed time.Duration, requestSize, responseSize, records int) {
+	m.Lock()
+	defer m.Unlock()
+	rm, ok := m.routes[key]
+	if !ok {
+		rm = &routeMetrics{
+			latency:      newHistogram(LATENCY_BUCKETS),
+			requestSize:  newHistogram(SIZE_BUCKETS),
+			responseSize: newHistogram(SIZE_BUCKETS),
+			records:      newHistogram(RECORD_BUCKETS),
+			statuses:     make(map[int]uint64),
+		}
+		m.routes[key] = rm
+	}
+	rm.latency.observe(elapsed.Seconds())
+	rm.requestSize.observe(float64(requestSize))
+	rm.responseSize.observe(float64(responseSize))
+	if records >= 0 {
+		rm.records.observe(float64(records))
+	}
+	rm.statuses[status]++
+}
+
+// ServeHTTP writes all metrics in the Prometheus text format
+func (m *Metrics) ServeHTTP(w http.ResponseWriter, r *http.Request) {
+	w.Header().Set("Content-Type", "text/plain; version=0.0.4")
+
+	fmt.Fprintf(w, "# TYPE syncserver_requests_in_flight gauge\n")
+	fmt.Fprintf(w, "syncserver_requests_in_flight %d\n", atomic.LoadInt64(&m.inFlight))
+
+	m.Lock()
+	defer m.Unlock()
+
+	keys := make([]routeKey, 0, len(m.routes))
+	for key := range m.routes {
+		keys = append(keys, key)
+	}
+	sort.Sort(byRoute(keys))
+
+	histograms := []struct {
+		name string
+		get  func(*routeMetrics) *histogram
+	}{
+		{"syncserver_request_duration_seconds", func(rm *routeMetrics) *histogram { return rm.latency }},
+		{"syncserver_request_size_bytes", func(rm *routeMetrics) *histogram { return rm.requestSize }},
+		{"syncserver_response_size_bytes", func(rm *routeMetrics) *histogram { return rm.responseSize }},
+		{"syncserver_records", func(rm *routeMetrics) *histogram { return rm.records }},
+	}
+	for _, h := range histograms {
+		fmt.Fprintf(w, "# TYPE %s histogram\n", h.name)
+		for _, key := range keys {
+			if hist := h.get(m.routes[key]); hist.count != 0 {
+				hist.write(w, h.name, fmt.Sprintf("route=%q,method=%q", key.route, key.method))
+			}
+		}
+	}
+
+	fmt.Fprintf(w, "# TYPE syncserver_responses_total counter\n")
+	for _, key := range keys {
+		statuses := make([]int, 0)
+		for status := range m.routes[key].statuses {
+			statuses = append(statuses, status)
+		}
+		sort.Ints(statuses)
+		for _, status := range statuses {
+			fmt.Fprintf(w, "syncserver_responses_total{route=%q,method=%q,status=\"%d\"} %d\n",
+				key.route, key.method, status, m.routes[key].statuses[status])
+		}
+	}
+}
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Request metrics in the Prometheus text format. Metrics collects them for
+# localserver.py the same way metrics.go does for the Go server, and the
+# rest scrapes /metrics before and after a load test to attribute server
+# time to endpoints:
+#
+#   ./metrics.py --server http://127.0.0.1:5000
+#   ./loadtest.py --server local --metrics
+
+from __future__ import print_function
+
+import argparse
+import re
+import threading
+
+import requests
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+RECORD_BUCKETS = [0, 1, 10, 100, 1000, 10000]
+
+# (metric name, field of the observation, buckets)
+HISTOGRAMS = [
+    ("syncserver_request_duration_seconds", "seconds", LATENCY_BUCKETS),
+    ("syncserver_db_duration_seconds", "db_seconds", LATENCY_BUCKETS),
+    ("syncserver_request_size_bytes", "request_size", SIZE_BUCKETS),
+    ("syncserver_response_size_bytes", "response_size", SIZE_BUCKETS),
+    ("syncserver_records", "records", RECORD_BUCKETS),
+]
+
+GAUGES = ("syncserver_requests_in_flight", "syncserver_cache_bytes")
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def route_name(path):
+    """Map a request path to its route, like RouteName in metrics.go."""
+    if path in ("/version", "/metrics", "/token/1.0/sync/1.5"):
+        return path
+    parts = path.strip("/").split("/")
+    # Storage nodes are mounted on their own path, like /storage/node1,
+    # which is left out of the route
+    if "1.5" not in parts or len(parts) < parts.index("1.5") + 2:
+        return "other"
+    route, rest = "/storage/1.5/{uid}", parts[parts.index("1.5") + 2:]
+    if len(rest) == 2 and rest[0] == "info":
+        return route + "/info/" + rest[1]
+    if rest == ["storage"]:
+        return route + "/storage"
+    if len(rest) == 2 and rest[0] == "storage":
+        return route + "/storage/{collection}"
+    if len(rest) == 3 and rest[0] == "storage":
+        return route + "/storage/{collection}/{id}"
+    return "other"
+
+def _format(value):
+    return "%d" % value if value == int(value) else "%r" % value
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = ['%s_bucket{%s,le="%s"} %d' % (name, labels, _format(bound), n)
+                 for bound, n in zip(self.buckets, self.counts)]
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        lines.append("%s_sum{%s} %r" % (name, labels, self.sum))
+        lines.append("%s_count{%s} %d" % (name, labels, self.count))
+        return lines
+
+class Metrics(object):
+
+    """Per route and method request metrics, rendered in the same format
+    as metrics.go. localserver.py also knows how long a request spent in
+    its store and adds syncserver_db_duration_seconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.routes = {}
+        self.statuses = {}
+        self.values = []
+
+    def add(self, name, kind, read):
+        """Also render the value of read(), a counter or gauge that is
+        kept elsewhere, like the store's query and cache counts."""
+        self.values.append((name, kind, read))
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self, route, method, status, seconds, request_size, response_size,
+                         records=None, db_seconds=None):
+        observation = {"seconds": seconds, "db_seconds": db_seconds, "request_size": request_size,
+                       "response_size": response_size, "records": records}
+        with self.lock:
+            self.in_flight -= 1
+            key = (route, method)
+            if key not in self.routes:
+                self.routes[key] = dict((field, Histogram(buckets)) for name, field, buckets in HISTOGRAMS)
+            for field, histogram in self.routes[key].items():
+                if observation[field] is not None:
+                    histogram.observe(observation[field])
+            self.statuses[key + (status,)] = self.statuses.get(key + (status,), 0) + 1
+
+    def render(self):
+        with self.lock:
+            lines = ["# TYPE syncserver_requests_in_flight gauge", "syncserver_requests_in_flight %d" % self.in_flight]
+            for name, field, buckets in HISTOGRAMS:
+                lines.append("# TYPE %s histogram" % name)
+                for (route, method), histograms in sorted(self.routes.items()):
+                    if histograms[field].count:
+                        lines.extend(histograms[field].render(name, 'route="%s",method="%s"' % (route, method)))
+            lines.append("# TYPE syncserver_responses_total counter")
+            for (route, method, status), n in sorted(self.statuses.items()):
+                lines.append('syncserver_responses_total{route="%s",method="%s",status="%d"} %d' % (route, method, status, n))
+            for name, kind, read in self.values:
+                lines.extend(["# TYPE %s %s" % (name, kind), "%s %d" % (name, read())])
+        return "\n".join(lines) + "\n"
+
+# Scraping and analysis
+
+def parse(text):
+    """Parse the text format into {(name, ((label, value), ...)): value}."""
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line.strip())
+        if match is None or line.startswith("#"):
+            continue
+        name, labels, value = match.groups()
+        samples[(name, tuple(sorted(_LABEL.findall(labels or ""))))] = float(value)
+    return samples
+
+def scrape(server, session=requests):
+    r = session.get(server.rstrip("/") + "/metrics")
+    r.raise_for_status()
+    return parse(r.text)
+
+def delta(before, after):
+    """What happened between two scrapes. Gauges keep their last value."""
+    return dict((key, value if key[0] in GAUGES else value - before.get(key, 0.0)) for key, value in after.items())
+
+def histogram_quantile(buckets, q):
+    # Linear interpolation within the bucket, as Prometheus does
+    buckets = sorted(buckets)
+    if not buckets or buckets[-1][1] == 0:
+        return 0.0
+    rank = q * buckets[-1][1]
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1e-9)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+def attribute(samples):
+    """Summarize samples, usually a delta, per route and method. Rows are
+    sorted by the server time they account for."""
+    rows = {}
+    def row(labels):
+        key = (labels["route"], labels["method"])
+        if key not in rows:
+            rows[key] = {"route": key[0], "method": key[1], "count": 0, "seconds": 0.0, "db_seconds": None,
+                         "request_bytes": 0.0, "response_bytes": 0.0, "records": None, "errors": 0, "buckets": []}
+        return rows[key]
+    for (name, labels), value in samples.items():
+        labels = dict(labels)
+        if "route" not in labels:
+            continue
+        r = row(labels)
+        if name == "syncserver_request_duration_seconds_count":
+            r["count"] = value
+        elif name == "syncserver_request_duration_seconds_sum":
+            r["seconds"] = value
+        elif name == "syncserver_request_duration_seconds_bucket":
+            r["buckets"].append((float(labels["le"]), value))
+        elif name == "syncserver_db_duration_seconds_sum":
+            r["db_seconds"] = value
+        elif name == "syncserver_request_size_bytes_sum":
+            r["request_bytes"] = value
+        elif name == "syncserver_response_size_bytes_sum":
+            r["response_bytes"] = value
+        elif name == "syncserver_records_sum":
+            r["records"] = value
+        elif name == "syncserver_responses_total" and int(labels["status"]) >= 400:
+            r["errors"] += value
+    total = sum(r["seconds"] for r in rows.values()) or 1.0
+    results = []
+    for r in rows.values():
+        if not r["count"]:
+            continue
+        r["share"] = r["seconds"] / total
+        r["mean"] = r["seconds"] / r["count"]
+        r["p50"] = histogram_quantile(r["buckets"], 0.50)
+        r["p95"] = histogram_quantile(r["buckets"], 0.95)
+        del r["buckets"]
+        results.append(r)
+    return sorted(results, key=lambda r: -r["seconds"])
+
+def print_attribution(rows):
+    print("%-44s %6s %8s %7s %8s %8s %8s %7s %10s %10s %8s %6s" % ("route", "method", "count", "share", "mean ms",
+          "p50 ms", "p95 ms", "db %", "req bytes", "resp bytes", "records", "errors"))
+    for r in rows:
+        db = "%6.1f%%" % (r["db_seconds"] / r["seconds"] * 100) if r["db_seconds"] is not None and r["seconds"] else "      -"
+        records = "%8.1f" % (r["records"] / r["count"]) if r["records"] is not None else "       -"
+        print("%-44s %6s %8d %6.1f%% %8.2f %8.2f %8.2f %s %10.0f %10.0f %s %6d" % (r["route"], r["method"], r["count"],
+              r["share"] * 100, r["mean"] * 1000, r["p50"] * 1000, r["p95"] * 1000, db, r["request_bytes"] / r["count"],
+              r["response_bytes"] / r["count"], records, r["errors"]))
+
+def print_store(samples):
+    """Print the store's query count and, when the server has a cache, its
+    hit ratio. Servers that do not export them print nothing."""
+    value = lambda name: samples.get((name, ()))
+    queries, hits, misses = (value("syncserver_db_queries_total"), value("syncserver_cache_hits_total"),
+                             value("syncserver_cache_misses_total"))
+    if queries is not None:
+        print("db queries: %d" % queries)
+    if hits is not None:
+        print("cache: %d hits, %d misses (%.1f%% hit ratio), %d evictions, %d bytes" % (hits, misses,
+              hits * 100.0 / max(hits + misses, 1), value("syncserver_cache_evictions_total"),
+              value("syncserver_cache_bytes")))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show where a sync server spends its time")
+    parser.add_argument("--server", default="http://127.0.0.1:5000")
+    args = parser.parse_args()
+    samples = scrape(args.server)
+    print_attribution(attribute(samples))
+    print_store(samples)
@@ -0,0 +1,13 @@
+-- This Source Code Form is subject to the terms of the Mozilla Public
+-- License, v. 2.0. If a copy of the MPL was not distributed with this
+-- file, You can obtain one at http://mozilla.org/MPL/2.0/
+
+-- Adds the Objects indexes from setup.sql to an existing database. The
+-- indexes are built concurrently so the server can keep running; this
+-- means the file cannot be run inside a transaction.
+
+create index concurrently ObjectsModifiedIndex on Objects (UserId, CollectionName, Modified);
+create index concurrently ObjectsSortIndexIndex on Objects (UserId, CollectionName, SortIndex);
+create index concurrently ObjectsExpiryIndex on Objects ((Modified + TTL::bigint * 1000)) where TTL <> 2100000000;
+
+analyze Objects;
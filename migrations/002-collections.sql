@@ -0,0 +1,83 @@
+-- This Source Code Form is subject to the terms of the Mozilla Public
+-- License, v. 2.0. If a copy of the MPL was not distributed with this
+-- file, You can obtain one at http://mozilla.org/MPL/2.0/
+
+-- Adds the Collections table from setup.sql to an existing database and
+-- fills it from Objects. Writes to Objects are blocked while the table is
+-- filled so that no change slips in between the copy and the trigger.
+
+begin;
+
+lock table Objects in share row exclusive mode;
+
+create table Collections (
+  UserId             integer not null,
+  CollectionName     varchar(32) not null,
+  primary key (UserId, CollectionName),
+  Modified           bigint not null,
+  Count              integer not null default 0,
+  TotalPayloadSize   bigint not null default 0
+);
+
+create function CollectionsAddObject(uid integer, collection varchar, objectModified bigint, objectSize integer) returns void as $$
+begin
+  loop
+    update Collections set Modified = greatest(Modified, objectModified), Count = Count + 1,
+      TotalPayloadSize = TotalPayloadSize + objectSize
+      where UserId = uid and CollectionName = collection;
+    if found then
+      return;
+    end if;
+    begin
+      insert into Collections (UserId, CollectionName, Modified, Count, TotalPayloadSize)
+        values (uid, collection, objectModified, 1, objectSize);
+      return;
+    exception when unique_violation then
+      -- Another transaction created the row first, update it instead
+    end;
+  end loop;
+end;
+$$ language plpgsql;
+
+create function CollectionsRemoveObject(uid integer, collection varchar, objectModified bigint, objectSize integer) returns void as $$
+declare
+  c Collections%rowtype;
+begin
+  update Collections set Count = Count - 1, TotalPayloadSize = TotalPayloadSize - objectSize
+    where UserId = uid and CollectionName = collection returning * into c;
+  if c.Count <= 0 then
+    delete from Collections where UserId = uid and CollectionName = collection;
+  elsif objectModified >= c.Modified then
+    update Collections set Modified = coalesce((select max(o.Modified) from Objects o
+      where o.UserId = uid and o.CollectionName = collection), c.Modified)
+      where UserId = uid and CollectionName = collection;
+  end if;
+end;
+$$ language plpgsql;
+
+create function ObjectsUpdateCollections() returns trigger as $$
+begin
+  if tg_op = 'UPDATE' and NEW.UserId = OLD.UserId and NEW.CollectionName = OLD.CollectionName then
+    update Collections set Modified = greatest(Modified, NEW.Modified),
+      TotalPayloadSize = TotalPayloadSize + NEW.PayloadSize - OLD.PayloadSize
+      where UserId = NEW.UserId and CollectionName = NEW.CollectionName;
+    return null;
+  end if;
+  if tg_op = 'DELETE' or tg_op = 'UPDATE' then
+    perform CollectionsRemoveObject(OLD.UserId, OLD.CollectionName, OLD.Modified, OLD.PayloadSize);
+  end if;
+  if tg_op = 'INSERT' or tg_op = 'UPDATE' then
+    perform CollectionsAddObject(NEW.UserId, NEW.CollectionName, NEW.Modified, NEW.PayloadSize);
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger ObjectsUpdateCollectionsTrigger after insert or update or delete on Objects
+  for each row execute procedure ObjectsUpdateCollections();
+
+insert into Collections (UserId, CollectionName, Modified, Count, TotalPayloadSize)
+  select UserId, CollectionName, max(Modified), count(*), sum(PayloadSize) from Objects
+  group by UserId, CollectionName;
+
+commit;
@@ -0,0 +1,20 @@
+-- This Source Code Form is subject to the terms of the Mozilla Public
+-- License, v. 2.0. If a copy of the MPL was not distributed with this
+-- file, You can obtain one at http://mozilla.org/MPL/2.0/
+
+-- Adds the storage node assignment from setup.sql to Users. Existing users
+-- stay on the server they are on, the "default" node of a configuration
+-- without StorageNode sections. When StorageNode sections are added, move
+-- them to the section of this server with ./nodes.py rename default <node>;
+-- until then the token server answers 503 for them.
+
+begin;
+
+alter table Users add column Node varchar(64);
+alter table Users add column Migrating boolean not null default false;
+
+update Users set Node = 'default';
+
+create index UsersNodeIndex on Users (Node);
+
+commit;
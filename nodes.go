@@ -0,0 +1,248 @@
+// This Source Code Form is subject to the terms of the Mozilla Public
+// License, v. 2.0. If a copy of the MPL was not distributed with this
+// file, You can obtain one at http://mozilla.org/MPL/2.0/
+
+package main
+
+// Storage nodes. With [StorageNode "name"] sections in the config the token
+// server assigns every user to one of them with weighted rendezvous hashing
+// of the email address and remembers the assignment in Users.Node, so that
+// adding a node only moves the users it wins. The token server itself knows
+// about a single node, so there is one per node and NodeDispatcher picks the
+// one to forward each token request to. nodes.py does the same assignment
+// and drains nodes.
+
+import (
+	"crypto/sha256"
+	"database/sql"
+	"encoding/base64"
+	"encoding/binary"
+	"encoding/json"
+	"log"
+	"math"
+	"net/http"
+	"net/url"
+	"sort"
+	"strings"
+)
+
+const (
+	DEFAULT_NODE        = "default"
+	DEFAULT_NODE_WEIGHT = 100
+
+	// Seconds a migrating user is asked to wait before asking again
+	MIGRATING_RETRY_AFTER = "300"
+)
+
+type StorageNodeConfig struct {
+	Url        string
+	DataSource string
+	Weight     int
+	Draining   bool
+}
+
+type Node struct {
+	Name       string
+	Url        string
+	DataSource string
+	Weight     int
+}
+
+type byName []Node
+
+func (n byName) Len() int           { return len(n) }
+func (n byName) Swap(i, j int)      { n[i], n[j] = n[j], n[i] }
+func (n byName) Less(i, j int) bool { return n[i].Name < n[j].Name }
+
+// readNodes returns the configured nodes sorted by name. Without StorageNode
+// sections the server itself is the only node.
+func readNodes(config Config) []Node {
+	var nodes []Node
+	for name, node := range config.StorageNode {
+		weight := node.Weight
+		if weight == 0 {
+			weight = DEFAULT_NODE_WEIGHT
+		}
+		// A draining node keeps its users until they are moved but gets no
+		// new ones
+		if node.Draining {
+			weight = 0
+		}
+		nodes = append(nodes, Node{Name: name, Url: node.Url, DataSource: node.DataSource, Weight: weight})
+	}
+	if len(nodes) == 0 {
+		nodes = append(nodes, Node{
+			Name:       DEFAULT_NODE,
+			Url:        config.SyncServer.PublicHostname + "/storage",
+			DataSource: config.SyncServer.DataSource,
+			Weight:     DEFAULT_NODE_WEIGHT,
+		})
+	}
+	sort.Sort(byName(nodes))
+	return nodes
+}
+
+// nodeScore is the node's draw for the key. The highest draw wins and
+// scaling -1/ln(h) by the weight gives every node a share of the keys
+// proportional to its weight.
+func nodeScore(node Node, key string) float64 {
+	digest := sha256.Sum256([]byte(node.Name + ":" + key))
+	h := (float64(binary.BigEndian.Uint64(digest[:8])) + 0.5) / math.Pow(2, 64)
+	return float64(node.Weight) / -math.Log(h)
+}
+
+// AssignNode returns the node for key, usually an email address, or nil if
+// all nodes are draining
+func AssignNode(key string, nodes []Node) *Node {
+	var best *Node
+	bestScore := 0.0
+	for i := range nodes {
+		if nodes[i].Weight <= 0 {
+			continue
+		}
+		score := nodeScore(nodes[i], key)
+		if best == nil || score > bestScore || (score == bestScore && nodes[i].Name > best.Name) {
+			best, bestScore = &nodes[i], score
+		}
+	}
+	return best
+}
+
+// mountPath is the path to mount the node's storage server on when it is
+// served by this server, or "" when it lives elsewhere
+func mountPath(node Node, publicHostname string) string {
+	nodeUrl, err := url.Parse(node.Url)
+	if err != nil {
+		return ""
+	}
+	publicUrl, err := url.Parse(publicHostname)
+	if err != nil || nodeUrl.Host != publicUrl.Host {
+		return ""
+	}
+	return nodeUrl.Path
+}
+
+// assertionEmail returns the email in the certificate of a BrowserID
+// assertion. It is only used to pick a node; the token server verifies it.
+func assertionEmail(r *http.Request) string {
+	authorization := r.Header.Get("Authorization")
+	if !strings.HasPrefix(authorization, "BrowserID ") {
+		return ""
+	}
+	parts := strings.Split(strings.SplitN(authorization[len("BrowserID "):], "~", 2)[0], ".")
+	if len(parts) != 3 {
+		return ""
+	}
+	segment := strings.TrimRight(parts[1], "=")
+	payload, err := base64.URLEncoding.DecodeString(segment + strings.Repeat("=", (4-len(segment)%4)%4))
+	if err != nil {
+		return ""
+	}
+	var certificate struct {
+		Principal struct {
+			Email string `json:"email"`
+		} `json:"principal"`
+	}
+	if json.Unmarshal(payload, &certificate) != nil {
+		return ""
+	}
+	return certificate.Principal.Email
+}
+
+// unknownNodes counts the users assigned to nodes that are not configured,
+// like the "default" node of migrations/003-user-nodes.sql once StorageNode
+// sections are added. They get a 503 until nodes.py rename maps the node to
+// a configured one.
+func unknownNodes(db *sql.DB, nodes []Node) (map[string]int, error) {
+	known := make(map[string]bool)
+	for _, node := range nodes {
+		known[node.Name] = true
+	}
+	rows, err := db.Query("select Node, count(*) from Users where Node is not null group by Node")
+	if err != nil {
+		return nil, err
+	}
+	defer rows.Close()
+	unknown := make(map[string]int)
+	for rows.Next() {
+		var name string
+		var count int
+		if err := rows.Scan(&name, &count); err != nil {
+			return nil, err
+		}
+		if !known[name] {
+			unknown[name] = count
+		}
+	}
+	return unknown, rows.Err()
+}
+
+type statusRecorder struct {
+	http.ResponseWriter
+	status int
+}
+
+func (w *statusRecorder) WriteHeader(status int) {
+	w.status = status
+	w.ResponseWriter.WriteHeader(status)
+}
+
+// NodeDispatcher forwards token requests to the token server of the user's
+// node. Users that nodes.py is migrating get a 503 until they are moved.
+type NodeDispatcher struct {
+	db           *sql.DB
+	nodes        []Node
+	tokenServers map[string]http.Handler
+}
+
+func NewNodeDispatcher(db *sql.DB, nodes []Node, tokenServers map[string]http.Handler) *NodeDispatcher {
+	return &NodeDispatcher{db: db, nodes: nodes, tokenServers: tokenServers}
+}
+
+func (d *NodeDispatcher) ServeHTTP(w http.ResponseWriter, r *http.Request) {
+	email := assertionEmail(r)
+	if email == "" {
+		// Let the token server reject it
+		d.tokenServers[d.nodes[0].Name].ServeHTTP(w, r)
+		return
+	}
+
+	var node sql.NullString
+	var migrating bool
+	err := d.db.QueryRow("select Node, Migrating from Users where Email = $1", email).Scan(&node, &migrating)
+	if err != nil && err != sql.ErrNoRows {
+		log.Print("Could not look up the node of a user: ", err)
+		http.Error(w, "Database error", http.StatusServiceUnavailable)
+		return
+	}
+	if migrating {
+		w.Header().Set("Retry-After", MIGRATING_RETRY_AFTER)
+		http.Error(w, "User is being migrated", http.StatusServiceUnavailable)
+		return
+	}
+
+	name := node.String
+	if !node.Valid {
+		assigned := AssignNode(email, d.nodes)
+		if assigned == nil {
+			http.Error(w, "No storage node accepts new users", http.StatusServiceUnavailable)
+			return
+		}
+		name = assigned.Name
+	} else if _, ok := d.tokenServers[name]; !ok {
+		// The user's data is on that node, assigning another one would
+		// hide it. See unknownNodes.
+		http.Error(w, "Unknown storage node", http.StatusServiceUnavailable)
+		return
+	}
+
+	recorder := &statusRecorder{ResponseWriter: w, status: http.StatusOK}
+	d.tokenServers[name].ServeHTTP(recorder, r)
+
+	// The token server creates the user, remember where it went
+	if recorder.status == http.StatusOK && node.String != name {
+		if _, err := d.db.Exec("update Users set Node = $1 where Email = $2", name, email); err != nil {
+			log.Print("Could not store the node of a user: ", err)
+		}
+	}
+}
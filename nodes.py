@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Storage nodes. The token server assigns every user to one of the nodes
+# in syncserver.ini with weighted rendezvous hashing of the email address,
+# the same way AssignNode in nodes.go does, and remembers the assignment in
+# Users.Node. drain moves all users off a node with dump.py, and rename
+# assigns the users of a node that is not configured, like the "default"
+# node of migrations/003-user-nodes.sql, to the node that has their data:
+#
+#   ./nodes.py --config /etc/syncserver.ini assign someone@example.com
+#   ./nodes.py --config /etc/syncserver.ini drain node1 --grace 300
+#   ./nodes.py --config /etc/syncserver.ini rename default node1
+
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import math
+import struct
+import tempfile
+import time
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+import dump
+
+# The node that a single node deployment stores everything on, and that
+# migrations/003-user-nodes.sql assigns existing users to
+DEFAULT_NODE = "default"
+DEFAULT_WEIGHT = 100
+DEFAULT_DRAIN_BATCH_SIZE = 100
+
+Node = collections.namedtuple("Node", ["name", "url", "data_source", "weight"])
+
+def node_score(node, key):
+    # Rendezvous hashing: every node draws a number for the key and the
+    # highest draw wins. Scaling -1/ln(h) by the weight gives every node a
+    # share of the keys proportional to its weight, and adding or removing
+    # a node only moves the keys that it wins or won.
+    digest = hashlib.sha256(("%s:%s" % (node.name, key)).encode("utf-8")).digest()
+    h = (struct.unpack(">Q", digest[:8])[0] + 0.5) / 2.0 ** 64
+    return node.weight / -math.log(h)
+
+def assign_node(key, nodes):
+    """The node for key, usually an email address. Nodes with a weight of
+    0, the draining ones, do not get new users."""
+    candidates = [node for node in nodes if node.weight > 0]
+    if not candidates:
+        raise ValueError("No storage node accepts new users")
+    return max(candidates, key=lambda node: (node_score(node, key), node.name))
+
+def read_config(path):
+    """The storage nodes in a syncserver.ini, like readNodes in nodes.go.
+    Without StorageNode sections the server itself is the only node."""
+    parser = RawConfigParser()
+    parser.optionxform = str
+    parser.read(path)
+    nodes = []
+    for section in parser.sections():
+        if not section.startswith("StorageNode "):
+            continue
+        options = dict(parser.items(section))
+        # A draining node keeps its users until they are moved but gets no
+        # new ones
+        weight = int(options.get("Weight") or 0) or DEFAULT_WEIGHT
+        if options.get("Draining", "false").lower() in ("true", "yes", "on", "1"):
+            weight = 0
+        nodes.append(Node(section.split(" ", 1)[1].strip('"'), options["Url"], options["DataSource"], weight))
+    if not nodes:
+        server = dict(parser.items("SyncServer"))
+        nodes.append(Node(DEFAULT_NODE, server["PublicHostname"] + "/storage", server["DataSource"], DEFAULT_WEIGHT))
+    return dict(parser.items("SyncServer")), sorted(nodes)
+
+class PostgresDirectory(object):
+
+    """The user to node assignments in the token server's Users table."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.autocommit = True
+
+    def node_users(self, node):
+        cur = self.conn.cursor()
+        cur.execute("select Uid, Email from Users where Node = %s order by Uid", (node,))
+        return cur.fetchall()
+
+    def set_node(self, uid, node, migrating=False):
+        self.conn.cursor().execute("update Users set Node = %s, Migrating = %s where Uid = %s", (node, migrating, uid))
+
+    def rename_node(self, old, new):
+        cur = self.conn.cursor()
+        cur.execute("update Users set Node = %s where Node = %s", (new, old))
+        return cur.rowcount
+
+def shares_data(a, b, databases):
+    return databases[a.name] is databases[b.name] or (a.data_source is not None and a.data_source == b.data_source)
+
+def drain(directory, databases, source, nodes, grace=0, batch_size=DEFAULT_DRAIN_BATCH_SIZE):
+    """Move every user assigned to source to the node assign_node picks for
+    them among the others. databases maps node names to dump databases.
+
+    Users are moved in batches. A batch is first marked as migrating, so
+    the token server answers 503 for them, then grace seconds are given
+    for tokens already handed out to expire. Each user is then exported,
+    imported on its new node, reassigned and deleted from source. A drain
+    that is interrupted can simply be run again.
+
+    Nodes can share a DataSource, in which case the data is already where
+    it needs to be and only the assignment changes. Copying it would
+    replace the user's rows with themselves and then delete them."""
+    source_node = [node for node in nodes if node.name == source][0]
+    targets = [node for node in nodes if node.name != source]
+    report = {"users": 0, "rows": 0, "bytes": 0, "moves": collections.Counter(), "started": time.time()}
+    users = directory.node_users(source)
+    for i in range(0, len(users), batch_size):
+        batch = users[i:i+batch_size]
+        for uid, email in batch:
+            directory.set_node(uid, source, migrating=True)
+        if grace:
+            time.sleep(grace)
+        for uid, email in batch:
+            target = assign_node(email, targets)
+            report["users"] += 1
+            report["moves"][target.name] += 1
+            if shares_data(source_node, target, databases):
+                directory.set_node(uid, target.name)
+                continue
+            with tempfile.TemporaryFile() as f:
+                dump.export_user(databases[source], uid, f)
+                databases[source].commit()
+                f.seek(0)
+                imported = dump.import_user(databases[target.name], f, uid, replace=True)
+            directory.set_node(uid, target.name)
+            databases[source].delete(uid)
+            databases[source].commit()
+            report["rows"] += imported["rows"]
+            report["bytes"] += imported["bytes"]
+    report["seconds"] = time.time() - report.pop("started")
+    return report
+
+def print_drain_report(source, report):
+    print("moved %d users (%d rows, %d bytes) off %s in %.1fs: %s" % (
+        report["users"], report["rows"], report["bytes"], source, report["seconds"],
+        ", ".join("%d to %s" % (n, name) for name, n in sorted(report["moves"].items())) or "nothing to do"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage node assignment and draining")
+    parser.add_argument("--config", default="/etc/syncserver.ini")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    assign = subparsers.add_parser("assign", help="show the node a new user would be assigned to")
+    assign.add_argument("email")
+    drain_parser = subparsers.add_parser("drain", help="move all users off a node")
+    drain_parser.add_argument("node")
+    drain_parser.add_argument("--grace", type=float, default=300, help="seconds for handed out tokens to expire")
+    drain_parser.add_argument("--batch-size", type=int, default=DEFAULT_DRAIN_BATCH_SIZE)
+    rename = subparsers.add_parser("rename", help="assign the users of a node that is not configured to one that is")
+    rename.add_argument("old")
+    rename.add_argument("new")
+    args = parser.parse_args()
+
+    server, nodes = read_config(args.config)
+    if args.command == "assign":
+        print(assign_node(args.email, nodes).name)
+    elif args.command == "rename":
+        import psycopg2
+        if args.new not in [node.name for node in nodes]:
+            parser.error("unknown node %s" % args.new)
+        directory = PostgresDirectory(psycopg2.connect(server["DataSource"]))
+        print("moved %d users from %s to %s" % (directory.rename_node(args.old, args.new), args.old, args.new))
+    else:
+        import psycopg2
+        if args.node not in [node.name for node in nodes]:
+            parser.error("unknown node %s" % args.node)
+        databases = dict((node.name, dump.PostgresDatabase(psycopg2.connect(node.data_source))) for node in nodes)
+        directory = PostgresDirectory(psycopg2.connect(server["DataSource"]))
+        print_drain_report(args.node, drain(directory, databases, args.node, nodes, args.grace, args.batch_size))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Runs test methods concurrently. Every StorageTestCase test works in its
+# own freshly minted user, so tests do not interfere with each other.
+#
+#   ./runtests.py --workers 16 tests
+#   ./runtests.py --processes 4 tests.StorageTestCase.test_newer
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import sys
+import threading
+import time
+import unittest
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import syncclient
+
+def test_ids(names):
+    def flatten(suite):
+        for test in suite:
+            if isinstance(test, unittest.TestSuite):
+                for t in flatten(test):
+                    yield t
+            else:
+                yield test
+    return [test.id() for test in flatten(unittest.defaultTestLoader.loadTestsFromNames(names))]
+
+def run_test(test_id):
+    """Run a single test and return (test_id, outcome, seconds, details)."""
+    suite = unittest.defaultTestLoader.loadTestsFromName(test_id)
+    result = unittest.TestResult()
+    started = time.time()
+    suite.run(result)
+    elapsed = time.time() - started
+    if result.errors:
+        return test_id, "error", elapsed, result.errors[0][1]
+    if result.failures:
+        return test_id, "fail", elapsed, result.failures[0][1]
+    if result.skipped:
+        return test_id, "skip", elapsed, result.skipped[0][1]
+    return test_id, "ok", elapsed, None
+
+def run_threads(ids, workers, report):
+    # Size the shared connection pool so workers do not wait on each other
+    syncclient.default_client = syncclient.SyncStorageClient(pool_size=workers)
+    queue = Queue()
+    for test_id in ids:
+        queue.put(test_id)
+    lock = threading.Lock()
+    def work():
+        while True:
+            try:
+                test_id = queue.get_nowait()
+            except Exception:
+                return
+            result = run_test(test_id)
+            with lock:
+                report(result)
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+def run_processes(ids, processes, report):
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(run_test, ids):
+            report(result)
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the tests concurrently")
+    parser.add_argument("--workers", type=int, default=8, help="number of threads")
+    parser.add_argument("--processes", type=int, default=0, help="use a pool of processes instead of threads")
+    parser.add_argument("--slowest", type=int, default=10, help="number of slowest tests to list")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("names", nargs="*", default=["tests"])
+    args = parser.parse_args()
+
+    results = []
+    def report(result):
+        results.append(result)
+        test_id, outcome, elapsed, details = result
+        if args.verbose:
+            print("%-5s %7.2fs %s" % (outcome, elapsed, test_id))
+        else:
+            sys.stdout.write({"ok": ".", "fail": "F", "error": "E", "skip": "s"}[outcome])
+            sys.stdout.flush()
+
+    ids = test_ids(args.names)
+    started = time.time()
+    if args.processes:
+        run_processes(ids, args.processes, report)
+    else:
+        run_threads(ids, args.workers, report)
+    elapsed = time.time() - started
+    print()
+
+    for test_id, outcome, seconds, details in sorted(results):
+        if outcome in ("fail", "error"):
+            print("=" * 70)
+            print("%s: %s" % (outcome.upper(), test_id))
+            print("-" * 70)
+            print(details)
+
+    if args.slowest:
+        print("Slowest tests:")
+        for test_id, outcome, seconds, details in sorted(results, key=lambda r: -r[2])[:args.slowest]:
+            print("  %7.2fs %s" % (seconds, test_id))
+
+    counts = dict((outcome, len([r for r in results if r[1] == outcome])) for outcome in ("ok", "fail", "error", "skip"))
+    serial = sum(r[2] for r in results)
+    print("Ran %d tests in %.2fs (%.2fs of test time)" % (len(results), elapsed, serial))
+    print("ok=%(ok)d fail=%(fail)d error=%(error)d skip=%(skip)d" % counts)
+    return 1 if counts["fail"] or counts["error"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Helpers to read setup.sql and the migrations from the Python tools.
+
+import os
+import re
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SETUP_SQL = os.path.join(ROOT, "setup.sql")
+MIGRATIONS = os.path.join(ROOT, "migrations")
+
+def sql_statements(path):
+    # Split a .sql file into statements, dropping comments and keeping
+    # $$ quoted function bodies intact
+    with open(path) as f:
+        sql = re.sub(r"--[^\n]*", "", f.read())
+    statements, current = [], ""
+    for i, part in enumerate(sql.split("$$")):
+        if i % 2:
+            current += "$$" + part + "$$"
+            continue
+        pieces = part.split(";")
+        current += pieces[0]
+        for piece in pieces[1:]:
+            statements.append(current.strip())
+            current = piece
+    statements.append(current.strip())
+    return [s for s in statements if s]
+
+def migrations():
+    return [os.path.join(MIGRATIONS, name) for name in sorted(os.listdir(MIGRATIONS)) if name.endswith(".sql")]
+
+def create_table_statement(table):
+    for statement in sql_statements(SETUP_SQL):
+        if statement.startswith("create table %s " % table):
+            return statement
+    raise KeyError(table)
+
+def sqlite_create_table_statement(table):
+    # SQLite wants table constraints after the columns, setup.sql has the
+    # primary key in between them
+    statement = create_table_statement(table)
+    head, body = statement.split("(", 1)
+    lines = [line.strip().rstrip(",") for line in body.rsplit(")", 1)[0].split("\n") if line.strip()]
+    constraints = [line for line in lines if line.startswith("primary key")]
+    columns = [line for line in lines if not line.startswith("primary key")]
+    return head + "(\n  " + ",\n  ".join(columns + constraints) + "\n)"
@@ -8,9 +8,15 @@ create table Users (
   Created      timestamp without time zone default (now() at time zone 'utc'),
   Email        varchar unique not null,
   Generation   bigint not null,
-  ClientState  varchar not null
+  ClientState  varchar not null,
+  -- The storage node the user is assigned to, see nodes.go, and whether
+  -- nodes.py is moving the user to another one
+  Node         varchar(64),
+  Migrating    boolean not null default false
 );
 
+create index UsersNodeIndex on Users (Node);
+
 -- From moz-syncserver/setup.sql
 create table Objects (
   UserId             integer not null,
@@ -23,3 +29,83 @@ create table Objects (
   PayloadSize        integer not null default 0,
   TTL                integer not null default 2100000000
 );
+
+-- Newer-than queries and max(Modified) per collection
+create index ObjectsModifiedIndex on Objects (UserId, CollectionName, Modified);
+
+-- Sorting by sortindex
+create index ObjectsSortIndexIndex on Objects (UserId, CollectionName, SortIndex);
+
+-- Finding expired objects. Modified is in milliseconds and TTL in
+-- seconds. Objects with the default TTL never expire and are left out.
+create index ObjectsExpiryIndex on Objects ((Modified + TTL::bigint * 1000)) where TTL <> 2100000000;
+
+-- Per collection totals so that /info/collections and friends do not have
+-- to aggregate over all of a user's objects. Kept up to date by triggers
+-- on Objects. Modified is always the max(Modified) of the collection's
+-- objects and the row disappears together with the last object.
+create table Collections (
+  UserId             integer not null,
+  CollectionName     varchar(32) not null,
+  primary key (UserId, CollectionName),
+  Modified           bigint not null,
+  Count              integer not null default 0,
+  TotalPayloadSize   bigint not null default 0
+);
+
+create function CollectionsAddObject(uid integer, collection varchar, objectModified bigint, objectSize integer) returns void as $$
+begin
+  loop
+    update Collections set Modified = greatest(Modified, objectModified), Count = Count + 1,
+      TotalPayloadSize = TotalPayloadSize + objectSize
+      where UserId = uid and CollectionName = collection;
+    if found then
+      return;
+    end if;
+    begin
+      insert into Collections (UserId, CollectionName, Modified, Count, TotalPayloadSize)
+        values (uid, collection, objectModified, 1, objectSize);
+      return;
+    exception when unique_violation then
+      -- Another transaction created the row first, update it instead
+    end;
+  end loop;
+end;
+$$ language plpgsql;
+
+create function CollectionsRemoveObject(uid integer, collection varchar, objectModified bigint, objectSize integer) returns void as $$
+declare
+  c Collections%rowtype;
+begin
+  update Collections set Count = Count - 1, TotalPayloadSize = TotalPayloadSize - objectSize
+    where UserId = uid and CollectionName = collection returning * into c;
+  if c.Count <= 0 then
+    delete from Collections where UserId = uid and CollectionName = collection;
+  elsif objectModified >= c.Modified then
+    update Collections set Modified = coalesce((select max(o.Modified) from Objects o
+      where o.UserId = uid and o.CollectionName = collection), c.Modified)
+      where UserId = uid and CollectionName = collection;
+  end if;
+end;
+$$ language plpgsql;
+
+create function ObjectsUpdateCollections() returns trigger as $$
+begin
+  if tg_op = 'UPDATE' and NEW.UserId = OLD.UserId and NEW.CollectionName = OLD.CollectionName then
+    update Collections set Modified = greatest(Modified, NEW.Modified),
+      TotalPayloadSize = TotalPayloadSize + NEW.PayloadSize - OLD.PayloadSize
+      where UserId = NEW.UserId and CollectionName = NEW.CollectionName;
+    return null;
+  end if;
+  if tg_op = 'DELETE' or tg_op = 'UPDATE' then
+    perform CollectionsRemoveObject(OLD.UserId, OLD.CollectionName, OLD.Modified, OLD.PayloadSize);
+  end if;
+  if tg_op = 'INSERT' or tg_op = 'UPDATE' then
+    perform CollectionsAddObject(NEW.UserId, NEW.CollectionName, NEW.Modified, NEW.PayloadSize);
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger ObjectsUpdateCollectionsTrigger after insert or update or delete on Objects
+  for each row execute procedure ObjectsUpdateCollections();
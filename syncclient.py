@@ -0,0 +1,887 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import codecs
+import collections
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import zlib
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from httplib import HTTPResponse
+except ImportError:
+    from http.client import HTTPResponse
+
+try:
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlencode, urlsplit
+
+import requests
+import requests.adapters
+import requests.exceptions
+import urllib3.connection
+import urllib3.connectionpool
+
+# Both can be overridden from the environment. SYNC_SERVER=local makes the
+# tests and tools start an in-process localserver.py.
+SERVER = os.environ.get("SYNC_SERVER", "https://sync.sateh.com")
+MOCKMYID_SERVER = os.environ.get("MOCKMYID_SERVER", "http://127.0.0.1:8080")
+
+# Match the proxy timeouts in etc/nginx/syncserver.conf
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_MAX_TIMINGS = 10000
+DEFAULT_PAGE_SIZE = 1000
+
+# Defaults for upload_objects. These are the knobs to sweep when looking
+# for the batch size the storage server handles best.
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_BYTES = 1024 * 1024
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_UPLOAD_RETRIES = 3
+
+# Matches TokenDuration in main.go. Tokens are refreshed this many seconds
+# before they expire so that requests in flight do not fail with a 401.
+DEFAULT_TOKEN_DURATION = 300
+DEFAULT_TOKEN_REFRESH_MARGIN = 30
+
+# Request bodies of at least this many bytes are sent gzipped, the same
+# threshold the server uses for responses. Smaller bodies do not shrink
+# enough to pay for the gzip header and the CPU time.
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_COMPRESS_LEVEL = 6
+
+# One record per request. All times are in seconds. connect is the time
+# spent setting up new TCP+TLS connections (0 when a pooled connection was
+# reused), server is the remaining time until the response headers arrived
+# and transfer is the time spent reading the response body. sent and
+# received are the bytes of the request and response, headers included.
+# received is counted on the socket, so it is the gzipped and chunked
+# size. A streamed response is recorded once its body has been read, see
+# finish_timing.
+RequestTiming = collections.namedtuple("RequestTiming",
+    ["method", "url", "status_code", "started", "connect", "server", "transfer", "total", "sent", "received"])
+
+_connect_times = threading.local()
+
+def _record_connect_time(elapsed):
+    _connect_times.total = getattr(_connect_times, "total", 0.0) + elapsed
+
+def _take_connect_time():
+    elapsed = getattr(_connect_times, "total", 0.0)
+    _connect_times.total = 0.0
+    return elapsed
+
+class _CountingReader(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def _counted(self, data):
+        self.count += len(data)
+        return data
+
+    def read(self, *args):
+        return self._counted(self.fp.read(*args))
+
+    def read1(self, *args):
+        return self._counted(self.fp.read1(*args))
+
+    def readline(self, *args):
+        return self._counted(self.fp.readline(*args))
+
+    def readinto(self, b):
+        n = self.fp.readinto(b)
+        self.count += n or 0
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+class _CountingHTTPResponse(HTTPResponse):
+    # The response closes and drops fp once the body is read, so keep the
+    # reader around to ask it for the count afterwards
+    def __init__(self, *args, **kwargs):
+        HTTPResponse.__init__(self, *args, **kwargs)
+        self.fp = self.reader = _CountingReader(self.fp)
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    response_class = _CountingHTTPResponse
+
+    def connect(self):
+        start = time.time()
+        try:
+            urllib3.connection.HTTPConnection.connect(self)
+        finally:
+            _record_connect_time(time.time() - start)
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    response_class = _CountingHTTPResponse
+
+    def connect(self):
+        start = time.time()
+        try:
+            urllib3.connection.HTTPSConnection.connect(self)
+        finally:
+            _record_connect_time(time.time() - start)
+
+class _TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool,
+                                                   "https": _TimedHTTPSConnectionPool}
+
+def _bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+def _gzip(data, level=DEFAULT_COMPRESS_LEVEL):
+    # zlib.compressobj with wbits 31 writes the gzip container, which also
+    # works on Python 2 where gzip.compress does not exist
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(_bytes(data)) + compressor.flush()
+
+def _headers_size(headers):
+    return sum(len(name) + len(value) + 4 for name, value in headers.items()) + 2
+
+def _request_size(r):
+    body = r.request.body or b""
+    return len("%s %s HTTP/1.1\r\n" % (r.request.method, r.request.path_url)) + _headers_size(r.request.headers) + len(body)
+
+def _response_size(r):
+    reader = getattr(getattr(r.raw, "_original_response", None), "reader", None)
+    if reader is not None:
+        return reader.count
+    # Not one of our connections, estimate it
+    return len("HTTP/1.1 %d %s\r\n" % (r.status_code, r.reason)) + _headers_size(r.headers) + \
+        int(r.headers.get("Content-Length") or 0)
+
+def _precondition_headers(headers=None, if_modified_since=None, if_unmodified_since=None):
+    headers = dict(headers or {})
+    if if_modified_since is not None:
+        headers["X-If-Modified-Since"] = "%.2f" % if_modified_since
+    if if_unmodified_since is not None:
+        headers["X-If-Unmodified-Since"] = "%.2f" % if_unmodified_since
+    return headers
+
+class HawkSigner(object):
+
+    """Signs requests for one token. The HMAC key schedule is set up once
+    and copied for every request instead of being rebuilt from the
+    credentials each time."""
+
+    def __init__(self, token_id, key, algorithm="sha256"):
+        self.token_id = str(token_id)
+        self.mac = hmac.new(_bytes(key), digestmod=getattr(hashlib, algorithm))
+
+    def header(self, method, url, timestamp=None, nonce=None):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        resource = parts.path
+        if parts.query:
+            resource += "?" + parts.query
+        if timestamp is None:
+            timestamp = time.time()
+        if nonce is None:
+            nonce = base64.urlsafe_b64encode(os.urandom(6))[:6].decode("ascii")
+        normalized = "hawk.1.header\n%d\n%s\n%s\n%s\n%s\n%d\n\n\n" % (
+            timestamp, nonce, method.upper(), resource, parts.hostname.lower(), port)
+        mac = self.mac.copy()
+        mac.update(_bytes(normalized))
+        return 'Hawk id="%s", ts="%d", nonce="%s", mac="%s"' % (
+            self.token_id, timestamp, nonce, base64.b64encode(mac.digest()).decode("ascii"))
+
+def _rebase_url(url, endpoint, token):
+    # url was built from endpoint, the token's api_endpoint at the time. A
+    # refreshed token can point to another node, e.g. after a drain.
+    if endpoint and token["api_endpoint"] != endpoint and url.startswith(endpoint):
+        return token["api_endpoint"] + url[len(endpoint):]
+    return url
+
+class ManagedToken(dict):
+
+    """A token that knows when it expires and how to mint a replacement.
+    It can be passed anywhere a token dict is expected; the client
+    refreshes it in place before it runs out."""
+
+    def __init__(self, mint, refresh_margin=DEFAULT_TOKEN_REFRESH_MARGIN):
+        dict.__init__(self)
+        self.mint = mint
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        token = self.mint()
+        self.clear()
+        self.update(token)
+        self.expires = time.time() + token.get("duration", DEFAULT_TOKEN_DURATION)
+        self.signer = HawkSigner(token["id"], token["key"])
+
+    def ensure_fresh(self):
+        if time.time() + self.refresh_margin >= self.expires:
+            with self.lock:
+                if time.time() + self.refresh_margin >= self.expires:
+                    self.refresh()
+
+    def replace(self, rejected):
+        """Refresh the token after the server rejected the one signed by
+        rejected, unless another thread already has, and return the
+        current signer."""
+        with self.lock:
+            if self.signer is rejected:
+                self.refresh()
+            return self.signer
+
+def _iter_json_array(chunks):
+    # Decode the elements of a JSON array one at a time as the chunks come
+    # in. An element is only emitted once the character that follows it has
+    # arrived, so a value split across chunks is never decoded early.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    opened = False
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if not opened:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                opened = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            if end == len(buf):
+                break
+            yield value
+            pos = end
+    raise ValueError("Truncated JSON array")
+
+class _Prefetch(threading.Thread):
+
+    def __init__(self, fn, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fn = fn
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class CollectionIterator(object):
+
+    """Iterates over a collection page by page, following X-Weave-Next-Offset.
+    Records are decoded as they stream in and the next page is requested
+    while the current one is being consumed."""
+
+    def __init__(self, client, token, collection_name, full=None, newer=None, ids=None, sort=None,
+                 page_size=DEFAULT_PAGE_SIZE, newlines=False, prefetch=True):
+        self.client = client
+        self.token = token
+        self.collection_name = collection_name
+        self.full = full
+        self.newer = newer
+        self.ids = ids
+        self.sort = sort
+        self.page_size = page_size
+        self.newlines = newlines
+        self.prefetch = prefetch
+        self.pages = 0
+        self.records = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def records_per_second(self):
+        return self.records / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def fetch(self, offset):
+        accepts = "application/newlines" if self.newlines else "application/json"
+        url = self.client.collection_url(self.token, self.collection_name, full=self.full, newer=self.newer,
+                                         limit=self.page_size, offset=offset, ids=self.ids, sort=self.sort)
+        r = self.client.request("GET", url, self.token, headers={"Accepts":accepts}, stream=True)
+        if r.status_code >= 400:
+            self.close(r)
+        r.raise_for_status()
+        return r
+
+    def close(self, r):
+        self.client.finish_timing(r)
+        r.close()
+
+    def chunks(self, r):
+        for chunk in r.iter_content(64 * 1024):
+            self.bytes += len(chunk)
+            yield chunk
+
+    def decode(self, r):
+        if self.newlines:
+            for line in r.iter_lines(64 * 1024):
+                self.bytes += len(line) + 1
+                if line:
+                    yield json.loads(line.decode("utf-8"))
+        else:
+            for record in _iter_json_array(self.chunks(r)):
+                yield record
+
+    def __iter__(self):
+        self.started = time.time()
+        r = self.fetch(None)
+        following = None
+        try:
+            while r is not None:
+                next_offset = r.headers.get("X-Weave-Next-Offset")
+                if next_offset and self.prefetch:
+                    following = _Prefetch(self.fetch, next_offset)
+                for record in self.decode(r):
+                    self.records += 1
+                    yield record
+                self.close(r)
+                r = None
+                self.pages += 1
+                if following is not None:
+                    prefetched, following = following, None
+                    r = prefetched.result()
+                elif next_offset:
+                    r = self.fetch(next_offset)
+                else:
+                    r = None
+        finally:
+            if r is not None:
+                self.close(r)
+            if following is not None:
+                self.close(following.result())
+            self.finished = time.time()
+
+def _encoded_batches(objects, batch_size, batch_bytes):
+    # Group an iterable of records into lists of (id, record, json) that
+    # stay under both the record count and the encoded body size.
+    batch, size = [], 2
+    for o in objects:
+        encoded = json.dumps(o)
+        if batch and (len(batch) >= batch_size or size + len(encoded) + 1 > batch_bytes):
+            yield batch
+            batch, size = [], 2
+        batch.append((o.get("id"), o, encoded))
+        size += len(encoded) + 1
+    if batch:
+        yield batch
+
+class _BatchUploader(object):
+
+    def __init__(self, client, token, collection_name, max_in_flight, retries):
+        self.client = client
+        self.token = token
+        self.collection_name = collection_name
+        self.retries = retries
+        self.queue = Queue(max_in_flight)
+        self.lock = threading.Lock()
+        self.result = {"modified": None, "success": [], "failed": {}}
+        self.batches = 0
+        self.error = None
+        self.workers = [threading.Thread(target=self.work) for i in range(max_in_flight)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def work(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.upload(batch)
+            except Exception as e:
+                self.error = e
+
+    def post(self, batch):
+        body = "[" + ",".join(encoded for object_id, o, encoded in batch) + "]"
+        for attempt in range(self.retries + 1):
+            try:
+                j,r = self.client.post_body(self.token, self.collection_name, body)
+                return j
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code < 500 or attempt == self.retries:
+                    raise
+            except requests.exceptions.ConnectionError:
+                if attempt == self.retries:
+                    raise
+            time.sleep(0.1 * 2 ** attempt)
+
+    def upload(self, batch):
+        for attempt in range(self.retries + 1):
+            j = self.post(batch)
+            with self.lock:
+                self.batches += 1
+                if self.result["modified"] is None or j["modified"] > self.result["modified"]:
+                    self.result["modified"] = j["modified"]
+                self.result["success"].extend(j["success"])
+                failed = j.get("failed") or {}
+                if attempt == self.retries or not failed:
+                    self.result["failed"].update(failed)
+                    return
+            # Only resend the records the server did not accept
+            batch = [b for b in batch if b[0] in failed]
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(batch)
+
+    def close(self):
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+class CollectionCache(object):
+
+    """Keeps one user's collection timestamps and records between syncs.
+    Reads are sent with X-If-Modified-Since, so an unchanged collection
+    costs a 304 without a body and a changed one only downloads the
+    records newer than the cached copy, followed by the ids to drop the
+    records other clients deleted. Writes to a cached collection are sent
+    with X-If-Unmodified-Since and fail with a 412 when another client
+    wrote in between; sync() and try again."""
+
+    def __init__(self, client, token):
+        self.client = client
+        self.token = token
+        self.info = None
+        self.info_modified = None
+        self.modified = {}
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def info_collections(self):
+        info, r = self.client.get_info_collections(self.token, if_modified_since=self.info_modified)
+        if info is None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.info = info
+            self.info_modified = float(r.headers["X-Last-Modified"])
+        return self.info
+
+    def get_collection(self, collection_name):
+        modified = self.modified.get(collection_name)
+        objects, r = self.client.get_objects(self.token, collection_name, full=True, newer=modified,
+                                             if_modified_since=modified)
+        records = self.records.setdefault(collection_name, collections.OrderedDict())
+        if objects is None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            for o in objects:
+                records[o["id"]] = o
+            if modified is not None:
+                ids, ids_r = self.client.get_objects(self.token, collection_name)
+                ids = set(ids)
+                for object_id in [object_id for object_id in records if object_id not in ids]:
+                    del records[object_id]
+            self.modified[collection_name] = float(r.headers["X-Last-Modified"])
+        return list(records.values())
+
+    def sync(self):
+        """Bring the cache up to date and return the names of the
+        collections that changed. Costs a single 304 when nothing did."""
+        info = self.info
+        if self.info_collections() is info:
+            return []
+        for name in list(self.records.keys()):
+            if name not in self.info:
+                del self.records[name]
+                del self.modified[name]
+        changed = [name for name, modified in sorted(self.info.items()) if modified != self.modified.get(name)]
+        for name in changed:
+            self.get_collection(name)
+        return changed
+
+    def written(self, collection_name, objects, modified, deleted=(), collection_checked=False):
+        if collection_name not in self.modified:
+            return
+        records = self.records[collection_name]
+        for o in objects:
+            record = dict(records.get(o["id"], {}))
+            record.update(o)
+            record["modified"] = modified
+            records[o["id"]] = record
+        for object_id in deleted:
+            records.pop(object_id, None)
+        # The server checks single item writes against the item alone, so
+        # another client may have changed other items in between. Only a
+        # write checked against the whole collection proves that nothing
+        # was missed; otherwise the next sync() fetches the difference.
+        if collection_checked:
+            self.modified[collection_name] = modified
+            if self.info is not None:
+                self.info[collection_name] = modified
+
+    def unmodified_since(self, collection_name, object_id):
+        # The item may be newer than the collection's cached timestamp
+        # when it was written through the cache since the last fetch
+        modified = self.modified.get(collection_name)
+        record = self.records.get(collection_name, {}).get(object_id)
+        if modified is not None and record is not None:
+            modified = max(modified, record["modified"])
+        return modified
+
+    def put_object(self, collection_name, o_id, o):
+        modified, r = self.client.put_object(self.token, collection_name, o_id, o,
+                                             if_unmodified_since=self.unmodified_since(collection_name, o_id))
+        self.written(collection_name, [dict(o, id=o_id)], modified)
+        return modified
+
+    def post_objects(self, collection_name, objects):
+        result, r = self.client.post_objects(self.token, collection_name, objects,
+                                             if_unmodified_since=self.modified.get(collection_name))
+        success = set(result["success"])
+        self.written(collection_name, [o for o in objects if o["id"] in success], result["modified"],
+                     collection_checked=True)
+        return result
+
+    def delete_object(self, collection_name, object_id):
+        result, r = self.client.delete_object(self.token, collection_name, object_id,
+                                              if_unmodified_since=self.unmodified_since(collection_name, object_id))
+        self.written(collection_name, [], result["modified"], deleted=[object_id])
+        return result
+
+class SyncStorageClient(object):
+
+    """Token server and storage API client that keeps connections alive
+    between requests and records a RequestTiming for every call.
+
+    Request bodies of at least compress_min_size bytes are gzipped and
+    gzipped responses are accepted. compress_min_size=None turns both off,
+    for servers without gzip support and for comparing the two."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, max_timings=DEFAULT_MAX_TIMINGS,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.session = requests.Session()
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.session.headers["Accept-Encoding"] = "gzip" if compress_min_size is not None else "identity"
+        adapter = _TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.timings = collections.deque(maxlen=max_timings)
+        self.signers = {}
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, url, token=None, headers=None, **kwargs):
+        endpoint = token.get("api_endpoint") if token is not None else None
+        signer = self.signer(token) if token is not None else None
+        url = _rebase_url(url, endpoint, token)
+        r = self._request(method, url, signer, headers, **kwargs)
+        if r.status_code == 401 and isinstance(token, ManagedToken):
+            if kwargs.get("stream"):
+                self.finish_timing(r)
+                r.close()
+            # The server may consider the token expired before we do. The
+            # first thread to get here mints a new one, the rest reuse it.
+            signer = token.replace(signer)
+            r = self._request(method, _rebase_url(url, endpoint, token), signer, headers, **kwargs)
+        return r
+
+    def _request(self, method, url, signer, headers, **kwargs):
+        headers = dict(headers or {})
+        if signer is not None:
+            headers["Authorization"] = signer.header(method, url)
+        _take_connect_time()
+        started = time.time()
+        r = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+        total = time.time() - started
+        connect = _take_connect_time()
+        elapsed = r.elapsed.total_seconds()
+        timing = RequestTiming(method, url, r.status_code, started, connect, max(elapsed - connect, 0.0),
+                               max(total - elapsed, 0.0), total, _request_size(r), _response_size(r))
+        if kwargs.get("stream"):
+            # The body has not been read yet
+            r.timing = timing
+        else:
+            self.timings.append(timing)
+        return r
+
+    def finish_timing(self, r):
+        """Record the timing of a streamed response once its body has been
+        read, or given up on."""
+        total = time.time() - r.timing.started
+        self.timings.append(r.timing._replace(transfer=max(total - r.timing.connect - r.timing.server, 0.0),
+                                              total=total, received=_response_size(r)))
+
+    def encode_body(self, headers, body):
+        """Gzip a request body that is big enough to be worth it."""
+        body = _bytes(body)
+        if self.compress_min_size is not None and len(body) >= self.compress_min_size:
+            headers["Content-Encoding"] = "gzip"
+            body = _gzip(body, self.compress_level)
+        return body
+
+    def signer(self, token):
+        if isinstance(token, ManagedToken):
+            token.ensure_fresh()
+            return token.signer
+        signer = self.signers.get(token["id"])
+        if signer is None:
+            if len(self.signers) >= 1024:
+                self.signers.clear()
+            signer = self.signers[token["id"]] = HawkSigner(token["id"], token["key"])
+        return signer
+
+    # Token server and mockmyid
+
+    def call_token_server(self, server, assertion):
+        url = server + "/token/1.0/sync/1.5"
+        r = self.request("GET", url, headers={"Authorization": "BrowserID " + assertion})
+        r.raise_for_status()
+        return r.json(),r
+
+    def call_mockmyid_server(self, email, audience):
+        url = MOCKMYID_SERVER + "/assertion"
+        r = self.request("GET", url, params={"email":email, "audience":audience})
+        r.raise_for_status()
+        return r.json().get("assertion"),r
+
+    def mint_token(self, server, email):
+        def mint():
+            assertion,r = self.call_mockmyid_server(email, server)
+            token,r = self.call_token_server(server, assertion)
+            return token
+        return ManagedToken(mint)
+
+    # Storage API
+
+    def delete_collection(self, token, collection_name, ids=None, if_unmodified_since=None):
+        params = {}
+        if ids:
+            params["ids"] = ",".join(ids)
+        url = token["api_endpoint"] + "/storage/%s" % collection_name
+        if len(params) != 0:
+            url += "?" + urlencode(params)
+        r = self.request("DELETE", url, token, headers=_precondition_headers(if_unmodified_since=if_unmodified_since))
+        r.raise_for_status()
+        return r.json(),r
+
+    def delete_storage(self, token, if_unmodified_since=None):
+        url = token["api_endpoint"] + "/storage"
+        r = self.request("DELETE", url, token, headers=_precondition_headers(if_unmodified_since=if_unmodified_since))
+        r.raise_for_status()
+        return r.json(),r
+
+    def get_object(self, token, collection_name, object_id, if_modified_since=None):
+        url = token["api_endpoint"] + "/storage/%s/%s" % (collection_name, object_id)
+        r = self.request("GET", url, token, headers=_precondition_headers(if_modified_since=if_modified_since))
+        r.raise_for_status()
+        if r.status_code == 304:
+            return None,r
+        return r.json(),r
+
+    def put_object(self, token, collection_name, o_id, o, if_unmodified_since=None):
+        url = token["api_endpoint"] + "/storage/%s/%s" % (collection_name, o_id)
+        headers = _precondition_headers(if_unmodified_since=if_unmodified_since)
+        r = self.request("PUT", url, token, headers=headers, data=self.encode_body(headers, json.dumps(o)))
+        r.raise_for_status()
+        return float(r.text),r
+
+    def delete_object(self, token, collection_name, object_id, if_unmodified_since=None):
+        url = token["api_endpoint"] + "/storage/%s/%s" % (collection_name, object_id)
+        r = self.request("DELETE", url, token, headers=_precondition_headers(if_unmodified_since=if_unmodified_since))
+        r.raise_for_status()
+        return r.json(),r
+
+    def post_objects(self, token, collection_name, objects, content_type="application/json", if_unmodified_since=None):
+        return self.post_body(token, collection_name, json.dumps(objects), content_type=content_type,
+                              if_unmodified_since=if_unmodified_since)
+
+    def post_body(self, token, collection_name, body, content_type="application/json", if_unmodified_since=None):
+        url = token["api_endpoint"] + "/storage/%s" % collection_name
+        headers = _precondition_headers({"Content-Type":content_type}, if_unmodified_since=if_unmodified_since)
+        r = self.request("POST", url, token, headers=headers, data=self.encode_body(headers, body))
+        r.raise_for_status()
+        return r.json(),r
+
+    def upload_objects(self, token, collection_name, objects, batch_size=DEFAULT_BATCH_SIZE,
+                       batch_bytes=DEFAULT_BATCH_BYTES, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                       retries=DEFAULT_UPLOAD_RETRIES):
+        """Upload any number of records as concurrent POSTs of at most
+        batch_size records and batch_bytes bytes each. Records the server
+        reports as failed are resent up to retries times. Returns the
+        merged success, failed and modified of all batches."""
+        uploader = _BatchUploader(self, token, collection_name, max_in_flight, retries)
+        try:
+            for batch in _encoded_batches(objects, batch_size, batch_bytes):
+                uploader.put(batch)
+        finally:
+            uploader.close()
+        if uploader.error is not None:
+            raise uploader.error
+        uploader.result["batches"] = uploader.batches
+        return uploader.result
+
+    def get_info_collections(self, token, if_modified_since=None):
+        url = token["api_endpoint"] + "/info/collections"
+        r = self.request("GET", url, token, headers=_precondition_headers(if_modified_since=if_modified_since))
+        r.raise_for_status()
+        if r.status_code == 304:
+            return None,r
+        return r.json(),r
+
+    def get_info_collection_counts(self, token):
+        url = token["api_endpoint"] + "/info/collection_counts"
+        r = self.request("GET", url, token)
+        r.raise_for_status()
+        return r.json(),r
+
+    def collection_url(self, token, collection_name, full=None, newer=None, limit=None, offset=None, ids=None,
+                       sort=None):
+        """offset is either an integer or the opaque X-Weave-Next-Offset
+        of the previous page, which the server hands out as a cursor for
+        the oldest, newest and index sort orders."""
+        params={}
+        if full:
+            params["full"] = "1"
+        if newer:
+            params["newer"] = ("%.2f" % newer)
+        if limit:
+            params["limit"] = limit
+        if offset:
+            params["offset"] = offset
+        if ids:
+            params["ids"] = ",".join(ids)
+        if sort:
+            params["sort"] = sort
+        return token["api_endpoint"] + "/storage/%s" % collection_name + "?" + urlencode(params)
+
+    def get_objects(self, token, collection_name, full=None, newer=None, limit=None, offset=None, ids=None,
+                    accepts="application/json", if_modified_since=None, sort=None):
+        url = self.collection_url(token, collection_name, full=full, newer=newer, limit=limit, offset=offset, ids=ids,
+                                  sort=sort)
+        r = self.request("GET", url, token, headers=_precondition_headers({"Accepts":accepts}, if_modified_since))
+        r.raise_for_status()
+        if r.status_code == 304:
+            return None,r
+        return r.json(),r
+
+    def iter_objects(self, token, collection_name, full=None, newer=None, ids=None, page_size=DEFAULT_PAGE_SIZE,
+                     newlines=False, prefetch=True, sort=None):
+        return CollectionIterator(self, token, collection_name, full=full, newer=newer, ids=ids, sort=sort,
+                                  page_size=page_size, newlines=newlines, prefetch=prefetch)
+
+    def collection_cache(self, token):
+        return CollectionCache(self, token)
+
+# Module level helpers that share a single pooled client
+
+default_client = SyncStorageClient()
+
+def call_token_server(server, assertion):
+    return default_client.call_token_server(server, assertion)
+
+def call_mockmyid_server(email, audience):
+    return default_client.call_mockmyid_server(email, audience)
+
+def delete_collection(token, collection_name, ids=None, if_unmodified_since=None):
+    return default_client.delete_collection(token, collection_name, ids=ids, if_unmodified_since=if_unmodified_since)
+
+def delete_storage(token, if_unmodified_since=None):
+    return default_client.delete_storage(token, if_unmodified_since=if_unmodified_since)
+
+def get_object(token, collection_name, object_id, if_modified_since=None):
+    return default_client.get_object(token, collection_name, object_id, if_modified_since=if_modified_since)
+
+def put_object(token, collection_name, o_id, o, if_unmodified_since=None):
+    return default_client.put_object(token, collection_name, o_id, o, if_unmodified_since=if_unmodified_since)
+
+def delete_object(token, collection_name, object_id, if_unmodified_since=None):
+    return default_client.delete_object(token, collection_name, object_id, if_unmodified_since=if_unmodified_since)
+
+def post_objects(token, collection_name, objects, content_type="application/json", if_unmodified_since=None):
+    return default_client.post_objects(token, collection_name, objects, content_type=content_type,
+                                       if_unmodified_since=if_unmodified_since)
+
+def upload_objects(token, collection_name, objects, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT, retries=DEFAULT_UPLOAD_RETRIES):
+    return default_client.upload_objects(token, collection_name, objects, batch_size=batch_size, batch_bytes=batch_bytes,
+                                         max_in_flight=max_in_flight, retries=retries)
+
+def get_info_collections(token, if_modified_since=None):
+    return default_client.get_info_collections(token, if_modified_since=if_modified_since)
+
+def get_info_collection_counts(token):
+    return default_client.get_info_collection_counts(token)
+
+def get_objects(token, collection_name, full=None, newer=None, limit=None, offset=None, ids=None,
+                accepts="application/json", if_modified_since=None, sort=None):
+    return default_client.get_objects(token, collection_name, full=full, newer=newer, limit=limit,
+                                      offset=offset, ids=ids, accepts=accepts, if_modified_since=if_modified_since,
+                                      sort=sort)
+
+def iter_objects(token, collection_name, full=None, newer=None, ids=None, page_size=DEFAULT_PAGE_SIZE,
+                 newlines=False, prefetch=True, sort=None):
+    return default_client.iter_objects(token, collection_name, full=full, newer=newer, ids=ids,
+                                       page_size=page_size, newlines=newlines, prefetch=prefetch, sort=sort)
+
+def collection_cache(token):
+    return default_client.collection_cache(token)
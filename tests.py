@@ -4,144 +4,47 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import json
+import io
+import random
+import threading
 import uuid
 import time
 import unittest
-import urllib
-import urllib2
+import zlib
 
-import hawk
 import requests
 import requests.exceptions
 
+import benchmarks
+import dump
+import localserver
+import metrics
+import nodes
+import purge
+import workload
+from syncclient import SERVER, ManagedToken, SyncStorageClient
+from syncclient import (call_token_server, call_mockmyid_server, delete_collection, delete_storage,
+                        get_object, put_object, delete_object, post_objects, get_info_collections,
+                        get_info_collection_counts, get_objects, iter_objects, upload_objects, collection_cache)
+from workload import random_id, random_object, random_object_with_id, random_objects
+
 DEFAULT_SORTINDEX = 0
 DEFAULT_TTL = 2100000000
 
-SERVER = "https://sync.sateh.com"
-
-def call_token_server(server, assertion):
-    url = server + "/token/1.0/sync/1.5"
-    r = requests.get(url, headers={"Authorization": "BrowserID " + assertion})
-    r.raise_for_status()
-    return r.json(),r
-
-def call_mockmyid_server(email, audience):
-    url = "http://127.0.0.1:8080/assertion"
-    r = requests.get(url, params={"email":email, "audience":audience})
-    r.raise_for_status()
-    return r.json().get("assertion"),r
-
-def delete_collection(token, collection_name, ids=None):
-    params = {}
-    if ids:
-        params["ids"] = ",".join(ids)
-    url = token["api_endpoint"] + "/storage/%s" % collection_name
-    if len(params) != 0:
-        url += "?" + urllib.urlencode(params)
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "DELETE", {"credentials": hawk_credentials, "ext":""})
-    r = requests.delete(url, headers={"Authorization":hawk_header["field"]})
-    r.raise_for_status()
-    return r.json(),r
-
-def delete_storage(token):
-    url = token["api_endpoint"] + "/storage"
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "DELETE", {"credentials": hawk_credentials, "ext":""})
-    r = requests.delete(url, headers={"Authorization":hawk_header["field"]})
-    r.raise_for_status()
-    return r.json(),r
-
-
-def get_object(token, collection_name, object_id):
-    url = token["api_endpoint"] + "/storage/%s/%s" % (collection_name, object_id)
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "GET", {"credentials": hawk_credentials, "ext":""})
-    r = requests.get(url, headers={"Authorization":hawk_header["field"]})
-    r.raise_for_status()
-    return r.json(),r
-
-def put_object(token, collection_name, o_id, o):
-    url = token["api_endpoint"] + "/storage/%s/%s" % (collection_name, o_id)
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "PUT", {"credentials": hawk_credentials, "ext":""})
-    r = requests.put(url, headers={"Authorization":hawk_header["field"]}, data=json.dumps(o))
-    r.raise_for_status()
-    return float(r.text),r
-
-def delete_object(token, collection_name, object_id):
-    url = token["api_endpoint"] + "/storage/%s/%s" % (collection_name, object_id)
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "DELETE", {"credentials": hawk_credentials, "ext":""})
-    r = requests.delete(url, headers={"Authorization":hawk_header["field"]})
-    r.raise_for_status()
-    return r.json(),r
-
-def post_objects(token, collection_name, objects, content_type="application/json"):
-    url = token["api_endpoint"] + "/storage/%s" % collection_name
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "POST", {"credentials": hawk_credentials, "ext":""})
-    r = requests.post(url, headers={"Authorization":hawk_header["field"],"Content-Type":content_type}, data=json.dumps(objects))
-    #print r.status_code, r.reason, r.text
-    r.raise_for_status()
-    return r.json(),r
-
-def get_info_collections(token):
-    url = token["api_endpoint"] + "/info/collections"
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "GET", {"credentials": hawk_credentials, "ext":""})
-    r = requests.get(url, headers={"Authorization":hawk_header["field"]})
-    r.raise_for_status()
-    return r.json(),r
-
-def get_info_collection_counts(token):
-    url = token["api_endpoint"] + "/info/collection_counts"
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "GET", {"credentials": hawk_credentials, "ext":""})
-    r = requests.get(url, headers={"Authorization":hawk_header["field"]})
-    r.raise_for_status()
-    return r.json(),r
-
-def get_objects(token, collection_name, full=None, newer=None, limit=None, offset=None, ids=None, accepts="application/json"):
-    params={}
-    if full:
-        params["full"] = "1"
-    if newer:
-        params["newer"] = ("%.2f" % newer)
-    if limit:
-        params["limit"] = limit
-    if offset:
-        params["offset"] = offset
-    if ids:
-        params["ids"] = ",".join(ids)
-    url = token["api_endpoint"] + "/storage/%s" % collection_name + "?" + urllib.urlencode(params)
-    hawk_credentials = {"id": str(token["id"]), "key": str(token["key"]), "algorithm":"sha256"}
-    hawk_header = hawk.client.header(url, "GET", {"credentials": hawk_credentials, "ext":""})
-    r = requests.get(url, headers={"Authorization":hawk_header["field"],"Accepts":accepts})
-    r.raise_for_status()
-    return r.json(),r
-
-
-def random_id():
-    return str(uuid.uuid4())
-
-def random_object():
-    return {"payload":"This is some payload at %f" % time.time()}
-
-def random_object_with_id():
-    return {"payload":"This is some payload at %f" % time.time(), "id": random_id()}
-
-def random_objects(n):
-    return [{"payload":"This is some payload at %f" % time.time(), "id":random_id()} for i in range(n)]
-
-class StorageTestCase(unittest.TestCase):
+# Tests for behavior that only localserver.py has, such as keyset cursors,
+# run only against it
+LOCAL_SERVER = SERVER == "local"
+SERVER = localserver.resolve_server(SERVER)
+
+class UserTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.email = "%.4f@mockmyid.com" % time.time()
+        self.email = "%s@mockmyid.com" % uuid.uuid4().hex
         self.assertion,r = call_mockmyid_server(self.email, SERVER)
         self.token,r = call_token_server(SERVER, self.assertion)
 
+class StorageTestCase(UserTestCase):
+
     def test_put_object_partial(self):
         # Put a new object
         modified,r = put_object(self.token, "things", "testid1", {"payload":"testpayload1"})
@@ -366,6 +269,18 @@ class StorageTestCase(unittest.TestCase):
         self.assertEquals(len(ids2), 30)
         self.assertEquals(len(ids3), 23)
 
+    def test_iter_objects_paging(self):
+        for i in range(83):
+            put_object(self.token, "test", "%.4d" % i, random_object())
+        ids,r = get_objects(self.token, "test")
+        for prefetch in (False, True):
+            objects = iter_objects(self.token, "test", page_size=30, prefetch=prefetch)
+            self.assertEquals(sorted(objects), sorted(ids))
+            self.assertEquals(objects.pages, 3)
+            self.assertEquals(objects.records, 83)
+        objects = list(iter_objects(self.token, "test", full=True, page_size=30))
+        self.assertEquals(sorted(o["id"] for o in objects), sorted(ids))
+
     def test_get_collection_paging_outofbounds(self):
         for i in range(5):
             put_object(self.token, "test", str(i), random_object())
@@ -408,6 +323,27 @@ class StorageTestCase(unittest.TestCase):
         self.assertEquals(no2["payload"], o2["payload"])
         self.assertEquals(no2["modified"], j["modified"])
 
+    def test_post_objects_update(self):
+        # Post objects with all fields
+        objects = [{"id": "post%d" % i, "payload": "payload%d" % i, "sortindex": i, "ttl": 3600} for i in range(3)]
+        j,r = post_objects(self.token, "test", objects)
+        # Post a batch with partial updates, a repeated id and a new object
+        j,r = post_objects(self.token, "test", [{"id": "post0", "payload": "updated0"},
+                                                {"id": "post1", "sortindex": 10},
+                                                {"id": "post1", "payload": "updated1"},
+                                                {"id": "post3", "payload": "payload3"}])
+        self.assertEquals(sorted(set(j["success"])), ["post0", "post1", "post3"])
+        # Fields that were left out are kept
+        for id, payload, sortindex, ttl in (("post0", "updated0", 0, 3600), ("post1", "updated1", 10, 3600),
+                                            ("post2", "payload2", 2, 3600)):
+            o,r = get_object(self.token, "test", id)
+            self.assertEquals((o["payload"], o["sortindex"], o["ttl"]), (payload, sortindex, ttl))
+        o,r = get_object(self.token, "test", "post3")
+        self.assertEquals(o["payload"], "payload3")
+        self.assertEquals(o["modified"], j["modified"])
+        counts,r = get_info_collection_counts(self.token)
+        self.assertEquals(counts["test"], 4)
+
     def test_post_objects_content_type(self):
         # Both tex/plain and application/json should be supported
         for content_type in ("text/plain", "application/json"):
@@ -436,6 +372,17 @@ class StorageTestCase(unittest.TestCase):
     #         self.assertEqual(context.exception.response.status_code, 404)
 
 
+    def test_upload_objects(self):
+        objects = random_objects(250)
+        result = upload_objects(self.token, "test", iter(objects), batch_size=40, max_in_flight=3)
+        self.assertEquals(sorted(result["success"]), sorted(o["id"] for o in objects))
+        self.assertEquals(result["failed"], {})
+        self.assertEquals(result["batches"], 7)
+        counts,r = get_info_collection_counts(self.token)
+        self.assertEquals(counts["test"], 250)
+        collections,r = get_info_collections(self.token)
+        self.assertEquals(collections["test"], result["modified"])
+
     # Tests for DELETE /storage/<collection>/<object>
 
     def test_delete_objects(self):
@@ -518,6 +465,545 @@ class StorageTestCase(unittest.TestCase):
         collections,r = get_info_collections(self.token)
         self.assertTrue("test" not in collections)
 
+    def test_token_refreshed_once(self):
+        minted = []
+        def mint():
+            # The first token has the wrong key so every request gets a 401
+            minted.append(dict(self.token, key="wrong" if not minted else self.token["key"]))
+            return minted[-1]
+        token = ManagedToken(mint)
+        client = SyncStorageClient(pool_size=8)
+        statuses = []
+        def worker():
+            statuses.append(client.get_info_collections(token)[1].status_code)
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(statuses, [200] * 8)
+        self.assertEquals(len(minted), 2)
+
+    # Tests for gzip request and response bodies
+
+    def test_compressed_post_and_get(self):
+        objects = random_objects(50)
+        result,r = post_objects(self.token, "test", objects)
+        self.assertEquals(r.request.headers["Content-Encoding"], "gzip")
+        self.assertEquals(sorted(result["success"]), sorted(o["id"] for o in objects))
+        fetched,r = get_objects(self.token, "test", full=True)
+        self.assertEquals(r.headers["Content-Encoding"], "gzip")
+        self.assertEquals(sorted(o["payload"] for o in fetched), sorted(o["payload"] for o in objects))
+
+    def test_small_bodies_not_compressed(self):
+        result,r = post_objects(self.token, "test", random_objects(1))
+        self.assertTrue("Content-Encoding" not in r.request.headers)
+        self.assertTrue("Content-Encoding" not in r.headers)
+
+    def test_compression_disabled(self):
+        client = SyncStorageClient(compress_min_size=None)
+        result,r = client.post_objects(self.token, "test", random_objects(50))
+        self.assertTrue("Content-Encoding" not in r.request.headers)
+        objects,r = client.get_objects(self.token, "test", full=True)
+        self.assertEquals(len(objects), 50)
+        self.assertTrue("Content-Encoding" not in r.headers)
+
+    def test_timings_count_wire_bytes(self):
+        client = SyncStorageClient()
+        client.post_objects(self.token, "test", random_objects(50))
+        objects,r = client.get_objects(self.token, "test", full=True)
+        # Headers and the gzipped body, not the decoded one
+        received = client.timings[-1].received
+        self.assertTrue(int(r.headers["Content-Length"]) < received < len(r.content))
+
+    # Tests for a replayed sync session
+
+    def test_sync_session_replay(self):
+        profile = workload.ProfileModel(seed=42, scale=0.01)
+        session = workload.SyncSession(SyncStorageClient(), self.token, profile, batch_size=50)
+        session.first_sync()
+        counts,r = get_info_collection_counts(self.token)
+        self.assertEquals(counts, profile.counts())
+        # A sync without remote changes only fetches /info/collections
+        stats = session.sync()
+        self.assertEquals(stats["requests"], 1)
+        self.assertEquals(stats["downloaded"], 0)
+        # Local changes are uploaded and do not come back on the next sync
+        changes = profile.mutate()
+        stats = session.sync(changes)
+        self.assertEquals(stats["uploaded"], sum(len(records) for records in changes.values()))
+        stats = session.sync()
+        self.assertEquals(stats["downloaded"], 0)
+        objects,r = get_objects(self.token, "tabs", full=True)
+        self.assertEquals(sorted(o["payload"] for o in objects), sorted(o["payload"] for o in profile.records("tabs")))
+
+
+@unittest.skipUnless(LOCAL_SERVER, "needs SYNC_SERVER=local")
+class LocalStorageTestCase(UserTestCase):
+
+    # Tests for keyset cursors
+
+    def test_get_collection_cursor_paging(self):
+        # Records share timestamps and sortindexes, so the cursors have to
+        # break ties on the id
+        for i in range(9):
+            post_objects(self.token, "test", [{"id": "%.4d" % (i * 10 + j), "payload": "x", "sortindex": j % 3}
+                                              for j in range(10)])
+        for sort in ("oldest", "newest", "index"):
+            expected,r = get_objects(self.token, "test", sort=sort)
+            by_offset = []
+            for offset in range(0, 90, 25):
+                ids,r = get_objects(self.token, "test", sort=sort, limit=25, offset=offset)
+                by_offset += ids
+            by_cursor, offset = [], None
+            while True:
+                ids,r = get_objects(self.token, "test", sort=sort, limit=25, offset=offset)
+                by_cursor += ids
+                offset = r.headers.get("X-Weave-Next-Offset")
+                if offset is None:
+                    break
+                self.assertFalse(offset.isdigit())
+            self.assertEquals(by_offset, expected)
+            self.assertEquals(by_cursor, expected)
+            self.assertEquals(list(iter_objects(self.token, "test", sort=sort, page_size=25)), expected)
+
+
+    def test_get_collection_bad_cursor(self):
+        for i in range(5):
+            put_object(self.token, "test", str(i), random_object())
+        ids,r = get_objects(self.token, "test", sort="newest", limit=2)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            get_objects(self.token, "test", sort="oldest", limit=2, offset=r.headers["X-Weave-Next-Offset"])
+        self.assertEqual(context.exception.response.status_code, 400)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            get_objects(self.token, "test", sort="newest", limit=2, offset="garbage")
+        self.assertEqual(context.exception.response.status_code, 400)
+
+    # Tests for X-If-Modified-Since and X-If-Unmodified-Since
+
+    def test_get_info_collections_if_modified_since(self):
+        modified,r = put_object(self.token, "col1", random_id(), random_object())
+        collections,r = get_info_collections(self.token, if_modified_since=modified)
+        self.assertEquals(r.status_code, 304)
+        self.assertEquals(collections, None)
+        self.assertEquals(r.headers["X-Last-Modified"], "%.2f" % modified)
+        collections,r = get_info_collections(self.token, if_modified_since=modified - 0.01)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(collections["col1"], modified)
+
+    def test_get_collection_if_modified_since(self):
+        modified,r = put_object(self.token, "col1", random_id(), random_object())
+        objects,r = get_objects(self.token, "col1", if_modified_since=modified)
+        self.assertEquals(r.status_code, 304)
+        self.assertEquals(r.content, b"")
+        # A write to another collection does not count
+        put_object(self.token, "col2", random_id(), random_object())
+        objects,r = get_objects(self.token, "col1", if_modified_since=modified)
+        self.assertEquals(r.status_code, 304)
+        put_object(self.token, "col1", random_id(), random_object())
+        objects,r = get_objects(self.token, "col1", if_modified_since=modified)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(len(objects), 2)
+
+    def test_get_object_if_modified_since(self):
+        modified,r = put_object(self.token, "col1", "o1", random_object())
+        o,r = get_object(self.token, "col1", "o1", if_modified_since=modified)
+        self.assertEquals(r.status_code, 304)
+        o,r = get_object(self.token, "col1", "o1", if_modified_since=modified - 0.01)
+        self.assertEquals(o["modified"], modified)
+
+    def test_put_object_if_unmodified_since(self):
+        modified1,r = put_object(self.token, "col1", "o1", random_object())
+        modified2,r = put_object(self.token, "col1", "o1", random_object(), if_unmodified_since=modified1)
+        self.assertTrue(modified2 > modified1)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            put_object(self.token, "col1", "o1", random_object(), if_unmodified_since=modified1)
+        self.assertEqual(context.exception.response.status_code, 412)
+        o,r = get_object(self.token, "col1", "o1")
+        self.assertEquals(o["modified"], modified2)
+
+    def test_post_objects_if_unmodified_since(self):
+        j,r = post_objects(self.token, "col1", random_objects(3))
+        modified = j["modified"]
+        j,r = post_objects(self.token, "col1", random_objects(3), if_unmodified_since=modified)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            post_objects(self.token, "col1", random_objects(3), if_unmodified_since=modified)
+        self.assertEqual(context.exception.response.status_code, 412)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            delete_collection(self.token, "col1", if_unmodified_since=modified)
+        self.assertEqual(context.exception.response.status_code, 412)
+        counts,r = get_info_collection_counts(self.token)
+        self.assertEquals(counts["col1"], 6)
+
+    def test_collection_cache(self):
+        post_objects(self.token, "col1", random_objects(5))
+        post_objects(self.token, "col2", random_objects(3))
+        cache = collection_cache(self.token)
+        self.assertEquals(cache.sync(), ["col1", "col2"])
+        self.assertEquals(len(cache.get_collection("col1")), 5)
+        # Without remote changes a sync is a single 304
+        self.assertEquals(cache.sync(), [])
+        self.assertEquals(cache.hits, 2)
+        # Changes made by another client are picked up incrementally
+        modified,r = put_object(self.token, "col2", "other", random_object())
+        self.assertEquals(cache.sync(), ["col2"])
+        records = cache.get_collection("col2")
+        self.assertEquals(len(records), 4)
+        self.assertEquals([o["modified"] for o in records if o["id"] == "other"], [modified])
+        # Writes through the cache keep it current
+        cache.put_object("col1", "mine", random_object())
+        self.assertEquals(len(cache.get_collection("col1")), 6)
+        # A write based on a stale copy is refused
+        put_object(self.token, "col1", "mine", random_object())
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            cache.put_object("col1", "mine", random_object())
+        self.assertEqual(context.exception.response.status_code, 412)
+        self.assertEquals(cache.sync(), ["col1"])
+        cache.put_object("col1", "mine", random_object())
+        cache.put_object("col1", "mine", random_object())
+
+    def test_collection_cache_concurrent_writes(self):
+        post_objects(self.token, "col1", [{"id": "a", "payload": "a"}, {"id": "c", "payload": "c"}])
+        cache = collection_cache(self.token)
+        cache.sync()
+        # Another client writes to another item and deletes one, then a
+        # write through the cache to a third item succeeds
+        put_object(self.token, "col1", "b", {"payload": "b"})
+        delete_object(self.token, "col1", "c")
+        cache.put_object("col1", "a", {"payload": "a2"})
+        self.assertEquals(cache.sync(), ["col1"])
+        records = dict((o["id"], o["payload"]) for o in cache.get_collection("col1"))
+        self.assertEquals(records, {"a": "a2", "b": "b"})
+        self.assertEquals(cache.sync(), [])
+
+    # Tests for POST /storage/collection
+
+    def test_post_objects_bad_object(self):
+        j,r = post_objects(self.token, "test", [{"id": "good", "payload": "good"}, {"id": "bad", "payload": 1234}])
+        self.assertEquals(j["success"], ["good"])
+        self.assertEquals(list(j["failed"].keys()), ["bad"])
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            get_object(self.token, "test", "bad")
+        self.assertEqual(context.exception.response.status_code, 404)
+
+    # Tests for gzip request bodies
+
+    def test_post_objects_bad_gzip(self):
+        client = SyncStorageClient()
+        r = client.request("POST", self.token["api_endpoint"] + "/storage/test", self.token,
+                           headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}, data=b"[]")
+        self.assertEqual(r.status_code, 400)
+
+    def test_post_objects_gzip_too_large(self):
+        # Spaces compress about 1000:1, so this is a few KB on the wire
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        data = compressor.compress(b" " * (localserver.MAX_DECODED_BODY_SIZE + 1)) + compressor.flush()
+        client = SyncStorageClient()
+        r = client.request("POST", self.token["api_endpoint"] + "/storage/test", self.token,
+                           headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}, data=data)
+        self.assertEqual(r.status_code, 413)
+
+class PurgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = localserver.SQLiteStore()
+        self.uid = self.store.get_user("%s@mockmyid.com" % uuid.uuid4().hex)
+        self.now = int(time.time() * 1000)
+        # 20 expired, 5 that expire later and 5 that never expire
+        self.store.put_objects(self.uid, "tabs", [{"id": str(i), "payload": "x", "ttl": 60} for i in range(20)],
+                               self.now - 120 * 1000)
+        self.store.put_objects(self.uid, "tabs", [{"id": str(i), "payload": "x", "ttl": 3600} for i in range(20, 25)],
+                               self.now - 120 * 1000)
+        self.store.put_objects(self.uid, "history", [{"id": str(i), "payload": "x"} for i in range(5)], 1000)
+
+    def test_purge(self):
+        report = purge.purge(purge.SQLitePurger(self.store.db), now=self.now, batch_size=7)
+        self.assertEquals(report["rows"], 20)
+        self.assertEquals(report["batches"], 3)
+        self.assertEquals(report["payload_bytes"], 20)
+        self.assertEquals(self.store.info_collection_counts(self.uid), {"tabs": 5, "history": 5})
+        report = purge.purge(purge.SQLitePurger(self.store.db), now=self.now)
+        self.assertEquals(report["rows"], 0)
+
+    def test_purge_dry_run(self):
+        report = purge.purge(purge.SQLitePurger(self.store.db), now=self.now, batch_size=7, dry_run=True)
+        self.assertEquals(report["rows"], 20)
+        self.assertEquals(self.store.info_collection_counts(self.uid), {"tabs": 25, "history": 5})
+
+    def test_purge_time_budget(self):
+        report = purge.purge(purge.SQLitePurger(self.store.db), now=self.now, max_seconds=0)
+        self.assertTrue(report["budget_exhausted"])
+        self.assertEquals(report["rows"], 0)
+
+
+class DumpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = localserver.SQLiteStore()
+        self.db = dump.SQLiteDatabase(self.store.db)
+        self.uid = self.store.get_user("%s@mockmyid.com" % uuid.uuid4().hex)
+        self.store.put_objects(self.uid, "history", [{"id": "h%d" % i, "payload": "line\n\ttab \\ %d" % i,
+                                                       "sortindex": i} for i in range(50)], 1000)
+        self.store.put_objects(self.uid, "tabs", [{"id": "t1", "payload": u"\u00e9\u6f22", "ttl": 60}], 2000)
+        self.dump = io.BytesIO()
+        self.export = dump.export_user(self.db, self.uid, self.dump)
+
+    def read(self, uid):
+        return (self.store.info_collections(uid), self.store.info_collection_counts(uid),
+                self.store.get_objects(uid, "history", sort="index"), self.store.get_object(uid, "tabs", "t1"))
+
+    def test_round_trip(self):
+        self.assertEquals(self.export["rows"], 51)
+        self.assertEquals(self.export["bytes"], len(self.dump.getvalue()))
+        uid = self.store.get_user("%s@mockmyid.com" % uuid.uuid4().hex)
+        report = dump.import_user(self.db, io.BytesIO(self.dump.getvalue()), uid)
+        self.assertEquals((report["rows"], report["sha256"]), (51, self.export["sha256"]))
+        self.assertEquals(self.read(uid), self.read(self.uid))
+        again = io.BytesIO()
+        dump.export_user(self.db, uid, again)
+        self.assertEquals(again.getvalue().split(b"\n", 1)[1], self.dump.getvalue().split(b"\n", 1)[1])
+
+    def test_existing_user(self):
+        with self.assertRaises(dump.DumpError):
+            dump.import_user(self.db, io.BytesIO(self.dump.getvalue()))
+        report = dump.import_user(self.db, io.BytesIO(self.dump.getvalue()), replace=True)
+        self.assertEquals(report["uid"], self.uid)
+        self.assertEquals(self.store.info_collection_counts(self.uid), {"history": 50, "tabs": 1})
+
+    def test_checksum_mismatch(self):
+        uid = self.store.get_user("%s@mockmyid.com" % uuid.uuid4().hex)
+        corrupt = self.dump.getvalue().replace(b'"h7",7,', b'"h7",70,')
+        with self.assertRaises(dump.DumpError):
+            dump.import_user(self.db, io.BytesIO(corrupt), uid)
+        truncated = b"\n".join(self.dump.getvalue().split(b"\n")[:10]) + b"\n"
+        with self.assertRaises(dump.DumpError):
+            dump.import_user(self.db, io.BytesIO(truncated), uid)
+        # Both imports were rolled back
+        self.assertEquals(self.store.info_collection_counts(uid), {})
+
+    def test_corrupt_dump(self):
+        uid = self.store.get_user("%s@mockmyid.com" % uuid.uuid4().hex)
+        lines = self.dump.getvalue().split(b"\n")
+        for corrupt in [lines[:5] + [b'["h4",'] + lines[6:], lines[:-2] + [b'{"rows":'], lines[:-2] + [b"x\xff"],
+                        [b"[]"] + lines[1:]]:
+            with self.assertRaises(dump.DumpError):
+                dump.import_user(self.db, io.BytesIO(b"\n".join(corrupt)), uid)
+        self.assertEquals(self.store.info_collection_counts(uid), {})
+
+
+class CachedStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = localserver.TimedStore(localserver.SQLiteStore())
+        self.cache = localserver.CachedStore(self.store)
+        self.uid = self.store.get_user("%s@mockmyid.com" % uuid.uuid4().hex)
+        self.cache.put_objects(self.uid, "meta", [{"id": "global", "payload": "x"}], 1000)
+        self.cache.put_objects(self.uid, "history", [{"id": "h1", "payload": "x"}], 2000)
+
+    def test_hits(self):
+        queries = self.store.queries
+        for i in range(3):
+            self.assertEquals(self.cache.info_collections(self.uid), {"meta": 1000, "history": 2000})
+            self.assertEquals(self.cache.get_object(self.uid, "meta", "global")["payload"], "x")
+            self.cache.get_object(self.uid, "history", "h1")
+        # Only the first info and meta reads and every history read hit the store
+        self.assertEquals(self.store.queries - queries, 5)
+        self.assertEquals((self.cache.hits, self.cache.misses), (4, 2))
+        # Callers get copies
+        self.cache.get_object(self.uid, "meta", "global")["payload"] = "changed"
+        self.assertEquals(self.cache.get_object(self.uid, "meta", "global")["payload"], "x")
+
+    def test_invalidation(self):
+        self.cache.info_collections(self.uid)
+        objects, more = self.cache.get_objects(self.uid, "meta")
+        self.cache.put_objects(self.uid, "meta", [{"id": "global", "payload": "y"}], 3000)
+        self.assertEquals(self.cache.info_collections(self.uid)["meta"], 3000)
+        self.assertEquals(self.cache.get_objects(self.uid, "meta")[0][0]["payload"], "y")
+        self.cache.delete_objects(self.uid, "meta", ["global"])
+        self.assertEquals(self.cache.get_object(self.uid, "meta", "global"), None)
+        self.assertEquals(self.cache.info_collections(self.uid), {"history": 2000})
+        self.cache.delete_storage(self.uid)
+        self.assertEquals(self.cache.info_collections(self.uid), {})
+
+    def test_eviction(self):
+        cache = localserver.CachedStore(self.store, max_bytes=1024)
+        for uid in range(100):
+            cache.info_collections(uid)
+        self.assertTrue(cache.bytes <= 1024)
+        self.assertTrue(cache.evictions > 0)
+        self.assertEquals(len(cache.entries), sum(len(keys) for keys in cache.keys.values()))
+
+
+class NodesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = localserver.LocalCluster().start()
+        self.client = SyncStorageClient()
+
+    def tearDown(self):
+        self.client.close()
+        self.cluster.stop()
+
+    def token(self, email):
+        assertion = self.cluster.token_server.app.signer.make_assertion(email, self.cluster.url)
+        token,r = self.client.call_token_server(self.cluster.url, assertion)
+        return token
+
+    def node_of(self, token):
+        return [node.name for node in self.cluster.nodes if token["api_endpoint"].startswith(node.url + "/")][0]
+
+    def test_assign_node(self):
+        weighted = [nodes.Node("a", "", None, 100), nodes.Node("b", "", None, 100), nodes.Node("c", "", None, 200)]
+        keys = ["user%d@example.com" % i for i in range(4000)]
+        assigned = dict((key, nodes.assign_node(key, weighted).name) for key in keys)
+        shares = dict((name, list(assigned.values()).count(name) / 4000.0) for name in "abc")
+        self.assertTrue(0.2 < shares["a"] < 0.3 and 0.2 < shares["b"] < 0.3 and 0.45 < shares["c"] < 0.55)
+        # Without c only the keys that were on c move
+        moved = [key for key in keys if nodes.assign_node(key, weighted[:2]).name != assigned[key]]
+        self.assertEquals(sorted(moved), sorted(key for key in keys if assigned[key] == "c"))
+
+    def test_users_spread(self):
+        emails = ["%s@mockmyid.com" % uuid.uuid4().hex for i in range(30)]
+        assigned = [self.node_of(self.token(email)) for email in emails]
+        self.assertEquals(sorted(set(assigned)), ["node1", "node2", "node3"])
+        # Users keep their node
+        self.assertEquals([self.node_of(self.token(email)) for email in emails], assigned)
+
+    def test_reads_go_to_node(self):
+        token = self.token("%s@mockmyid.com" % uuid.uuid4().hex)
+        name = self.node_of(token)
+        self.client.put_object(token, "col1", "x", {"payload": "on %s" % name})
+        for other, server in self.cluster.servers.items():
+            counts = server.timed_store.store.info_collection_counts(token["uid"])
+            self.assertEquals(counts, {"col1": 1} if other == name else {})
+            if other != name:
+                url = server.url + "/storage/1.5/%d/info/collections" % token["uid"]
+                self.assertEquals(self.client.request("GET", url, token).status_code, 401)
+
+    def test_drain(self):
+        # Five of these hash to node1
+        emails = ["drain%d@mockmyid.com" % i for i in range(12)]
+        tokens = [self.token(email) for email in emails]
+        for i, token in enumerate(tokens):
+            self.client.post_objects(token, "col1", [{"id": str(n), "payload": "%d/%d" % (i, n)} for n in range(5)])
+        before = [self.client.get_objects(token, "col1", full=True)[0] for token in tokens]
+        self.assertEquals([self.node_of(token) for token in tokens].count("node1"), 5)
+        report = self.cluster.drain("node1")
+        self.assertEquals((report["users"], report["rows"]), (5, 25))
+        self.assertEquals(self.cluster.token_server.app.store.node_users("node1"), [])
+        self.assertEquals(self.cluster.servers["node1"].timed_store.store.db.execute(
+            "select count(*) from Objects").fetchone()[0], 0)
+        # Fresh tokens point to the new nodes, where the data now is
+        tokens = [self.token(email) for email in emails]
+        self.assertTrue("node1" not in [self.node_of(token) for token in tokens])
+        self.assertEquals([self.client.get_objects(token, "col1", full=True)[0] for token in tokens], before)
+
+    def test_drain_shared_data_source(self):
+        emails = ["drain%d@mockmyid.com" % i for i in range(12)]
+        tokens = [self.token(email) for email in emails]
+        for i, token in enumerate(tokens):
+            self.client.post_objects(token, "col1", [{"id": str(n), "payload": "%d/%d" % (i, n)} for n in range(5)])
+        moving = [token for token in tokens if self.node_of(token) == "node1"]
+        # node2 is configured with node1's DataSource, through its own connection
+        db = self.cluster.servers["node1"].timed_store.store.db
+        shared = [nodes.Node("node1", "", "shared", 0), nodes.Node("node2", "", "shared", 100)]
+        databases = {"node1": dump.SQLiteDatabase(db), "node2": dump.SQLiteDatabase(db)}
+        report = nodes.drain(self.cluster.token_server.app.store, databases, "node1", shared)
+        self.assertEquals((report["users"], report["rows"]), (5, 0))
+        self.assertEquals(report["moves"], {"node2": 5})
+        self.assertEquals(db.execute("select count(*) from Objects").fetchone()[0], 25)
+        for token in moving:
+            self.assertEquals(self.cluster.token_server.app.store.get_node(token["uid"]), ("node2", False))
+
+    def test_refreshed_token_on_new_node(self):
+        token = self.token("%s@mockmyid.com" % uuid.uuid4().hex)
+        other = [node for node in self.cluster.nodes if node.name != self.node_of(token)][0]
+        minted = []
+        def mint():
+            # As if the user was moved after the first token was handed out
+            stale = dict(token, key="wrong", api_endpoint="%s/1.5/%d" % (other.url, token["uid"]))
+            minted.append(stale if not minted else token)
+            return minted[-1]
+        managed = ManagedToken(mint)
+        self.assertEquals(self.client.get_info_collections(managed)[1].status_code, 200)
+        self.assertEquals(len(minted), 2)
+
+    def test_migrating_user(self):
+        email = "%s@mockmyid.com" % uuid.uuid4().hex
+        token = self.token(email)
+        self.cluster.token_server.app.store.set_node(token["uid"], self.node_of(token), migrating=True)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            self.token(email)
+        self.assertEqual(context.exception.response.status_code, 503)
+
+    def test_unknown_node(self):
+        email = "%s@mockmyid.com" % uuid.uuid4().hex
+        token = self.token(email)
+        # Like the users that migrations/003-user-nodes.sql put on "default"
+        self.cluster.token_server.app.store.set_node(token["uid"], nodes.DEFAULT_NODE)
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            self.token(email)
+        self.assertEqual(context.exception.response.status_code, 503)
+        self.cluster.token_server.app.store.set_node(token["uid"], "node2")
+        self.assertEquals(self.node_of(self.token(email)), "node2")
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_route_name(self):
+        self.assertEquals(metrics.route_name("/storage/1.5/42/storage/tabs"), "/storage/1.5/{uid}/storage/{collection}")
+        self.assertEquals(metrics.route_name("/storage/1.5/42/storage/tabs/x"), "/storage/1.5/{uid}/storage/{collection}/{id}")
+        self.assertEquals(metrics.route_name("/storage/1.5/42/info/collections"), "/storage/1.5/{uid}/info/collections")
+        self.assertEquals(metrics.route_name("/storage/1.5/42/storage/tabs/x/y"), "other")
+        # Storage nodes mounted on their own path
+        self.assertEquals(metrics.route_name("/storage/node1/1.5/42/storage/tabs"), "/storage/1.5/{uid}/storage/{collection}")
+        self.assertEquals(metrics.route_name("/storage/node1/1.5/42/info/collections"), "/storage/1.5/{uid}/info/collections")
+        self.assertEquals(metrics.route_name("/storage/node1/1.5"), "other")
+
+    def test_attribute(self):
+        m = metrics.Metrics()
+        for seconds in (0.002, 0.004, 0.3):
+            m.request_started()
+            m.request_finished("/storage/1.5/{uid}/storage/{collection}", "GET", 200, seconds, 0, 1000, 10, seconds / 2)
+        before = metrics.parse(m.render())
+        m.request_started()
+        m.request_finished("/storage/1.5/{uid}/storage/{collection}", "POST", 400, 0.1, 500, 20, 5)
+        rows = metrics.attribute(metrics.delta(before, metrics.parse(m.render())))
+        self.assertEquals(len(rows), 1)
+        self.assertEquals((rows[0]["method"], rows[0]["count"], rows[0]["errors"], rows[0]["records"]), ("POST", 1, 1, 5))
+        rows = metrics.attribute(metrics.parse(m.render()))
+        self.assertEquals([r["method"] for r in rows], ["GET", "POST"])
+        self.assertAlmostEqual(rows[0]["seconds"], 0.306)
+        self.assertAlmostEqual(rows[0]["db_seconds"], 0.153)
+        self.assertTrue(0.0025 <= rows[0]["p50"] <= 0.005)
+
+class BenchmarksTestCase(unittest.TestCase):
+
+    def run_of(self, factor, seed):
+        # Rounds of skewed timings around 10ms, scaled by factor
+        rnd = random.Random(seed)
+        rounds = [[factor * 0.01 * rnd.lognormvariate(0, 0.2) for i in range(20)] for r in range(10)]
+        return {"format": benchmarks.SUITE_FORMAT, "version": benchmarks.SUITE_VERSION, "environment": {"commit": "c%d" % seed},
+                "scenarios": {"put_object": {"operation": "PUT", "rounds": rounds}}}
+
+    def test_compare_runs(self):
+        baseline = self.run_of(1.0, 1)
+        for factor, verdict in ((1.0, "same"), (1.03, "same"), (1.5, "REGRESSION"), (0.5, "improvement")):
+            rows = benchmarks.compare_runs(baseline, self.run_of(factor, 2))
+            self.assertEquals(rows[0]["verdict"], verdict)
+            self.assertTrue(rows[0]["low"] <= rows[0]["ratio"] <= rows[0]["high"])
+
+    def test_compression_bytes(self):
+        results = dict(((r["mode"], r["phase"]), r) for r in benchmarks.bench_compression(SERVER, scale=0.01))
+        profile = workload.ProfileModel(0, 0.01, shared_noise=False)
+        payloads = sum(len(record["payload"]) for name in profile.collections for record in profile.records(name))
+        self.assertTrue(results["identity", "download"]["bytes_received"] >= payloads)
+        self.assertTrue(results["gzip", "download"]["bytes_received"] < results["identity", "download"]["bytes_received"])
+
+    def test_merge_runs(self):
+        merged = benchmarks.merge_runs([self.run_of(1.0, 1), self.run_of(1.0, 2)])
+        self.assertEquals(len(merged["scenarios"]["put_object"]["rounds"]), 20)
+        self.assertEquals(merged["environment"]["commit"], "c1,c2")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function
+
+import argparse
+import base64
+import binascii
+import collections
+import json
+import math
+import random
+import time
+import uuid
+
+import localserver
+from syncclient import DEFAULT_BATCH_SIZE, SERVER, SyncStorageClient
+
+# Shape of a typical desktop profile. Payload sizes are for the encrypted
+# BSO payload as it is stored in Objects.Payload, lognormal around the
+# median. Churn is the fraction of records that change between syncs.
+CollectionModel = collections.namedtuple("CollectionModel",
+    ["name", "count", "payload_median", "payload_sigma", "sortindex_max", "ttl", "churn"])
+
+COLLECTION_MODELS = [
+    CollectionModel("bookmarks", 1200, 420, 0.5, 2000, None, 0.005),
+    CollectionModel("history", 15000, 560, 0.4, 10000, None, 0.01),
+    CollectionModel("forms", 700, 260, 0.3, 0, 5184000, 0.01),
+    CollectionModel("passwords", 120, 880, 0.3, 0, None, 0.002),
+    CollectionModel("tabs", 3, 4200, 0.8, 0, 1814400, 1.0),
+    CollectionModel("clients", 3, 540, 0.2, 0, 1814400, 0.34),
+    CollectionModel("meta", 1, 380, 0.0, 0, None, 0.0),
+    CollectionModel("crypto", 1, 340, 0.0, 0, None, 0.0),
+]
+
+_GUID_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+def random_id():
+    return str(uuid.uuid4())
+
+def random_object():
+    return {"payload":"This is some payload at %f" % time.time()}
+
+def random_object_with_id():
+    return {"payload":"This is some payload at %f" % time.time(), "id": random_id()}
+
+def random_objects(n):
+    return [{"payload":"This is some payload at %f" % time.time(), "id":random_id()} for i in range(n)]
+
+class ProfileModel(object):
+
+    """Seeded generator for the records of one Firefox profile. The same
+    seed and scale always produce the same collections and changes.
+
+    With shared_noise every ciphertext is a slice of one random block, so
+    a batch of records compresses far better than real, independently
+    encrypted records do. Compression benchmarks turn it off."""
+
+    def __init__(self, seed=0, scale=1.0, models=COLLECTION_MODELS, shared_noise=True):
+        self.rnd = random.Random(seed)
+        self.models = models
+        self.scale = scale
+        self.shared_noise = shared_noise
+        # Ciphertext is sliced from one random block so generating large
+        # profiles stays cheap. It is base64 like the real thing.
+        self.noise = base64.b64encode(bytearray(self.rnd.getrandbits(8) for i in range(48 * 1024)))
+        if not isinstance(self.noise, str):
+            self.noise = self.noise.decode("ascii")
+        self.collections = {}
+        for model in models:
+            count = max(1, int(round(model.count * scale))) if model.count > 1 else model.count
+            if model.name == "meta":
+                ids = ["global"]
+            elif model.name == "crypto":
+                ids = ["keys"]
+            else:
+                ids = [self.random_guid() for i in range(count)]
+            self.collections[model.name] = collections.OrderedDict((i, self.random_record(model, i)) for i in ids)
+
+    def random_guid(self):
+        return "".join(self.rnd.choice(_GUID_ALPHABET) for i in range(12))
+
+    def random_payload(self, model):
+        size = int(model.payload_median * math.exp(self.rnd.gauss(0, model.payload_sigma)))
+        size = min(max(size - 110, 16), len(self.noise) - 24)
+        if self.shared_noise:
+            start = self.rnd.randint(0, len(self.noise) - size)
+            ciphertext, iv = self.noise[start:start+size], self.noise[start:start+24]
+        else:
+            ciphertext, iv = self.random_base64(size), self.random_base64(24)
+        hmac = "%064x" % self.rnd.getrandbits(256)
+        return json.dumps({"ciphertext": ciphertext, "IV": iv, "hmac": hmac})
+
+    def random_base64(self, size):
+        n = size * 3 // 4 + 3
+        data = base64.b64encode(binascii.unhexlify("%0*x" % (n * 2, self.rnd.getrandbits(n * 8))))
+        return data.decode("ascii")[:size]
+
+    def random_record(self, model, object_id):
+        record = {"id": object_id, "payload": self.random_payload(model)}
+        if model.sortindex_max:
+            record["sortindex"] = self.rnd.randint(0, model.sortindex_max)
+        if model.ttl:
+            record["ttl"] = model.ttl
+        return record
+
+    def records(self, collection_name):
+        return list(self.collections[collection_name].values())
+
+    def counts(self):
+        return dict((name, len(records)) for name, records in self.collections.items())
+
+    def mutate(self):
+        """Apply one sync interval worth of local changes and return them
+        as a dict of collection name to changed records."""
+        changes = {}
+        for model in self.models:
+            records = self.collections[model.name]
+            n = int(round(len(records) * model.churn))
+            if n == 0 and model.churn and self.rnd.random() < len(records) * model.churn:
+                n = 1
+            if n == 0:
+                continue
+            changed = []
+            for object_id in self.rnd.sample(list(records.keys()), n):
+                records[object_id] = self.random_record(model, object_id)
+                changed.append(records[object_id])
+            changes[model.name] = changed
+        return changes
+
+def batches(records, batch_size):
+    for i in range(0, len(records), batch_size):
+        yield records[i:i+batch_size]
+
+def upload_profile(client, token, profile, batch_size=DEFAULT_BATCH_SIZE):
+    """Load all of a profile's records into the account behind token."""
+    last_modified = {}
+    for name in sorted(profile.collections.keys()):
+        result = client.upload_objects(token, name, profile.records(name), batch_size=batch_size)
+        last_modified[name] = result["modified"]
+    return last_modified
+
+class SyncSession(object):
+
+    """Replays the requests a desktop client makes during a sync: fetch
+    /info/collections, download only the collections that changed since
+    the last sync and upload local changes in batches."""
+
+    def __init__(self, client, token, profile, batch_size=DEFAULT_BATCH_SIZE):
+        self.client = client
+        self.token = token
+        self.profile = profile
+        self.batch_size = batch_size
+        self.last_modified = {}
+
+    def first_sync(self):
+        self.last_modified = upload_profile(self.client, self.token, self.profile, self.batch_size)
+
+    def sync(self, changes=None):
+        stats = {"requests": 0, "downloaded": 0, "uploaded": 0, "bytes_down": 0, "bytes_up": 0}
+        started = time.time()
+        info,r = self.client.get_info_collections(self.token)
+        stats["requests"] += 1
+        stats["bytes_down"] += len(r.content)
+        for name, modified in sorted(info.items()):
+            if modified <= self.last_modified.get(name, 0):
+                continue
+            objects,r = self.client.get_objects(self.token, name, full=True, newer=self.last_modified.get(name))
+            stats["requests"] += 1
+            stats["downloaded"] += len(objects)
+            stats["bytes_down"] += len(r.content)
+            self.last_modified[name] = modified
+        for name, records in sorted((changes or {}).items()):
+            for batch in batches(records, self.batch_size):
+                body = json.dumps(batch)
+                j,r = self.client.post_objects(self.token, name, batch)
+                stats["requests"] += 1
+                stats["uploaded"] += len(j["success"])
+                stats["bytes_up"] += len(body)
+                self.last_modified[name] = j["modified"]
+        stats["duration"] = time.time() - started
+        return stats
+
+def new_token(client, server):
+    return client.mint_token(server, "%s@mockmyid.com" % uuid.uuid4().hex)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay Firefox sync sessions against a sync server")
+    parser.add_argument("--server", default=SERVER, type=localserver.resolve_server)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the record counts")
+    parser.add_argument("--syncs", type=int, default=10, help="number of incremental syncs to replay")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    client = SyncStorageClient()
+    profile = ProfileModel(args.seed, args.scale)
+    session = SyncSession(client, new_token(client, args.server), profile, args.batch_size)
+
+    started = time.time()
+    session.first_sync()
+    print("first sync: %d records in %.2fs" % (sum(profile.counts().values()), time.time() - started))
+    for i in range(args.syncs):
+        stats = session.sync(profile.mutate())
+        print("sync %d: %.3fs requests=%d downloaded=%d uploaded=%d bytes_down=%d bytes_up=%d" % (
+              i + 1, stats["duration"], stats["requests"], stats["downloaded"], stats["uploaded"],
+              stats["bytes_down"], stats["bytes_up"]))